@@ -0,0 +1,217 @@
+import json
+import os
+import shutil
+from functools import cached_property
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from loguru import logger
+
+from utils import load_json
+from .constants import possible_headers, path_dir_data
+
+STORE_FORMAT_VERSION = 1
+META_FILE_NAME = "meta.json"
+HEADER_VALUES_FILE_NAME = "header_values.json"
+HEADERS_FILE_NAME = "headers.npy"
+CONTENT_FILE_NAME = "content.bin"
+CONTENT_OFFSETS_FILE_NAME = "content_offsets.npy"
+NUMS_FILE_NAME = "nums.bin"
+NUM_OFFSETS_FILE_NAME = "num_offsets.npy"
+
+
+def get_store_path(code_name: str, dir_data: str = path_dir_data) -> str:
+    return os.path.join(dir_data, f"{code_name}.store")
+
+
+def _source_signature(json_path: str) -> dict:
+    stat = os.stat(json_path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def get_source_signature(
+    code_name: str, dir_data: str = path_dir_data
+) -> Optional[dict]:
+    """
+    Signature of the file the articles of a code are loaded from: the JSON file, or
+    the one the article store was converted from when there is no JSON file. None
+    when the code has neither.
+    """
+    json_path = os.path.join(dir_data, f"{code_name}.json")
+    if os.path.exists(json_path):
+        return _source_signature(json_path)
+    meta_path = os.path.join(get_store_path(code_name, dir_data), META_FILE_NAME)
+    if os.path.exists(meta_path):
+        return load_json(meta_path)["source"]
+    return None
+
+
+def _write_blob(strings: List[str], blob_path: str, offsets_path: str):
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    with open(blob_path, "wb") as f:
+        f.write(b"".join(encoded))
+    np.save(offsets_path, offsets)
+
+
+def convert_json_to_store(json_path: str, store_path: str) -> None:
+    """
+    Convert a code saved as JSON by `get_code_articles` into an article store.
+
+    The store is a directory holding the article contents and numbers as utf-8
+    blobs with their offsets, and the headers (`livre`, `titre`, ...) of each
+    article as ids into a dictionary of distinct header values.
+    """
+    articles = load_json(json_path)
+    header_names = list(possible_headers)
+    header_values: Dict[str, int] = {}
+    headers = np.full((len(articles), len(header_names), 2), -1, dtype=np.int32)
+
+    for i, article in enumerate(articles):
+        article_headers = [
+            (k, v) for k, v in article.items() if k not in ["content", "num"]
+        ]
+        for j, (header_name, header_value) in enumerate(article_headers):
+            if header_name not in header_names:
+                header_names.append(header_name)
+                headers = np.concatenate(
+                    [headers, np.full((len(articles), 1, 2), -1, dtype=np.int32)],
+                    axis=1,
+                )
+            headers[i, j, 0] = header_names.index(header_name)
+            headers[i, j, 1] = header_values.setdefault(
+                header_value, len(header_values)
+            )
+
+    tmp_path = f"{store_path}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    _write_blob(
+        [article["content"] for article in articles],
+        os.path.join(tmp_path, CONTENT_FILE_NAME),
+        os.path.join(tmp_path, CONTENT_OFFSETS_FILE_NAME),
+    )
+    _write_blob(
+        [article["num"] for article in articles],
+        os.path.join(tmp_path, NUMS_FILE_NAME),
+        os.path.join(tmp_path, NUM_OFFSETS_FILE_NAME),
+    )
+    np.save(os.path.join(tmp_path, HEADERS_FILE_NAME), headers)
+    with open(os.path.join(tmp_path, HEADER_VALUES_FILE_NAME), "w") as js:
+        json.dump(list(header_values), js)
+    with open(os.path.join(tmp_path, META_FILE_NAME), "w") as js:
+        json.dump(
+            {
+                "version": STORE_FORMAT_VERSION,
+                "n_articles": len(articles),
+                "header_names": header_names,
+                "source": _source_signature(json_path),
+            },
+            js,
+        )
+
+    shutil.rmtree(store_path, ignore_errors=True)
+    os.replace(tmp_path, store_path)
+
+
+class ArticleStore(Sequence):
+    """
+    Read-only, memory-mapped view of the articles of a code.
+
+    Articles are decoded into the same dicts as the JSON files (`content`, `num`
+    and the headers, in the same order) only when accessed, so opening a store
+    costs a few small file reads whatever the size of the code.
+    """
+
+    def __init__(self, store_path: str):
+        self.store_path = store_path
+        with open(os.path.join(store_path, META_FILE_NAME), "r") as js:
+            self.meta = json.load(js)
+        self.header_names = self.meta["header_names"]
+        self._content = self._map_blob(CONTENT_FILE_NAME)
+        self._content_offsets = np.load(
+            self._path(CONTENT_OFFSETS_FILE_NAME), mmap_mode="r"
+        )
+        self._nums = self._map_blob(NUMS_FILE_NAME)
+        self._num_offsets = np.load(self._path(NUM_OFFSETS_FILE_NAME), mmap_mode="r")
+        self._headers = np.load(self._path(HEADERS_FILE_NAME), mmap_mode="r")
+
+    def _path(self, file_name: str) -> str:
+        return os.path.join(self.store_path, file_name)
+
+    def _map_blob(self, file_name: str) -> np.ndarray:
+        # empty files cannot be memory-mapped
+        if os.path.getsize(self._path(file_name)) == 0:
+            return np.zeros(0, dtype=np.uint8)
+        return np.memmap(self._path(file_name), dtype=np.uint8, mode="r")
+
+    @cached_property
+    def _header_values(self) -> List[str]:
+        with open(self._path(HEADER_VALUES_FILE_NAME), "r") as js:
+            return json.load(js)
+
+    @cached_property
+    def _num_to_position(self) -> Dict[str, int]:
+        return {self.get_num(i): i for i in range(len(self))}
+
+    def __len__(self) -> int:
+        return self.meta["n_articles"]
+
+    @staticmethod
+    def _decode(blob: np.memmap, offsets: np.ndarray, i: int) -> str:
+        return blob[offsets[i] : offsets[i + 1]].tobytes().decode("utf-8")
+
+    def get_num(self, i: int) -> str:
+        return self._decode(self._nums, self._num_offsets, i)
+
+    def get_content(self, i: int) -> str:
+        return self._decode(self._content, self._content_offsets, i)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"Article index {i} out of range.")
+        article = {"content": self.get_content(i), "num": self.get_num(i)}
+        for header_name_id, header_value_id in self._headers[i]:
+            if header_name_id < 0:
+                break
+            article[self.header_names[header_name_id]] = self._header_values[
+                header_value_id
+            ]
+        return article
+
+    def get_by_num(self, num: str) -> dict:
+        return self[self._num_to_position[num]]
+
+
+def load_article_store(code_name: str, dir_data: str = path_dir_data) -> ArticleStore:
+    """
+    Open the article store of a code, (re)building it from the code JSON file when
+    it is missing or older than the JSON file.
+    """
+    json_path = os.path.join(dir_data, f"{code_name}.json")
+    store_path = get_store_path(code_name, dir_data)
+
+    if os.path.exists(os.path.join(store_path, META_FILE_NAME)):
+        store = ArticleStore(store_path)
+        if not os.path.exists(json_path) or (
+            store.meta["version"] == STORE_FORMAT_VERSION
+            and store.meta["source"] == _source_signature(json_path)
+        ):
+            return store
+
+    if not os.path.exists(json_path):
+        raise FileNotFoundError(f"No article store nor JSON file for {code_name}.")
+    logger.info(f"Converting {json_path} to an article store.")
+    convert_json_to_store(json_path, store_path)
+    return ArticleStore(store_path)
+
+
+if __name__ == "__main__":
+    for file_name in sorted(os.listdir(path_dir_data)):
+        if file_name.endswith(".json"):
+            load_article_store(file_name[: -len(".json")])
@@ -0,0 +1,159 @@
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Callable, List, Optional, Tuple
+
+from loguru import logger
+
+from schema import (
+    EMBEDDING_MODELS_MAX_TOKENS,
+    FASTEMBED_MAX_TOKENS,
+    HASHING_EMBEDDING_MAX_TOKENS,
+    HASHING_EMBEDDING_PREFIX,
+)
+
+# used when the tokenizer of a model cannot be loaded: French text averages more
+# than 3 characters per token, so this overestimates token counts
+CHARS_PER_TOKEN_ESTIMATE = 3
+# Mistral's tokenizer is not a dependency of the project, its counts are estimated
+# from the cl100k_base ones with a safety factor
+MISTRAL_TOKENS_PER_CL100K_TOKEN = 1.2
+
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.;:!?])\s+")
+
+# (separator preceding the unit, unit text, number of tokens of the unit)
+Unit = Tuple[str, str, int]
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN_ESTIMATE + 1
+
+
+@lru_cache(maxsize=None)
+def get_token_counter(embedding_model_name: str) -> Callable[[str], int]:
+    """Return a function counting the tokens of a text for the given embedding model."""
+    try:
+        if "multilingual" in embedding_model_name:
+            from tokenizers import Tokenizer
+
+            tokenizer = Tokenizer.from_pretrained(embedding_model_name)
+            tokenizer.no_truncation()
+            return lambda text: len(tokenizer.encode(text).ids)
+
+        import tiktoken
+
+        encoding = tiktoken.get_encoding("cl100k_base")
+        if "mistral" in embedding_model_name:
+            return (
+                lambda text: int(
+                    len(encoding.encode_ordinary(text))
+                    * MISTRAL_TOKENS_PER_CL100K_TOKEN
+                )
+                + 1
+            )
+        return lambda text: len(encoding.encode_ordinary(text))
+    except Exception as exc:
+        logger.warning(
+            f"Could not load the tokenizer of {embedding_model_name} ({exc!r}). "
+            "Token counts will be estimated from the number of characters."
+        )
+        return estimate_tokens
+
+
+def get_max_tokens(embedding_model_name: str) -> int:
+    if embedding_model_name in EMBEDDING_MODELS_MAX_TOKENS:
+        return EMBEDDING_MODELS_MAX_TOKENS[embedding_model_name]
+    if "multilingual" in embedding_model_name:
+        return FASTEMBED_MAX_TOKENS
+    if embedding_model_name.startswith(HASHING_EMBEDDING_PREFIX):
+        return HASHING_EMBEDDING_MAX_TOKENS
+    raise ValueError(
+        f"Unknown token limit for embeddings model {embedding_model_name}."
+    )
+
+
+@dataclass
+class TokenChunker:
+    """
+    Split texts into chunks of at most `max_tokens` tokens.
+
+    Texts are split on line breaks (the paragraphs kept by `clean_content`), then on
+    sentences and finally on words for the pieces that are still too long. The
+    pieces are then packed greedily into chunks, each chunk starting with the last
+    pieces of the previous one up to `overlap_tokens` tokens. Every piece is
+    tokenized once, so the cost is linear in the length of the text.
+    """
+
+    count_tokens: Callable[[str], int]
+    max_tokens: int
+    overlap_tokens: int = 0
+
+    def split(self, text: str, max_tokens: Optional[int] = None) -> List[str]:
+        max_tokens = max_tokens or self.max_tokens
+        units = []
+        for paragraph in text.split("\n"):
+            if paragraph.strip():
+                units.extend(self._split_into_units(paragraph, "\n", max_tokens))
+        if not units:
+            return [text]
+        return self._merge_units(units, max_tokens)
+
+    def _split_into_units(
+        self, text: str, separator: str, max_tokens: int, level: int = 0
+    ) -> List[Unit]:
+        n_tokens = self.count_tokens(text)
+        if n_tokens <= max_tokens:
+            return [(separator, text, n_tokens)]
+
+        if level == 0:
+            parts = SENTENCE_BOUNDARY.split(text)
+        elif level == 1:
+            parts = text.split()
+        else:
+            # a single word longer than the budget: cut it by characters
+            step = max(1, len(text) * max_tokens // n_tokens)
+            parts = [text[i : i + step] for i in range(0, len(text), step)]
+            return [
+                (separator if i == 0 else "", part, self.count_tokens(part))
+                for i, part in enumerate(parts)
+            ]
+
+        units = []
+        for i, part in enumerate(p for p in parts if p.strip()):
+            units.extend(
+                self._split_into_units(
+                    part, separator if i == 0 else " ", max_tokens, level + 1
+                )
+            )
+        return units
+
+    def _merge_units(self, units: List[Unit], max_tokens: int) -> List[str]:
+        chunks = []
+        current: List[Unit] = []
+        current_tokens = 0
+        for unit in units:
+            # one more token for the separator
+            unit_tokens = unit[2] + 1
+            if current and current_tokens + unit_tokens > max_tokens:
+                chunks.append(self._join(current))
+                current = self._get_overlap(current, max_tokens - unit_tokens)
+                current_tokens = sum(u[2] + 1 for u in current)
+            current.append(unit)
+            current_tokens += unit_tokens
+        chunks.append(self._join(current))
+        return chunks
+
+    def _get_overlap(self, units: List[Unit], available_tokens: int) -> List[Unit]:
+        budget = min(self.overlap_tokens, available_tokens)
+        overlap = []
+        overlap_tokens = 0
+        for unit in reversed(units):
+            if overlap_tokens + unit[2] + 1 > budget:
+                break
+            overlap.append(unit)
+            overlap_tokens += unit[2] + 1
+        return overlap[::-1]
+
+    @staticmethod
+    def _join(units: List[Unit]) -> str:
+        return units[0][1] + "".join(sep + text for sep, text, _ in units[1:])
@@ -1,109 +1,222 @@
 from dataclasses import dataclass
-from typing import List
+from functools import cached_property
+from typing import Iterable, Iterator, List, Optional, Sequence
 import os
-from uuid import uuid4
-from llama_index.core.schema import TextNode
+from uuid import UUID, uuid5
+from llama_index.core.schema import MetadataMode, TextNode
 from llama_index.core.postprocessor import MetadataReplacementPostProcessor
 
 from loguru import logger
 
-from utils import load_json
+from schema import OpenAISupportedModels
+from utils import hash_text
+from .article_store import load_article_store
+from .chunking import TokenChunker, get_max_tokens, get_token_counter
 from .preprocess_legifrance_data import get_code_articles
 from .constants import path_dir_data
-from .window_nodes import add_window_nodes
+from .window_nodes import WindowReconstructionPostProcessor, iter_window_nodes
+
+PAYLOAD_HASH_METADATA_KEY = "payload_hash"
+CODE_NAME_METADATA_KEY = "Nom du code"
+NODE_ID_NAMESPACE = UUID("5b0e3c1e-8f2a-4c55-9a61-2f0c1d3e7b44")
+# room left in the token budget of a node for the separators of its metadata and
+# the chunk suffix of its id
+METADATA_TOKENS_MARGIN = 16
+MIN_CHUNK_TOKENS = 16
+
+
+def make_node_id(code_name: str, article_id: str, content: str) -> str:
+    """Deterministic node id, stable across runs as long as the article is unchanged.
+
+    `article_id` is the article number, suffixed with the chunk index for
+    articles split into several chunks.
+    """
+    return str(
+        uuid5(NODE_ID_NAMESPACE, f"{code_name}|{article_id}|{hash_text(content)}")
+    )
+
+
+def set_payload_hash(node: TextNode) -> None:
+    """Store a hash of everything the vector store keeps for this node (text and
+    metadata), so that stored points can be compared with freshly built nodes."""
+    node.metadata.pop(PAYLOAD_HASH_METADATA_KEY, None)
+    node.metadata[PAYLOAD_HASH_METADATA_KEY] = hash_text(
+        node.get_content(metadata_mode=MetadataMode.ALL)
+    )
+    for excluded_keys in [
+        node.excluded_embed_metadata_keys,
+        node.excluded_llm_metadata_keys,
+    ]:
+        if PAYLOAD_HASH_METADATA_KEY not in excluded_keys:
+            excluded_keys.append(PAYLOAD_HASH_METADATA_KEY)
 
 
 @dataclass
 class CodeNodes:
+    """
+    Articles of a code and the text nodes built from them.
+
+    `articles` and `nodes` are only built when first accessed; `iter_articles`
+    and `iter_nodes` produce the same articles and nodes one at a time, for
+    callers that do not need the whole code in memory.
+    """
+
     code_name: str
     use_window_nodes: bool
     nodes_window_size: int = 3
-    max_words_per_node: int = 2000
+    embedding_model_name: str = OpenAISupportedModels.ADA.value
+    max_tokens_per_node: Optional[int] = None
+    chunk_overlap_tokens: int = 0
     reload_data: bool = False
+    query_time_window: bool = False
     _n_truncated_articles: int = 0
 
     def __post_init__(self):
-        self.articles = self.try_load_data()
-        self.nodes = self.create_nodes(self.articles)
         code_name_no_spaces = self.code_name.replace(" ", "_")
         self.nodes_config = f"{code_name_no_spaces}_base"
         self.post_processors = []
-        if self.use_window_nodes:
-            logger.info("Adding window nodes ...")
-            self.nodes = add_window_nodes(self.nodes, self.nodes_window_size)
+        if self.use_window_nodes and self.query_time_window:
+            # nodes are indexed like base nodes, windows are rebuilt at query time
+            self.post_processors.append(
+                WindowReconstructionPostProcessor(
+                    windows_key=f"{code_name_no_spaces}_{self.chunking_config}",
+                    load_nodes=self.iter_nodes,
+                    window_size=self.nodes_window_size,
+                )
+            )
+        elif self.use_window_nodes:
             self.nodes_config = f"{code_name_no_spaces}_window"
             self.post_processors.append(
                 MetadataReplacementPostProcessor(target_metadata_key="window")
             )
 
-    def create_nodes(self, list_articles: List[dict]):
-        nodes = [
-            TextNode(
-                text=article["content"],
-                id_=str(uuid4()),
-                metadata=self._parse_metadata(article),
+    @property
+    def chunking_config(self) -> str:
+        return (
+            f"{self.embedding_model_name.replace('/', '_')}"
+            f"_{self.max_tokens}_{self.chunk_overlap_tokens}"
+        )
+
+    @property
+    def max_tokens(self) -> int:
+        # not read from the chunker, whose tokenizer is only loaded for chunking
+        return self.max_tokens_per_node or get_max_tokens(self.embedding_model_name)
+
+    @cached_property
+    def chunker(self) -> TokenChunker:
+        """Chunker bounding the embedded text of each node (metadata included) by
+        `max_tokens_per_node`, by default the input limit of the embedding model."""
+        return TokenChunker(
+            count_tokens=get_token_counter(self.embedding_model_name),
+            max_tokens=self.max_tokens,
+            overlap_tokens=self.chunk_overlap_tokens,
+        )
+
+    @property
+    def stores_windows(self) -> bool:
+        return self.use_window_nodes and not self.query_time_window
+
+    @cached_property
+    def articles(self) -> List[dict]:
+        return self.try_load_data()
+
+    @cached_property
+    def nodes(self) -> List[TextNode]:
+        if self.stores_windows:
+            logger.info("Adding window nodes ...")
+        return list(self.iter_nodes(self.articles))
+
+    def iter_nodes(
+        self, articles: Optional[Iterable[dict]] = None
+    ) -> Iterator[TextNode]:
+        """Yield the final nodes (window metadata and payload hash included) of
+        `articles`, by default of every article of the code."""
+        if articles is None:
+            articles = self.iter_articles()
+        self._n_truncated_articles = 0
+        nodes = (self.create_node(article) for article in articles)
+        if self.stores_windows:
+            nodes = iter_window_nodes(nodes, self.nodes_window_size)
+        for node in nodes:
+            set_payload_hash(node)
+            yield node
+        if self._n_truncated_articles:
+            logger.info(
+                f"Truncated {self._n_truncated_articles} articles into smaller chunks."
             )
-            for article in list_articles
-        ]
+
+    def create_node(self, article: dict) -> TextNode:
+        return TextNode(
+            text=article["content"],
+            id_=make_node_id(self.code_name, article["id"], article["content"]),
+            metadata=self._parse_metadata(article),
+        )
+
+    def create_nodes(self, list_articles: List[dict]):
+        nodes = [self.create_node(article) for article in list_articles]
 
         return nodes
 
-    def try_load_data(self) -> List[dict]:
-        path = os.path.join(path_dir_data, f"{self.code_name}.json")
+    def load_raw_articles(self) -> Sequence[dict]:
         if self.reload_data:
-            code_articles = get_code_articles(code_name=self.code_name)
-        else:
-            try:
-                code_articles = load_json(path=path)
-            except FileNotFoundError:
-                logger.warning(
-                    f"File not found at path {path}. Fetching data from Legifrance."
-                )
-                code_articles = get_code_articles(code_name=self.code_name)
+            return get_code_articles(code_name=self.code_name)
+        try:
+            return load_article_store(self.code_name)
+        except FileNotFoundError:
+            path = os.path.join(path_dir_data, f"{self.code_name}.json")
+            logger.warning(
+                f"File not found at path {path}. Fetching data from Legifrance."
+            )
+            return get_code_articles(code_name=self.code_name)
 
-        truncated_articles = self._chunk_long_articles(code_articles)
+    def try_load_data(self) -> List[dict]:
+        truncated_articles = self._chunk_long_articles(self.load_raw_articles())
         return truncated_articles
 
+    def iter_articles(self) -> Iterator[dict]:
+        """Yield the articles of the code, long articles being split into chunks."""
+        for article in self.load_raw_articles():
+            yield from self._chunk_article(article)
+
     def _parse_metadata(self, article: dict) -> dict:
         metadata = {k: v for k, v in article.items() if k not in ["content", "num"]}
         metadata = {
-            "Nom du code": self.code_name,
+            CODE_NAME_METADATA_KEY: self.code_name,
             **metadata,
             "Article numero": article["num"],
         }
         return metadata
 
-    def _chunk_one_article(self, content: str) -> List[str]:
-        words = content.split()
-        chunks = []
-        chunk = ""
-        for word in words:
-            if len(chunk) + len(word) > self.max_words_per_node:
-                chunks.append(chunk)
-                chunk = ""
-            chunk += word + " "
-        chunks.append(chunk)
-        return chunks
+    def _chunk_article(self, article: dict) -> List[dict]:
+        metadata_str = "\n".join(
+            f"{k}: {v}" for k, v in self._parse_metadata(article).items()
+        )
+        content_budget = max(
+            MIN_CHUNK_TOKENS,
+            self.chunker.max_tokens
+            - self.chunker.count_tokens(metadata_str)
+            - METADATA_TOKENS_MARGIN,
+        )
+        if self.chunker.count_tokens(article["content"]) <= content_budget:
+            article["id"] = article["num"]
+            return [article]
+
+        self._n_truncated_articles += 1
+        chunks = self.chunker.split(article["content"], max_tokens=content_budget)
+        return [
+            {
+                "content": chunk,
+                "id": article["num"] + f"_chunk_{i}",
+                **{k: v for k, v in article.items() if k != "content"},
+            }
+            for i, chunk in enumerate(chunks)
+        ]
 
     def _chunk_long_articles(self, articles: List[dict]) -> List[dict]:
+        self._n_truncated_articles = 0
         truncated_articles = []
         for article in articles:
-            words = article["content"].split()
-            if len(words) > self.max_words_per_node:
-                self._n_truncated_articles += 1
-                chunks = self._chunk_one_article(article["content"])
-                for i, chunk in enumerate(chunks):
-                    truncated_articles.append(
-                        {
-                            "content": chunk,
-                            "id": article["num"] + f"_chunk_{i}",
-                            **{k: v for k, v in article.items() if k != "content"},
-                        }
-                    )
-
-            else:
-                article["id"] = article["num"]
-                truncated_articles.append(article)
+            truncated_articles.extend(self._chunk_article(article))
         logger.info(
             f"Truncated {self._n_truncated_articles} articles into smaller chunks."
         )
@@ -1,6 +1,10 @@
+import argparse
+import random
 import re
 import os
-from typing import List
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, List
 
 from pylegifrance import recherche_CODE, LegiHandler
 from loguru import logger
@@ -63,18 +67,29 @@ def parse_row(row: dict) -> dict:
     }
 
 
-def get_code_articles(
-    code_name: str = "Code civil", save_rows: bool = True
-) -> List[dict]:
+def set_legifrance_api_keys():
     client = LegiHandler()
     client.set_api_keys(
         legifrance_api_key=os.getenv("LEGIFRANCE_API_KEY"),
         legifrance_api_secret=os.getenv("LEGIFRANCE_API_SECRET"),
     )
-    dict_code = recherche_CODE(code_name, champ="ALL")[0]
+
+
+def fetch_code_articles(
+    code_name: str, search_code: Callable = recherche_CODE
+) -> List[dict]:
+    dict_code = search_code(code_name, champ="ALL")[0]
     articles = get_all_articles(dict_code=dict_code)
     preprocessed_articles = list(map(parse_row, articles))
     no_duplicates_rows = list({r["num"]: r for r in preprocessed_articles}.values())
+    return no_duplicates_rows
+
+
+def get_code_articles(
+    code_name: str = "Code civil", save_rows: bool = True
+) -> List[dict]:
+    set_legifrance_api_keys()
+    no_duplicates_rows = fetch_code_articles(code_name)
 
     os.makedirs(path_dir_data, exist_ok=True)
 
@@ -82,3 +97,133 @@ def get_code_articles(
     if save_rows:
         save_json(no_duplicates_rows, path_data)
     return no_duplicates_rows
+
+
+def fetch_code_with_retry(
+    code_name: str,
+    search_code: Callable = recherche_CODE,
+    max_retries: int = 3,
+    backoff_seconds: float = 2.0,
+) -> List[dict]:
+    """Fetch a code, retrying with jittered exponential backoff on any error."""
+    for attempt in range(max_retries + 1):
+        try:
+            return fetch_code_articles(code_name, search_code=search_code)
+        except Exception as exc:
+            if attempt == max_retries:
+                raise
+            delay = backoff_seconds * 2**attempt * random.uniform(0.5, 1.5)
+            logger.warning(
+                f"Fetching {code_name} failed ({exc!r}), retrying in {delay:.1f}s "
+                f"({attempt + 1}/{max_retries})."
+            )
+            time.sleep(delay)
+
+
+def fetch_codes(
+    code_names: List[str],
+    max_workers: int = 3,
+    max_retries: int = 3,
+    backoff_seconds: float = 2.0,
+    overwrite: bool = False,
+    search_code: Callable = recherche_CODE,
+    dir_data: str = path_dir_data,
+) -> Dict[str, float]:
+    """
+    Fetch several codes concurrently and save each one to `dir_data` as soon as it
+    is complete.
+
+    Codes whose file already exists are skipped unless `overwrite` is True, so
+    running the function again after a failure only fetches the missing codes.
+
+    Parameters
+    ----------
+    code_names : List[str]
+        The names of the codes to fetch, e.g. "Code civil".
+    max_workers : int, optional
+        Maximum number of codes fetched at the same time, by default 3.
+    max_retries : int, optional
+        Number of retries per code, by default 3.
+    backoff_seconds : float, optional
+        Base delay of the exponential backoff between retries, by default 2.0.
+    overwrite : bool, optional
+        Whether to fetch again codes that are already saved, by default False.
+    search_code : Callable, optional
+        Function returning the Legifrance search results of a code, by default
+        `pylegifrance.recherche_CODE`.
+    dir_data : str, optional
+        Directory where the codes are saved, by default `./data/legifrance`.
+
+    Returns
+    -------
+    Dict[str, float]
+        The wall-clock fetch time in seconds of each fetched code.
+    """
+    os.makedirs(dir_data, exist_ok=True)
+    to_fetch = []
+    for code_name in code_names:
+        if not overwrite and os.path.exists(
+            os.path.join(dir_data, f"{code_name}.json")
+        ):
+            logger.info(f"{code_name} already saved in {dir_data}, skipping.")
+        else:
+            to_fetch.append(code_name)
+    if not to_fetch:
+        return {}
+
+    if search_code is recherche_CODE:
+        set_legifrance_api_keys()
+
+    def fetch_and_save(code_name: str) -> float:
+        start = time.perf_counter()
+        rows = fetch_code_with_retry(
+            code_name,
+            search_code=search_code,
+            max_retries=max_retries,
+            backoff_seconds=backoff_seconds,
+        )
+        save_json(rows, os.path.join(dir_data, f"{code_name}.json"))
+        return time.perf_counter() - start
+
+    code_to_seconds = {}
+    failed_codes = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(fetch_and_save, code_name): code_name
+            for code_name in to_fetch
+        }
+        for future in as_completed(futures):
+            code_name = futures[future]
+            try:
+                code_to_seconds[code_name] = future.result()
+                logger.info(
+                    f"Fetched {code_name} in {code_to_seconds[code_name]:.1f}s."
+                )
+            except Exception as exc:
+                failed_codes.append(code_name)
+                logger.error(f"Failed to fetch {code_name}: {exc!r}")
+
+    if failed_codes:
+        raise RuntimeError(
+            f"Failed to fetch {failed_codes}. Fetched codes were saved, run again to "
+            "resume."
+        )
+    return code_to_seconds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Fetch law codes from Legifrance into ./data/legifrance."
+    )
+    parser.add_argument("codes", nargs="+", help='Code names, e.g. "Code civil".')
+    parser.add_argument("--max-workers", type=int, default=3)
+    parser.add_argument("--max-retries", type=int, default=3)
+    parser.add_argument("--overwrite", action="store_true")
+    args = parser.parse_args()
+
+    fetch_codes(
+        args.codes,
+        max_workers=args.max_workers,
+        max_retries=args.max_retries,
+        overwrite=args.overwrite,
+    )
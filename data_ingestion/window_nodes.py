@@ -1,5 +1,9 @@
-from typing import List
-from llama_index.core.schema import TextNode
+from collections import deque
+from threading import Lock
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import NodeWithScore, QueryBundle, TextNode
 from tqdm import tqdm
 
 from .constants import possible_headers
@@ -8,17 +12,27 @@ WINDOW_METADATA_KEY = "window"
 ORIGINAL_TEXT_METADATA_KEY = "original_text"
 
 
-def add_window_nodes(nodes: List[TextNode], window_size: int = 3):
-    """ """
-    for i, node in tqdm(
-        enumerate(nodes), total=len(nodes), desc="Adding window nodes ..."
-    ):
-        window_nodes = nodes[
-            max(0, i - window_size) : min(i + window_size + 1, len(nodes))
-        ]
+def iter_window_nodes(
+    nodes: Iterable[TextNode], window_size: int = 3
+) -> Iterator[TextNode]:
+    """
+    Add to each node the text of its `window_size` neighbours on each side.
+
+    Nodes are yielded as soon as their right neighbours are known, so at most
+    `2 * window_size + 1` nodes are held at a time.
+    """
+    # (node, llm content before any window metadata was added)
+    buffer = deque()
+    buffer_start = 0  # position of buffer[0] in the stream of nodes
+    next_to_yield = 0
+
+    def finalize(position: int, last_position: int) -> TextNode:
+        start = max(0, position - window_size) - buffer_start
+        end = min(position + window_size, last_position) + 1 - buffer_start
+        node = buffer[position - buffer_start][0]
 
         node.metadata[WINDOW_METADATA_KEY] = "\n".join(
-            [n.get_content("llm") for n in window_nodes]
+            buffer[i][1] for i in range(start, end)
         )
         node.metadata[ORIGINAL_TEXT_METADATA_KEY] = node.text
 
@@ -27,14 +41,126 @@ def add_window_nodes(nodes: List[TextNode], window_size: int = 3):
             [WINDOW_METADATA_KEY, ORIGINAL_TEXT_METADATA_KEY]
         )
 
+        # since articles metadata (like title, chapter, etc ...) will be incorporated in WINDOW_METADATA_KEY,
+        # we can exclude them from the llm metadata.
         node.excluded_llm_metadata_keys.extend(
-            [WINDOW_METADATA_KEY, ORIGINAL_TEXT_METADATA_KEY]
+            [WINDOW_METADATA_KEY, ORIGINAL_TEXT_METADATA_KEY, *possible_headers]
         )
+        return node
+
+    position = -1
+    for position, node in enumerate(nodes):
+        buffer.append((node, node.get_content("llm")))
+        while next_to_yield + window_size <= position:
+            yield finalize(next_to_yield, position)
+            next_to_yield += 1
+            while buffer_start < next_to_yield - window_size:
+                buffer.popleft()
+                buffer_start += 1
+
+    while next_to_yield <= position:
+        yield finalize(next_to_yield, position)
+        next_to_yield += 1
+
+
+def add_window_nodes(nodes: List[TextNode], window_size: int = 3):
+    """ """
+    return list(
+        tqdm(
+            iter_window_nodes(nodes, window_size),
+            total=len(nodes),
+            desc="Adding window nodes ...",
+        )
+    )
+
+
+class ArticleWindows:
+    """
+    The llm content of every node of a code, in code order, used to rebuild the
+    window of a node at query time instead of storing it in the node metadata.
+    """
+
+    def __init__(self, nodes: Iterable[TextNode]):
+        self.node_ids: List[str] = []
+        self.contents: List[str] = []
+        for node in nodes:
+            self.node_ids.append(node.node_id)
+            self.contents.append(node.get_content("llm"))
+        self.node_id_to_position = {
+            node_id: position for position, node_id in enumerate(self.node_ids)
+        }
+
+    def get_window(self, node_id: str, window_size: int) -> Optional[str]:
+        position = self.node_id_to_position.get(node_id)
+        if position is None:
+            return None
+        return "\n".join(
+            self.contents[max(0, position - window_size) : position + window_size + 1]
+        )
+
+
+# shared by all the query engines of the process
+_article_windows: Dict[str, ArticleWindows] = {}
+_article_windows_lock = Lock()
+
+
+def get_article_windows(
+    key: str, load_nodes: Callable[[], Iterable[TextNode]]
+) -> ArticleWindows:
+    with _article_windows_lock:
+        if key not in _article_windows:
+            _article_windows[key] = ArticleWindows(load_nodes())
+        return _article_windows[key]
+
+
+class WindowReconstructionPostProcessor(BaseNodePostprocessor):
+    """
+    Replace the content of each retrieved node with its window, rebuilt from the
+    shared `ArticleWindows` of the code. Replaces `MetadataReplacementPostProcessor`
+    for nodes indexed without window metadata, so the window size can be chosen
+    at query time.
+    """
+
+    window_size: int = Field(
+        default=3, description="Number of neighbouring nodes on each side."
+    )
+    windows_key: str = Field(description="Key of the code in the shared windows.")
+
+    _load_nodes: Callable[[], Iterable[TextNode]] = PrivateAttr()
 
-    # since articles metadata (like title, chapter, etc ...) will be incorporated in WINDOW_METADATA_KEY,
-    # we can exclude them from the llm metadata.
+    def __init__(
+        self,
+        windows_key: str,
+        load_nodes: Callable[[], Iterable[TextNode]],
+        window_size: int = 3,
+    ) -> None:
+        super().__init__(windows_key=windows_key, window_size=window_size)
+        self._load_nodes = load_nodes
 
-    for node in nodes:
-        node.excluded_llm_metadata_keys.extend(possible_headers)
+    @classmethod
+    def class_name(cls) -> str:
+        return "WindowReconstructionPostProcessor"
 
-    return nodes
+    def _postprocess_nodes(
+        self,
+        nodes: List[NodeWithScore],
+        query_bundle: Optional[QueryBundle] = None,
+    ) -> List[NodeWithScore]:
+        article_windows = get_article_windows(self.windows_key, self._load_nodes)
+        new_nodes = []
+        for n in nodes:
+            window = article_windows.get_window(n.node.node_id, self.window_size)
+            if window is None:
+                new_nodes.append(n)
+                continue
+            # the retrieved nodes can be shared, by the docstore or a cache
+            node = n.node.copy()
+            node.set_content(window)
+            # as for stored windows, the headers are already part of the window
+            node.excluded_llm_metadata_keys = node.excluded_llm_metadata_keys + [
+                key
+                for key in possible_headers
+                if key not in node.excluded_llm_metadata_keys
+            ]
+            new_nodes.append(NodeWithScore(node=node, score=n.score))
+        return new_nodes
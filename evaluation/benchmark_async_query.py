@@ -0,0 +1,114 @@
+"""
+Compare the latency of the synchronous and asynchronous query rewrite engines.
+
+The embedding and LLM providers are replaced by the stubs of `stub_providers`, with a
+configurable latency, and the nodes are indexed in in-memory Qdrant collections, so
+the benchmark runs offline and only measures how the calls are scheduled.
+
+    python -m evaluation.benchmark_async_query --embedding-latency 0.1 --llm-latency 0.5
+"""
+
+import argparse
+import asyncio
+import time
+from typing import Callable, List
+
+import numpy as np
+from llama_index.core import Settings, VectorStoreIndex
+from llama_index.vector_stores.qdrant import QdrantVectorStore
+from loguru import logger
+from qdrant_client import AsyncQdrantClient, QdrantClient
+
+from data_ingestion.nodes_processing import CodeNodes
+from evaluation.eval_with_llamaindex import PATH_EVAL_CODE_CIVIL
+from evaluation.stub_providers import HashingEmbedding, StubLLM
+from query.query_engine import get_query_fusion_retrieval
+from utils import load_json
+
+
+def build_index(code_name: str, embed_model: HashingEmbedding) -> VectorStoreIndex:
+    nodes = CodeNodes(code_name=code_name, use_window_nodes=False).nodes
+    embeddings = embed_model.get_text_embedding_batch(
+        [node.get_content(metadata_mode="embed") for node in nodes]
+    )
+    for node, embedding in zip(nodes, embeddings):
+        node.embedding = embedding
+
+    # in-memory clients do not share their data, so the nodes are added to both
+    vector_store = QdrantVectorStore(
+        collection_name="benchmark",
+        client=QdrantClient(":memory:"),
+        aclient=AsyncQdrantClient(":memory:"),
+    )
+    vector_store.add(nodes)
+    asyncio.run(vector_store.async_add(nodes))
+    return VectorStoreIndex.from_vector_store(vector_store, embed_model=embed_model)
+
+
+def log_latencies(name: str, latencies: List[float]):
+    logger.info(
+        f"{name}: mean {np.mean(latencies):.3f}s, "
+        f"p50 {np.percentile(latencies, 50):.3f}s, "
+        f"p95 {np.percentile(latencies, 95):.3f}s over {len(latencies)} queries."
+    )
+
+
+def time_queries(questions: List[str], query: Callable[[str], object]) -> List[float]:
+    latencies = []
+    for question in questions:
+        start = time.perf_counter()
+        query(question)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+async def atime_queries(questions: List[str], query_engine) -> List[float]:
+    latencies = []
+    for question in questions:
+        start = time.perf_counter()
+        await query_engine.aquery(question)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def run_benchmark(
+    code_name: str = "Code civil",
+    n_queries: int = 10,
+    num_generated_questions: int = 4,
+    embedding_latency: float = 0.1,
+    llm_latency: float = 0.5,
+):
+    embed_model = HashingEmbedding()
+    index = build_index(code_name, embed_model)
+    embed_model.latency = embedding_latency
+    Settings.llm = StubLLM(latency=llm_latency, n_lines=num_generated_questions)
+    Settings.embed_model = embed_model
+
+    questions = load_json(PATH_EVAL_CODE_CIVIL)[:n_queries]
+    kwargs = {
+        "index": index,
+        "postprocessors_list": [],
+        "num_generated_questions": num_generated_questions,
+    }
+    sync_engine = get_query_fusion_retrieval(**kwargs)
+    async_engine = get_query_fusion_retrieval(**kwargs, use_async=True)
+
+    log_latencies("Sync engine", time_queries(questions, sync_engine.query))
+    log_latencies("Async engine", asyncio.run(atime_queries(questions, async_engine)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--code-name", default="Code civil")
+    parser.add_argument("--n-queries", type=int, default=10)
+    parser.add_argument("--num-generated-questions", type=int, default=4)
+    parser.add_argument("--embedding-latency", type=float, default=0.1)
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    args = parser.parse_args()
+    run_benchmark(
+        code_name=args.code_name,
+        n_queries=args.n_queries,
+        num_generated_questions=args.num_generated_questions,
+        embedding_latency=args.embedding_latency,
+        llm_latency=args.llm_latency,
+    )
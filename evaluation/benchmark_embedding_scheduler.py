@@ -0,0 +1,128 @@
+"""
+Embed the nodes of a code through the embedding scheduler, against a local fake
+provider with rate limits, latency and transient errors.
+
+The fake provider is the `RateLimitedEmbedding` of `stub_providers`, so the benchmark
+runs offline. Its limits are per `window` seconds, shorter than a minute so that a
+run hits them quickly; the scheduler gets the same budgets per minute, scaled by
+`budget_fraction`. The naive batching of llama-index, without scheduling, is run
+first for comparison: it fails at the first error of the provider.
+
+    python -m evaluation.benchmark_embedding_scheduler --requests-per-window 50 \
+        --tokens-per-window 100000 --window 10 --error-rate 0.05
+"""
+
+import argparse
+import time
+from typing import Optional
+
+from loguru import logger
+
+from data_ingestion.chunking import estimate_tokens
+from data_ingestion.nodes_processing import CodeNodes
+from evaluation.stub_providers import RateLimitedEmbedding
+from retriever.embedding_scheduler import EmbeddingRateLimits, EmbeddingScheduler
+
+
+def run_benchmark(
+    code_name: str = "Code civil",
+    requests_per_window: Optional[int] = 50,
+    tokens_per_window: Optional[int] = 100_000,
+    window: float = 10.0,
+    max_batch_tokens: Optional[int] = 4096,
+    latency: float = 0.2,
+    latency_per_1k_tokens: float = 0.01,
+    error_rate: float = 0.05,
+    max_concurrency: int = 4,
+    budget_fraction: float = 0.85,
+    naive_batch_size: int = 10,
+):
+    texts = [
+        node.get_content(metadata_mode="embed")
+        for node in CodeNodes(code_name=code_name, use_window_nodes=False).nodes
+    ]
+    n_tokens = sum(estimate_tokens(text) for text in texts)
+    logger.info(f"{len(texts)} texts, {n_tokens} tokens to embed.")
+
+    def get_provider() -> RateLimitedEmbedding:
+        return RateLimitedEmbedding(
+            requests_per_window=requests_per_window,
+            tokens_per_window=tokens_per_window,
+            window=window,
+            max_batch_tokens=max_batch_tokens,
+            latency=latency,
+            latency_per_1k_tokens=latency_per_1k_tokens,
+            error_rate=error_rate,
+        )
+
+    provider = get_provider()
+    provider.embed_batch_size = naive_batch_size
+    start = time.perf_counter()
+    try:
+        provider.get_text_embedding_batch(texts)
+        logger.info(f"Naive batching: done in {time.perf_counter() - start:.1f} s.")
+    except Exception as exc:
+        logger.info(
+            f"Naive batching: failed after {time.perf_counter() - start:.1f} s "
+            f"({exc!r})."
+        )
+
+    per_minute = 60 / window * budget_fraction
+    limits = EmbeddingRateLimits(
+        requests_per_minute=requests_per_window and requests_per_window * per_minute,
+        tokens_per_minute=tokens_per_window and tokens_per_window * per_minute,
+        max_concurrency=max_concurrency,
+        # larger than the provider's one, which the scheduler has to find out
+        max_batch_tokens=max_batch_tokens and 2 * max_batch_tokens,
+        initial_backoff=0.5,
+    )
+    scheduler = EmbeddingScheduler(
+        get_provider(), limits, count_tokens=estimate_tokens, progress_interval=5.0
+    )
+    embeddings = scheduler.embed(texts)
+    stats = scheduler.last_stats
+    assert len(embeddings) == len(texts) and all(embeddings)
+    logger.info(f"Scheduled: {stats.describe()}.")
+    if tokens_per_window:
+        logger.info(
+            f"Tokens quota usage: "
+            f"{stats.tokens_per_minute / (tokens_per_window * 60 / window):.0%}."
+        )
+    if requests_per_window:
+        logger.info(
+            f"Requests quota usage: "
+            f"{stats.requests_per_minute / (requests_per_window * 60 / window):.0%}."
+        )
+
+
+def parse_optional_int(value: str) -> Optional[int]:
+    return None if value.lower() == "none" else int(value)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--code-name", default="Code civil")
+    parser.add_argument("--requests-per-window", type=parse_optional_int, default=50)
+    parser.add_argument("--tokens-per-window", type=parse_optional_int, default=100_000)
+    parser.add_argument("--window", type=float, default=10.0)
+    parser.add_argument("--max-batch-tokens", type=parse_optional_int, default=4096)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--latency-per-1k-tokens", type=float, default=0.01)
+    parser.add_argument("--error-rate", type=float, default=0.05)
+    parser.add_argument("--max-concurrency", type=int, default=4)
+    parser.add_argument("--budget-fraction", type=float, default=0.85)
+    parser.add_argument("--naive-batch-size", type=int, default=10)
+    args = parser.parse_args()
+    run_benchmark(
+        code_name=args.code_name,
+        requests_per_window=args.requests_per_window,
+        tokens_per_window=args.tokens_per_window,
+        window=args.window,
+        max_batch_tokens=args.max_batch_tokens,
+        latency=args.latency,
+        latency_per_1k_tokens=args.latency_per_1k_tokens,
+        error_rate=args.error_rate,
+        max_concurrency=args.max_concurrency,
+        budget_fraction=args.budget_fraction,
+        naive_batch_size=args.naive_batch_size,
+    )
@@ -0,0 +1,76 @@
+"""
+Measure how the FastEmbed embedding of the nodes of a code scales with the number of
+worker processes.
+
+Every number of workers gets its own pool, started and warmed up before the
+measure and shut down after it, so only the embedding throughput is compared. The
+model is downloaded to `./data/fastembed_cache` on the first run.
+
+    python -m evaluation.benchmark_fastembed_pool --n-workers 1 2 4 8 16
+"""
+
+import argparse
+import time
+from typing import List
+
+from loguru import logger
+
+from data_ingestion.nodes_processing import CodeNodes
+from retriever.fastembed_pool import (
+    DEFAULT_QUERY_THREADS,
+    ParallelFastEmbedEmbedding,
+    shutdown_fastembed_pools,
+)
+
+
+def run_benchmark(
+    code_name: str = "Code civil",
+    embedding_model: str = "intfloat/multilingual-e5-large",
+    n_workers_list: List[int] = [1, 2, 4],
+    batch_size: int = 64,
+    query_threads: int = DEFAULT_QUERY_THREADS,
+):
+    texts = [
+        node.get_content(metadata_mode="embed")
+        for node in CodeNodes(
+            code_name=code_name,
+            use_window_nodes=False,
+            embedding_model_name=embedding_model,
+        ).nodes
+    ]
+    baseline = None
+    for n_workers in n_workers_list:
+        embed_model = ParallelFastEmbedEmbedding(
+            model_name=embedding_model,
+            n_workers=n_workers,
+            batch_size=batch_size,
+            query_threads=query_threads,
+        )
+        # one shard per worker, which loads the model
+        embed_model._get_text_embeddings(texts[: batch_size * n_workers])
+        start = time.perf_counter()
+        embed_model._get_text_embeddings(texts)
+        texts_per_second = len(texts) / (time.perf_counter() - start)
+        shutdown_fastembed_pools()
+        baseline = baseline or (n_workers_list[0], texts_per_second)
+        logger.info(
+            f"{n_workers} workers: {texts_per_second:.1f} texts/s, speedup "
+            f"{texts_per_second / baseline[1]:.2f} over {baseline[0]} workers."
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--code-name", default="Code civil")
+    parser.add_argument("--embedding-model", default="intfloat/multilingual-e5-large")
+    parser.add_argument("--n-workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--query-threads", type=int, default=DEFAULT_QUERY_THREADS)
+    args = parser.parse_args()
+    run_benchmark(
+        code_name=args.code_name,
+        embedding_model=args.embedding_model,
+        n_workers_list=args.n_workers,
+        batch_size=args.batch_size,
+        query_threads=args.query_threads,
+    )
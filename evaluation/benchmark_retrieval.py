@@ -0,0 +1,364 @@
+"""
+Retrieval-only benchmark of query engine configurations: recall@k and MRR of the
+expected articles, retrieval latency percentiles and throughput, without any LLM call.
+
+The labelled questions are (question, expected article numbers) pairs, read from a
+JSON file of `{"question": ..., "articles": [...]}` objects. When the file is missing,
+known-item questions are generated from the code, each one being a span of words of
+an article labelled with the number of this article, and saved so that the following
+runs use the same questions.
+
+Every combination of the swept options is benchmarked and appended as one JSON line
+to the results file, with the memory of the vectors searched by every query and its
+reduction from the full-precision configuration with the same other options. With
+the `hashing-<dim>` embedding model and the numpy vector store backend, the benchmark
+runs offline and deterministically:
+
+    python -m evaluation.benchmark_retrieval --similarity-top-k 5 10 --hybrid-search false true
+    python -m evaluation.benchmark_retrieval --vector-quantization none int8 binary
+"""
+
+import argparse
+import itertools
+import json
+import os
+import random
+import subprocess
+import time
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from llama_index.core import Settings
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.schema import NodeWithScore
+from llama_index.core.vector_stores.types import VectorStore
+from loguru import logger
+from qdrant_client.http import models as rest
+
+from data_ingestion.article_store import load_article_store
+from evaluation.stub_providers import StubLLM
+from query.query_engine import create_query_engine
+from retriever.article_index import (
+    ARTICLE_NUMBER_METADATA_KEY,
+    normalize_article_number,
+)
+from retriever.numpy_vector_store import NumpyVectorStore
+from retriever.quantization import DENSE_VECTOR_NAME, get_code_nbytes
+from schema import VectorQuantization, VectorStoreBackend
+from utils import load_json, save_json
+
+PATH_RETRIEVAL_QUESTIONS = "./data/retrieval_benchmark/{code_name}_questions.json"
+PATH_RETRIEVAL_RESULTS = "./data/retrieval_benchmark/{code_name}_results.jsonl"
+DEFAULT_KS = (1, 3, 5, 10)
+# the options of `create_query_engine` swept by default
+DEFAULT_SWEEP = {
+    "embedding_model": ["hashing-256"],
+    "use_window_nodes": [False],
+    "hybrid_search": [False, True],
+    "similarity_top_k": [5],
+    "sparse_top_k": [0],
+    "hybrid_search_alpha": [0.5],
+    "embedding_dimensions": [None],
+    "vector_quantization": [VectorQuantization.NONE.value],
+    "rescore_oversampling": [2.0],
+}
+# the options changing the precision of the searched vectors
+PRECISION_OPTIONS = (
+    "embedding_dimensions",
+    "vector_quantization",
+    "rescore_oversampling",
+)
+
+
+@dataclass
+class LabelledQuestion:
+    question: str
+    articles: List[str]
+
+
+def generate_known_item_questions(
+    code_name: str, n_questions: int = 200, n_words: int = 12, seed: int = 0
+) -> List[LabelledQuestion]:
+    """
+    Questions made of `n_words` consecutive words of randomly drawn articles, labelled
+    with the number of their article. Only the articles of at least twice `n_words`
+    words are drawn, the shorter ones being mostly repeated formulas ("Abrogé").
+    """
+    articles = load_article_store(code_name)
+    rng = random.Random(seed)
+    positions = list(range(len(articles)))
+    rng.shuffle(positions)
+    questions = []
+    for position in positions:
+        words = articles.get_content(position).split()
+        if len(words) < 2 * n_words:
+            continue
+        start = rng.randrange(len(words) - n_words + 1)
+        questions.append(
+            LabelledQuestion(
+                question=" ".join(words[start : start + n_words]),
+                articles=[articles.get_num(position)],
+            )
+        )
+        if len(questions) == n_questions:
+            break
+    return questions
+
+
+def load_labelled_questions(
+    code_name: str, path: Optional[str] = None, n_questions: int = 200, seed: int = 0
+) -> List[LabelledQuestion]:
+    """The labelled questions of `path`, generated and saved there if missing."""
+    path = path or PATH_RETRIEVAL_QUESTIONS.format(code_name=code_name)
+    if os.path.exists(path):
+        return [LabelledQuestion(**question) for question in load_json(path)]
+
+    questions = generate_known_item_questions(code_name, n_questions, seed=seed)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    save_json([asdict(question) for question in questions], path)
+    logger.info(f"Saved {len(questions)} known-item questions to {path}.")
+    return questions
+
+
+def get_node_articles(nodes: Sequence[NodeWithScore]) -> List[str]:
+    """The article numbers of the retrieved nodes, in their order."""
+    return [
+        normalize_article_number(node.node.metadata[ARTICLE_NUMBER_METADATA_KEY])
+        for node in nodes
+    ]
+
+
+def compute_retrieval_metrics(
+    retrieved_articles: List[List[str]],
+    expected_articles: List[List[str]],
+    ks: Sequence[int] = DEFAULT_KS,
+) -> Dict[str, float]:
+    """
+    Mean recall@k of the expected articles in the first k retrieved nodes, and mean
+    reciprocal rank of the first node of an expected article (0 when none is).
+    """
+    recalls = {k: [] for k in ks}
+    reciprocal_ranks = []
+    for retrieved, expected in zip(retrieved_articles, expected_articles):
+        expected = {normalize_article_number(article) for article in expected}
+        for k in ks:
+            recalls[k].append(len(expected.intersection(retrieved[:k])) / len(expected))
+        rank = next(
+            (i + 1 for i, article in enumerate(retrieved) if article in expected), None
+        )
+        reciprocal_ranks.append(1 / rank if rank else 0.0)
+    metrics = {f"recall@{k}": float(np.mean(recalls[k])) for k in ks}
+    metrics["mrr"] = float(np.mean(reciprocal_ranks))
+    return metrics
+
+
+def compute_latency_metrics(latencies: List[float]) -> Dict[str, float]:
+    """Latency percentiles in milliseconds, and queries per second of the
+    sequential run."""
+    latencies_ms = 1000 * np.array(latencies)
+    metrics = {
+        f"latency_p{percentile}_ms": float(np.percentile(latencies_ms, percentile))
+        for percentile in (50, 95, 99)
+    }
+    metrics["latency_mean_ms"] = float(latencies_ms.mean())
+    metrics["qps"] = len(latencies) / float(np.sum(latencies))
+    return metrics
+
+
+def get_git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def is_full_precision(config: dict) -> bool:
+    return not config["embedding_dimensions"] and (
+        VectorQuantization(config["vector_quantization"]) == VectorQuantization.NONE
+    )
+
+
+def get_vector_store(retriever: BaseRetriever) -> VectorStore:
+    # the dense retriever of the BM25 hybrid retriever
+    retriever = getattr(retriever, "_dense_retriever", retriever)
+    return retriever._vector_store
+
+
+def get_searched_vectors_nbytes(vector_store: VectorStore) -> int:
+    """Bytes of the vectors searched by every query: their codes when quantized,
+    estimated from the collection configuration for Qdrant."""
+    if isinstance(vector_store, NumpyVectorStore):
+        return vector_store.scanned_nbytes
+    collection = vector_store.client.get_collection(vector_store.collection_name)
+    vector_params = collection.config.params.vectors
+    if isinstance(vector_params, dict):
+        vector_params = vector_params[DENSE_VECTOR_NAME]
+    quantization = {
+        rest.ScalarQuantization: VectorQuantization.INT8,
+        rest.BinaryQuantization: VectorQuantization.BINARY,
+    }.get(type(collection.config.quantization_config), VectorQuantization.NONE)
+    return collection.points_count * get_code_nbytes(vector_params.size, quantization)
+
+
+def get_retriever(code_name: str, **config) -> BaseRetriever:
+    # the engines are only used for their retriever, the article lookup answering
+    # without retrieval is disabled
+    query_engine = create_query_engine(
+        code_name=code_name, article_lookup=False, **config
+    )
+    return query_engine.retriever
+
+
+def benchmark_retriever(
+    retriever: BaseRetriever,
+    questions: List[LabelledQuestion],
+    ks: Sequence[int] = DEFAULT_KS,
+    n_warmup: int = 5,
+) -> Dict[str, float]:
+    """Retrieve the questions one after the other and measure the retrieval."""
+    for question in questions[:n_warmup]:
+        retriever.retrieve(question.question)
+
+    latencies, retrieved_articles = [], []
+    for question in questions:
+        start = time.perf_counter()
+        nodes = retriever.retrieve(question.question)
+        latencies.append(time.perf_counter() - start)
+        retrieved_articles.append(get_node_articles(nodes))
+
+    return {
+        **compute_retrieval_metrics(
+            retrieved_articles, [question.articles for question in questions], ks
+        ),
+        **compute_latency_metrics(latencies),
+    }
+
+
+def run_benchmark(
+    code_name: str = "Code civil",
+    sweep: Optional[Dict[str, list]] = None,
+    questions_path: Optional[str] = None,
+    results_path: Optional[str] = None,
+    n_questions: int = 200,
+    ks: Sequence[int] = DEFAULT_KS,
+    n_warmup: int = 5,
+    vector_store_backend: VectorStoreBackend = VectorStoreBackend.NUMPY,
+) -> List[dict]:
+    """
+    Benchmark every combination of the options of `sweep`, a mapping from options of
+    `create_query_engine` to their values, by default `DEFAULT_SWEEP`. The results
+    are appended to `results_path` and returned.
+    """
+    # building an engine resolves the LLM of its response synthesizer, never called
+    Settings.llm = StubLLM()
+    sweep = {**DEFAULT_SWEEP, **(sweep or {})}
+    questions = load_labelled_questions(code_name, questions_path, n_questions)
+    results_path = results_path or PATH_RETRIEVAL_RESULTS.format(code_name=code_name)
+    os.makedirs(os.path.dirname(results_path), exist_ok=True)
+
+    configs = [
+        dict(zip(sweep, values)) for values in itertools.product(*sweep.values())
+    ]
+    # the full-precision configurations first, to compare the others with them
+    configs.sort(key=is_full_precision, reverse=True)
+    full_precision_nbytes = {}
+
+    results = []
+    for config in configs:
+        retriever = get_retriever(
+            code_name, vector_store_backend=vector_store_backend, **config
+        )
+        top_k_ks = [k for k in ks if k <= config["similarity_top_k"]]
+        metrics = benchmark_retriever(retriever, questions, top_k_ks, n_warmup)
+
+        searched_nbytes = get_searched_vectors_nbytes(get_vector_store(retriever))
+        other_options = json.dumps(
+            {k: v for k, v in config.items() if k not in PRECISION_OPTIONS},
+            sort_keys=True,
+        )
+        if is_full_precision(config):
+            full_precision_nbytes[other_options] = searched_nbytes
+        metrics["searched_vectors_mb"] = searched_nbytes / 2**20
+        if full_precision_nbytes.get(other_options) and searched_nbytes:
+            metrics["memory_reduction"] = (
+                full_precision_nbytes[other_options] / searched_nbytes
+            )
+        result = {
+            "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "git_revision": get_git_revision(),
+            "code_name": code_name,
+            "vector_store_backend": VectorStoreBackend(vector_store_backend).value,
+            "n_questions": len(questions),
+            "config": config,
+            "metrics": metrics,
+        }
+        with open(results_path, "a") as f:
+            f.write(json.dumps(result, ensure_ascii=False) + "\n")
+        logger.info(
+            f"{config}: "
+            + ", ".join(f"{name} {value:.3f}" for name, value in metrics.items())
+        )
+        results.append(result)
+    logger.info(f"Results appended to {results_path}.")
+    return results
+
+
+def parse_bool(value: str) -> bool:
+    if value.lower() not in ("true", "false"):
+        raise argparse.ArgumentTypeError(f"Expected true or false, got {value}.")
+    return value.lower() == "true"
+
+
+def parse_optional_int(value: str) -> Optional[int]:
+    return None if value.lower() == "none" else int(value)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--code-name", default="Code civil")
+    parser.add_argument("--questions-path")
+    parser.add_argument("--results-path")
+    parser.add_argument("--n-questions", type=int, default=200)
+    parser.add_argument("--ks", type=int, nargs="+", default=list(DEFAULT_KS))
+    parser.add_argument("--n-warmup", type=int, default=5)
+    parser.add_argument(
+        "--vector-store-backend",
+        default=VectorStoreBackend.NUMPY.value,
+        choices=[backend.value for backend in VectorStoreBackend],
+    )
+    sweep_types = {
+        "embedding_model": str,
+        "use_window_nodes": parse_bool,
+        "hybrid_search": parse_bool,
+        "similarity_top_k": int,
+        "sparse_top_k": int,
+        "hybrid_search_alpha": float,
+        "embedding_dimensions": parse_optional_int,
+        "vector_quantization": str,
+        "rescore_oversampling": float,
+    }
+    for option, option_type in sweep_types.items():
+        parser.add_argument(
+            f"--{option.replace('_', '-')}",
+            type=option_type,
+            nargs="+",
+            default=DEFAULT_SWEEP[option],
+        )
+    args = parser.parse_args()
+    run_benchmark(
+        code_name=args.code_name,
+        sweep={option: getattr(args, option) for option in sweep_types},
+        questions_path=args.questions_path,
+        results_path=args.results_path,
+        n_questions=args.n_questions,
+        ks=args.ks,
+        n_warmup=args.n_warmup,
+        vector_store_backend=args.vector_store_backend,
+    )
@@ -1,4 +1,4 @@
-from typing import Any, Optional, Sequence
+from typing import Any, Optional, Sequence, Tuple
 
 from llama_index.core.evaluation import (
     ContextRelevancyEvaluator,
@@ -10,6 +10,17 @@ from llama_index.core.schema import MetadataMode
 from llama_index.core.evaluation.base import EvaluationResult
 
 
+def get_response_and_contexts(
+    response: Optional[Response], metadata_mode: MetadataMode
+) -> Tuple[Optional[str], Optional[Sequence[str]]]:
+    if response is None:
+        return None, None
+    contexts = [
+        node.get_content(metadata_mode=metadata_mode) for node in response.source_nodes
+    ]
+    return response.response, contexts
+
+
 class CustomContextRelevancyEvaluator(ContextRelevancyEvaluator):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -39,6 +50,19 @@ class CustomContextRelevancyEvaluator(ContextRelevancyEvaluator):
             query=query, response=response_str, contexts=contexts, **kwargs
         )
 
+    async def aevaluate_response(
+        self,
+        query: Optional[str] = None,
+        response: Optional[Response] = None,
+        metadata_mode: MetadataMode = MetadataMode.ALL,
+        **kwargs: Any,
+    ) -> EvaluationResult:
+        """Async version of `evaluate_response`."""
+        response_str, contexts = get_response_and_contexts(response, metadata_mode)
+        return await self.aevaluate(
+            query=query, response=response_str, contexts=contexts, **kwargs
+        )
+
 
 class CustomFaithfulnessEvaluator(FaithfulnessEvaluator):
     def __init__(self, **kwargs):
@@ -69,6 +93,19 @@ class CustomFaithfulnessEvaluator(FaithfulnessEvaluator):
             query=query, response=response_str, contexts=contexts, **kwargs
         )
 
+    async def aevaluate_response(
+        self,
+        query: Optional[str] = None,
+        response: Optional[Response] = None,
+        metadata_mode: MetadataMode = MetadataMode.ALL,
+        **kwargs: Any,
+    ) -> EvaluationResult:
+        """Async version of `evaluate_response`."""
+        response_str, contexts = get_response_and_contexts(response, metadata_mode)
+        return await self.aevaluate(
+            query=query, response=response_str, contexts=contexts, **kwargs
+        )
+
 
 class CustomAnswerRelevancyEvaluator(AnswerRelevancyEvaluator):
     def __init__(self, **kwargs):
@@ -98,3 +135,16 @@ class CustomAnswerRelevancyEvaluator(AnswerRelevancyEvaluator):
         return self.evaluate(
             query=query, response=response_str, contexts=contexts, **kwargs
         )
+
+    async def aevaluate_response(
+        self,
+        query: Optional[str] = None,
+        response: Optional[Response] = None,
+        metadata_mode: MetadataMode = MetadataMode.ALL,
+        **kwargs: Any,
+    ) -> EvaluationResult:
+        """Async version of `evaluate_response`."""
+        response_str, contexts = get_response_and_contexts(response, metadata_mode)
+        return await self.aevaluate(
+            query=query, response=response_str, contexts=contexts, **kwargs
+        )
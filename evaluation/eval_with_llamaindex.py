@@ -1,21 +1,24 @@
 from enum import Enum
-from typing import Literal, List, Dict
+from typing import Coroutine, Literal, List, Dict, Optional
+import asyncio
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 from IPython.display import display
 from llama_index.core.query_engine import BaseQueryEngine
 from llama_index.llms.openai import OpenAI
 from llama_index.core.evaluation.notebook_utils import get_eval_results_df
-from llama_index.core.evaluation.base import EvaluationResult
+from llama_index.core.evaluation.base import BaseEvaluator, EvaluationResult
 
 from llama_index.core.schema import MetadataMode
 import pandas as pd
-from tqdm import tqdm
+from tqdm.asyncio import tqdm_asyncio
 from loguru import logger
 
 import evaluation.custom_evaluators as evals
-from utils import load_json
-
+from evaluation.results_store import EvaluationStore, get_experiment_fingerprint
+from query.query_engine import get_query_engine_config
+from utils import RateLimiter, load_json
 
 PATH_SAVE_EVAL_METRICS = "./data/evaluation_results/{exp_name}_{code_name}_metrics.csv"
 PATH_SAVE_EVAL_DEEP = "./data/evaluation_results/{exp_name}_{code_name}_deep.csv"
@@ -45,34 +48,171 @@ def displayify_df(df):
     display(display_df)
 
 
-def evaluate_one_metric(
-    query_engine: BaseQueryEngine,
-    metric: Metric,
+def get_eval_questions(
     code_name: Literal["code_civil", "code_de_la_route"],
-    metadata_mode: MetadataMode,
-    llm_for_eval: str = "gpt-3.5-turbo",
     if_query_rewrite: bool = False,
-) -> List[EvaluationResult]:
-
-    evaluator_class = getattr(evals, f"Custom{metric.value}Evaluator")
-
-    evaluator = evaluator_class(llm=OpenAI(temperature=0, model=llm_for_eval))
-
+) -> List[str]:
     path_eval_data = f"PATH_EVAL_{code_name.upper()}"
     if if_query_rewrite:
         path_eval_data = f"PATH_EVAL_{code_name.upper()}_QUERY_REWRITE"
-    eval_data = load_json(globals()[path_eval_data])
+    return load_json(globals()[path_eval_data])
+
 
-    results = []
-    for question in tqdm(eval_data):
-        response = query_engine.query(question)
-        eval_result = evaluator.evaluate_response(
-            query=question, response=response, metadata_mode=metadata_mode
+def run_coroutine(coroutine: Coroutine):
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    # in a notebook, the event loop of the kernel is already running and cannot be
+    # re-entered: the coroutine runs on its own loop, in another thread
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+async def aevaluate_questions(
+    query_engine: BaseQueryEngine,
+    questions: List[str],
+    evaluators: Dict[Metric, BaseEvaluator],
+    metadata_mode: MetadataMode,
+    rate_limiter: RateLimiter,
+    evaluation_store: Optional[EvaluationStore] = None,
+    experiment_fingerprint: str = "",
+    evaluation_key: str = "",
+) -> Dict[Metric, List[EvaluationResult]]:
+    """
+    Query the engine once per question and evaluate the response with every
+    evaluator. The questions are processed concurrently, and every query and
+    evaluator call goes through `rate_limiter`.
+
+    With an `evaluation_store`, the responses and results are looked up in the
+    store before being computed, and stored as soon as they are computed.
+    """
+
+    async def evaluate_question(question: str) -> Dict[Metric, EvaluationResult]:
+        results = {}
+        if evaluation_store is not None:
+            for metric in evaluators:
+                results[metric] = evaluation_store.get_result(
+                    experiment_fingerprint, question, metric.value, evaluation_key
+                )
+        missing_metrics = [metric for metric in evaluators if not results.get(metric)]
+        if not missing_metrics:
+            return results
+
+        response = None
+        if evaluation_store is not None:
+            response = evaluation_store.get_response(experiment_fingerprint, question)
+        if response is None:
+            async with rate_limiter:
+                # not every engine is built for `aquery`, so the engine runs in a thread
+                response = await asyncio.to_thread(query_engine.query, question)
+            if evaluation_store is not None:
+                evaluation_store.put_response(
+                    experiment_fingerprint, question, response
+                )
+
+        async def evaluate_response(metric: Metric) -> EvaluationResult:
+            async with rate_limiter:
+                result = await evaluators[metric].aevaluate_response(
+                    query=question, response=response, metadata_mode=metadata_mode
+                )
+            if evaluation_store is not None:
+                evaluation_store.put_result(
+                    experiment_fingerprint,
+                    question,
+                    metric.value,
+                    evaluation_key,
+                    result,
+                )
+            return result
+
+        computed_results = await asyncio.gather(
+            *map(evaluate_response, missing_metrics)
+        )
+        results.update(zip(missing_metrics, computed_results))
+        return results
+
+    async def evaluate_question_safely(question: str):
+        # a failed question does not stop the others, whose results get stored
+        try:
+            return await evaluate_question(question)
+        except Exception as exc:
+            return exc
+
+    questions_results = await tqdm_asyncio.gather(
+        *map(evaluate_question_safely, questions)
+    )
+    errors = [result for result in questions_results if isinstance(result, Exception)]
+    if errors:
+        logger.error(f"The evaluation of {len(errors)} questions failed.")
+        raise errors[0]
+    return {
+        metric: [question_results[metric] for question_results in questions_results]
+        for metric in evaluators
+    }
+
+
+def evaluate_metrics(
+    query_engine: BaseQueryEngine,
+    metrics: List[Metric],
+    code_name: Literal["code_civil", "code_de_la_route"],
+    metadata_mode: MetadataMode,
+    llm_for_eval: str = "gpt-3.5-turbo",
+    if_query_rewrite: bool = False,
+    max_concurrency: int = 8,
+    max_calls_per_minute: Optional[float] = None,
+    evaluation_store: Optional[EvaluationStore] = None,
+    experiment_fingerprint: str = "",
+) -> Dict[Metric, List[EvaluationResult]]:
+    """
+    Evaluate the engine on the questions of the code for every metric, with one
+    query per question whose response is shared by the metrics.
+
+    At most `max_concurrency` queries and evaluator calls run at once, and at most
+    `max_calls_per_minute` of them start per minute if given. With an
+    `evaluation_store`, the responses and results already stored for
+    `experiment_fingerprint` are reused.
+    """
+    llm = OpenAI(temperature=0, model=llm_for_eval)
+    evaluators = {
+        metric: getattr(evals, f"Custom{metric.value}Evaluator")(llm=llm)
+        for metric in metrics
+    }
+    eval_data = get_eval_questions(code_name, if_query_rewrite)
+
+    async def run() -> Dict[Metric, List[EvaluationResult]]:
+        # the rate limiter is bound to the event loop of the run
+        rate_limiter = RateLimiter(max_concurrency, max_calls_per_minute)
+        return await aevaluate_questions(
+            query_engine,
+            eval_data,
+            evaluators,
+            metadata_mode,
+            rate_limiter,
+            evaluation_store=evaluation_store,
+            experiment_fingerprint=experiment_fingerprint,
+            evaluation_key=f"{llm_for_eval}|{metadata_mode.name}",
         )
 
-        results.append(eval_result)
+    return run_coroutine(run())
+
 
-    return results
+def evaluate_one_metric(
+    query_engine: BaseQueryEngine,
+    metric: Metric,
+    code_name: Literal["code_civil", "code_de_la_route"],
+    metadata_mode: MetadataMode,
+    llm_for_eval: str = "gpt-3.5-turbo",
+    if_query_rewrite: bool = False,
+) -> List[EvaluationResult]:
+    return evaluate_metrics(
+        query_engine=query_engine,
+        metrics=[metric],
+        code_name=code_name,
+        metadata_mode=metadata_mode,
+        llm_for_eval=llm_for_eval,
+        if_query_rewrite=if_query_rewrite,
+    )[metric]
 
 
 def postprocess_eval_results(metric_to_results: Dict[str, pd.DataFrame]):
@@ -97,22 +237,54 @@ def evaluate(
     do_save: bool = True,
     metadata_mode: MetadataMode = MetadataMode.ALL,
     if_query_rewrite: bool = False,
+    max_concurrency: int = 8,
+    max_calls_per_minute: Optional[float] = None,
+    resume: bool = True,
+    evaluation_store: Optional[EvaluationStore] = None,
+    experiment_config: Optional[dict] = None,
 ):
+    """
+    Evaluate a query engine on every metric and return the mean and per-question
+    scores.
+
+    With `resume`, the responses and results are persisted in `evaluation_store`,
+    by default the one of `PATH_EVALUATION_STORE`, and the ones already computed
+    for the experiment are reused. The experiment is identified by
+    `experiment_config`, by default the parameters of the engines built by
+    `create_query_engine` or `create_routing_engine`; it is required to resume the
+    evaluation of other engines.
+    """
+    if "window" in exp_name.lower():
+        metadata_mode = MetadataMode.NONE
+    if experiment_config is None:
+        experiment_config = get_query_engine_config(query_engine)
+    if resume and experiment_config is None:
+        raise ValueError(
+            f"The engine of {exp_name} was not built by `create_query_engine`, "
+            "give its `experiment_config` to resume its evaluation."
+        )
+    if resume and evaluation_store is None:
+        evaluation_store = EvaluationStore()
+    experiment_fingerprint = get_experiment_fingerprint(
+        {"experiment": experiment_config, "code_name": code_name}
+    )
+    metric_to_results = evaluate_metrics(
+        query_engine=query_engine,
+        metrics=[Metric[metric_name.upper()] for metric_name in list_metrics],
+        code_name=code_name,
+        llm_for_eval=llm_for_eval,
+        metadata_mode=metadata_mode,
+        if_query_rewrite=if_query_rewrite,
+        max_concurrency=max_concurrency,
+        max_calls_per_minute=max_calls_per_minute,
+        evaluation_store=evaluation_store if resume else None,
+        experiment_fingerprint=experiment_fingerprint,
+    )
+
     deep_dfs = []
     mean_dfs = {}
     for metric_name in list_metrics:
-        metric = Metric[metric_name.upper()]
-        if "window" in exp_name.lower():
-            metadata_mode = MetadataMode.NONE
-
-        results = evaluate_one_metric(
-            query_engine=query_engine,
-            metric=metric,
-            code_name=code_name,
-            llm_for_eval=llm_for_eval,
-            metadata_mode=metadata_mode,
-            if_query_rewrite=if_query_rewrite,
-        )
+        results = metric_to_results[Metric[metric_name.upper()]]
         deep_df, mean_df = get_eval_results_df(
             names=[exp_name] * len(results),
             results_arr=results,
@@ -144,10 +316,16 @@ def evaluate_multiple_experiments(
     llm_for_eval: str = "gpt-3.5-turbo",
     do_save: bool = True,
     metadata_mode: MetadataMode = MetadataMode.ALL,
+    max_concurrency: int = 8,
+    max_calls_per_minute: Optional[float] = None,
+    resume: bool = True,
+    experiment_to_config: Optional[Dict[str, dict]] = None,
 ):
     dfs_mean_scores = []
     dfs_deep = []
     if_query_rewrite = "rewrit" in general_exp_name.lower()
+    evaluation_store = EvaluationStore() if resume else None
+    experiment_to_config = experiment_to_config or {}
     for exp_name, query_engine in experiment_to_query_engine.items():
         logger.info(f"Evaluating experiment: {exp_name}")
         mean_scores_df, deep_dfs_full, _ = evaluate(
@@ -158,6 +336,11 @@ def evaluate_multiple_experiments(
             llm_for_eval=llm_for_eval,
             metadata_mode=metadata_mode,
             if_query_rewrite=if_query_rewrite,
+            max_concurrency=max_concurrency,
+            max_calls_per_minute=max_calls_per_minute,
+            resume=resume,
+            evaluation_store=evaluation_store,
+            experiment_config=experiment_to_config.get(exp_name),
         )
         dfs_mean_scores.append(mean_scores_df)
         dfs_deep.append(deep_dfs_full)
@@ -0,0 +1,145 @@
+"""
+SQLite store of the evaluation runs, so that an interrupted sweep resumes where it
+stopped and a finished one is not paid for again.
+
+The engine responses and the evaluation results are stored as soon as they are
+computed, keyed by the fingerprint of the experiment configuration and the question.
+The responses are stored separately from the results, so that a new metric is
+evaluated on the stored responses without querying the engines again.
+"""
+
+import json
+import os
+import sqlite3
+from threading import Lock
+from typing import Any, Optional
+
+from llama_index.core.base.response.schema import RESPONSE_TYPE, Response
+from llama_index.core.evaluation.base import EvaluationResult
+from llama_index.core.schema import NodeWithScore
+from llama_index.core.storage.docstore.utils import doc_to_json, json_to_doc
+
+from utils import hash_text
+
+PATH_EVALUATION_STORE = "./data/evaluation_results/evaluation_store.sqlite"
+
+
+def get_experiment_fingerprint(config: Any) -> str:
+    """Hash of a JSON-serializable description of an experiment."""
+    return hash_text(json.dumps(config, sort_keys=True, default=str))
+
+
+def response_to_json(response: RESPONSE_TYPE) -> str:
+    return json.dumps(
+        {
+            "response": response.response,
+            "source_nodes": [
+                {"node": doc_to_json(node.node), "score": node.score}
+                for node in response.source_nodes
+            ],
+            "metadata": response.metadata,
+        },
+        default=str,
+    )
+
+
+def json_to_response(response_json: str) -> Response:
+    data = json.loads(response_json)
+    return Response(
+        response=data["response"],
+        source_nodes=[
+            NodeWithScore(node=json_to_doc(node["node"]), score=node["score"])
+            for node in data["source_nodes"]
+        ],
+        metadata=data["metadata"],
+    )
+
+
+class EvaluationStore:
+    """
+    Engine responses and evaluation results of the experiments.
+
+    The results are keyed by the experiment fingerprint, the question, the metric
+    and `evaluation_key`, which describes how the metric was computed (evaluator
+    LLM, metadata mode).
+    """
+
+    def __init__(self, path: str = PATH_EVALUATION_STORE):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # the evaluation writes from a single thread at a time, but not always
+        # from the thread that created the store
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = Lock()
+        with self._lock, self._connection:
+            self._connection.executescript("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    fingerprint TEXT NOT NULL,
+                    question TEXT NOT NULL,
+                    response TEXT NOT NULL,
+                    PRIMARY KEY (fingerprint, question)
+                );
+                CREATE TABLE IF NOT EXISTS results (
+                    fingerprint TEXT NOT NULL,
+                    question TEXT NOT NULL,
+                    metric TEXT NOT NULL,
+                    evaluation_key TEXT NOT NULL,
+                    result TEXT NOT NULL,
+                    PRIMARY KEY (fingerprint, question, metric, evaluation_key)
+                );
+                """)
+
+    def _fetch_one(self, query: str, parameters: tuple) -> Optional[str]:
+        with self._lock:
+            row = self._connection.execute(query, parameters).fetchone()
+        return row[0] if row is not None else None
+
+    def _write(self, query: str, parameters: tuple):
+        with self._lock, self._connection:
+            self._connection.execute(query, parameters)
+
+    def get_response(self, fingerprint: str, question: str) -> Optional[Response]:
+        response_json = self._fetch_one(
+            "SELECT response FROM responses WHERE fingerprint = ? AND question = ?",
+            (fingerprint, question),
+        )
+        return json_to_response(response_json) if response_json else None
+
+    def put_response(self, fingerprint: str, question: str, response: RESPONSE_TYPE):
+        self._write(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?)",
+            (fingerprint, question, response_to_json(response)),
+        )
+
+    def get_result(
+        self, fingerprint: str, question: str, metric: str, evaluation_key: str
+    ) -> Optional[EvaluationResult]:
+        result_json = self._fetch_one(
+            "SELECT result FROM results WHERE fingerprint = ? AND question = ? "
+            "AND metric = ? AND evaluation_key = ?",
+            (fingerprint, question, metric, evaluation_key),
+        )
+        return EvaluationResult.parse_raw(result_json) if result_json else None
+
+    def put_result(
+        self,
+        fingerprint: str,
+        question: str,
+        metric: str,
+        evaluation_key: str,
+        result: EvaluationResult,
+    ):
+        self._write(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+            (fingerprint, question, metric, evaluation_key, result.json()),
+        )
+
+    def delete_experiment(self, fingerprint: str):
+        """Forget the responses and results of an experiment, to run it again."""
+        with self._lock, self._connection:
+            for table in ("responses", "results"):
+                self._connection.execute(
+                    f"DELETE FROM {table} WHERE fingerprint = ?", (fingerprint,)
+                )
+
+    def close(self):
+        self._connection.close()
@@ -0,0 +1,163 @@
+"""
+Offline stand-ins for the embedding and LLM providers, for benchmarks that should not
+depend on network access or API keys. The embedding is the `HashingEmbedding` of the
+retriever, re-exported here. Both stubs are deterministic and can simulate the latency
+of a remote call. `RateLimitedEmbedding` also simulates the rate limits and the
+errors of a remote embedding provider.
+"""
+
+import asyncio
+import random
+import re
+import threading
+import time
+from collections import deque
+from typing import Any, List, Optional
+
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.llms import (
+    CompletionResponse,
+    CompletionResponseGen,
+    CustomLLM,
+    LLMMetadata,
+)
+from llama_index.core.llms.callbacks import llm_completion_callback
+
+from data_ingestion.chunking import estimate_tokens
+from retriever.embeddings import HashingEmbedding
+
+
+class ProviderError(Exception):
+    """HTTP error of `RateLimitedEmbedding`, with the seconds to wait before a retry
+    for the rate-limit errors."""
+
+    def __init__(
+        self, message: str, status_code: int, retry_after: Optional[float] = None
+    ):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class RateLimitedEmbedding(HashingEmbedding):
+    """
+    Hashing embedding behind the limits of a remote provider.
+
+    Every batch call sleeps `latency` seconds plus `latency_per_1k_tokens` by
+    thousand tokens. It fails with a 400 when the batch has more than
+    `max_batch_tokens` tokens, with a 429 when the requests or the tokens accepted
+    during the last `window` seconds would exceed `requests_per_window` or
+    `tokens_per_window`, and with a 503 for a random `error_rate` of the calls.
+    The tokens are estimated from the number of characters.
+    """
+
+    requests_per_window: Optional[int] = Field(default=None)
+    tokens_per_window: Optional[int] = Field(default=None)
+    window: float = Field(default=60.0, description="Seconds.")
+    max_batch_tokens: Optional[int] = Field(default=None)
+    latency_per_1k_tokens: float = Field(default=0.0)
+    error_rate: float = Field(default=0.0)
+    seed: int = Field(default=0)
+    # (time, tokens) of the accepted requests of the window
+    _accepted: deque = PrivateAttr(default_factory=deque)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _random: random.Random = PrivateAttr()
+
+    def __init__(self, **kwargs: Any):
+        super().__init__(**kwargs)
+        self._random = random.Random(self.seed)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "RateLimitedEmbedding"
+
+    def _accept(self, texts: List[str]) -> float:
+        """Seconds of latency of the request, or raise its error."""
+        n_tokens = sum(estimate_tokens(text) for text in texts)
+        if self.max_batch_tokens and n_tokens > self.max_batch_tokens:
+            raise ProviderError(
+                f"Too many tokens in batch: {n_tokens}, the maximum is "
+                f"{self.max_batch_tokens}.",
+                status_code=400,
+            )
+        with self._lock:
+            now = time.monotonic()
+            while self._accepted and self._accepted[0][0] <= now - self.window:
+                self._accepted.popleft()
+            used_tokens = sum(tokens for _, tokens in self._accepted)
+            if (
+                self.requests_per_window
+                and len(self._accepted) >= self.requests_per_window
+            ) or (
+                self.tokens_per_window
+                and used_tokens + n_tokens > self.tokens_per_window
+                and self._accepted
+            ):
+                retry_after = self._accepted[0][0] + self.window - now
+                raise ProviderError(
+                    "Rate limit reached, retry later.",
+                    status_code=429,
+                    retry_after=retry_after,
+                )
+            if self._random.random() < self.error_rate:
+                raise ProviderError("Service unavailable.", status_code=503)
+            self._accepted.append((now, n_tokens))
+        return self.latency + self.latency_per_1k_tokens * n_tokens / 1000
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._get_text_embeddings([text])[0]
+
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        return (await self._aget_text_embeddings([text]))[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        time.sleep(self._accept(texts))
+        return [self.embed(text) for text in texts]
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        await asyncio.sleep(self._accept(texts))
+        return [self.embed(text) for text in texts]
+
+
+class StubLLM(CustomLLM):
+    """
+    LLM answering after `latency` seconds with the last `Query:` line of the prompt,
+    repeated on `n_lines` lines so that it can also stand for query generation.
+    """
+
+    latency: float = Field(default=0.0, description="Seconds slept by each call.")
+    n_lines: int = Field(default=4, description="Number of lines of each answer.")
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "StubLLM"
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(model_name="stub")
+
+    def _answer(self, prompt: str) -> str:
+        queries = re.findall(r"Query: (.*)", prompt)
+        query = queries[-1] if queries else prompt[-200:]
+        return "\n".join(f"{query} ({i})" for i in range(self.n_lines))
+
+    @llm_completion_callback()
+    def complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponse:
+        time.sleep(self.latency)
+        return CompletionResponse(text=self._answer(prompt))
+
+    @llm_completion_callback()
+    async def acomplete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponse:
+        await asyncio.sleep(self.latency)
+        return CompletionResponse(text=self._answer(prompt))
+
+    @llm_completion_callback()
+    def stream_complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponseGen:
+        response = self.complete(prompt, formatted=formatted, **kwargs)
+        yield CompletionResponse(text=response.text, delta=response.text)
@@ -0,0 +1,153 @@
+import re
+from typing import List, Optional, Tuple
+
+from llama_index.core.base.base_query_engine import BaseQueryEngine
+from llama_index.core.base.response.schema import RESPONSE_TYPE
+from llama_index.core.prompts.mixin import PromptMixinType
+from llama_index.core.query_engine import RetrieverQueryEngine
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from llama_index.vector_stores.qdrant import QdrantVectorStore
+from loguru import logger
+
+from retriever.article_index import ArticleIndex
+from retriever.bm25 import fold_accents
+from retriever.hybrid_retriever import get_nodes_by_id
+from retriever.numpy_vector_store import NumpyVectorStore
+
+# "1240", "1240-1", "L. 121-1", "R417-4", and "1er" for the first article
+ARTICLE_NUMBER = r"(?:[LRDA]\s?\.?\s?)?\d+(?:-\d+)*(?:er\b)?"
+# separators of the lists and ranges of articles, "à" often being written "a"
+SEPARATOR = r"(?:,|\bet\b|à|\ba\b|\bau\b)"
+ARTICLE_REFERENCE_PATTERN = re.compile(
+    rf"\b(?:articles?|art\.)\s*({ARTICLE_NUMBER}(?:\s*{SEPARATOR}\s*{ARTICLE_NUMBER})*)",
+    re.IGNORECASE,
+)
+# the separator is read before the number, " a 1244" not being the article "A1244"
+ARTICLE_LIST_ITEM_PATTERN = re.compile(
+    rf"\s*({SEPARATOR})?\s*({ARTICLE_NUMBER})", re.IGNORECASE
+)
+RANGE_SEPARATORS = ("à", "a", "au")
+# the codes number their first article "1", not "1er"
+ORDINAL_SUFFIX_PATTERN = re.compile(r"er$", re.IGNORECASE)
+# the kinds of legal texts an article can belong to, accent-folded: an article cited
+# with one of them is not an article of the code unless the code is named too
+LEGAL_TEXT_MENTION_PATTERN = re.compile(
+    r"\b(?:code|loi|decret|ordonnance|reglement|directive|constitution|convention)s?\b"
+)
+
+
+def parse_article_references(query: str) -> List[Tuple[str, Optional[str]]]:
+    """
+    Find the articles cited by the query, as (first article, last article) for the
+    ranges and (article, None) for single articles. "articles L. 121-1 à 121-3"
+    gives [("L. 121-1", "L121-3")]: the prefix of a range start applies to its end.
+    "article 1er" gives [("1", None)].
+    """
+    references = []
+    for match in ARTICLE_REFERENCE_PATTERN.finditer(query):
+        for item in ARTICLE_LIST_ITEM_PATTERN.finditer(match.group(1)):
+            separator = item.group(1)
+            article_number = ORDINAL_SUFFIX_PATTERN.sub("", item.group(2))
+            is_range = separator is not None and separator.lower() in RANGE_SEPARATORS
+            if is_range and references:
+                first = references[-1][0]
+                prefix = re.match(r"[A-Za-z]*", first).group()
+                if not article_number[0].isalpha():
+                    article_number = prefix + article_number
+                references[-1] = (first, article_number)
+            else:
+                references.append((article_number, None))
+    return references
+
+
+def mentions_other_text(query: str, code_name: str) -> bool:
+    """Whether the query names a code or another legal text, e.g. "la loi de 1978",
+    without naming the code `code_name`."""
+    folded_query = fold_accents(query.lower())
+    return bool(LEGAL_TEXT_MENTION_PATTERN.search(folded_query)) and (
+        fold_accents(code_name.lower()) not in folded_query
+    )
+
+
+class ArticleLookupQueryEngine(BaseQueryEngine):
+    """
+    Query engine answering the queries citing articles of its code from these
+    articles, with one LLM call and without retrieval.
+
+    The cited articles are resolved with the `ArticleIndex` of the collection and
+    their nodes fetched by id from the vector store. The queries citing unknown
+    articles, too many nodes or another code are answered by `query_engine`.
+
+    Parameters
+    ----------
+    query_engine : RetrieverQueryEngine
+        The engine of the code, its postprocessors and response synthesizer are
+        also used for the cited articles.
+    article_index : ArticleIndex
+        The article index of the collection of `query_engine`.
+    vector_store : QdrantVectorStore | NumpyVectorStore
+        The vector store of the collection.
+    max_nodes : int, optional
+        The maximum number of nodes put in the context, by default 10.
+    """
+
+    def __init__(
+        self,
+        query_engine: RetrieverQueryEngine,
+        article_index: ArticleIndex,
+        vector_store: QdrantVectorStore | NumpyVectorStore,
+        max_nodes: int = 10,
+    ) -> None:
+        self._query_engine = query_engine
+        self._article_index = article_index
+        self._vector_store = vector_store
+        self._max_nodes = max_nodes
+        super().__init__(callback_manager=query_engine.callback_manager)
+
+    def _get_prompt_modules(self) -> PromptMixinType:
+        return {"query_engine": self._query_engine}
+
+    def get_article_nodes(self, query_str: str) -> Optional[List[NodeWithScore]]:
+        """The nodes of the articles cited by the query, None to use the retriever."""
+        references = parse_article_references(query_str)
+        if not references or mentions_other_text(
+            query_str, self._article_index.code_name
+        ):
+            return None
+
+        node_ids = []
+        for first_article, last_article in references:
+            article_node_ids = self._article_index.get_node_ids(
+                first_article, last_article
+            )
+            if article_node_ids is None:
+                return None
+            node_ids.extend(article_node_ids)
+        node_ids = list(dict.fromkeys(node_ids))
+        if len(node_ids) > self._max_nodes:
+            return None
+
+        nodes = get_nodes_by_id(self._vector_store, node_ids)
+        if len(nodes) < len(node_ids):
+            # the index was built from nodes that are not all in the vector store
+            return None
+        logger.debug(f"Answering from articles {references} without retrieval.")
+        return [NodeWithScore(node=nodes[node_id], score=1.0) for node_id in node_ids]
+
+    def _query(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
+        nodes = self.get_article_nodes(query_bundle.query_str)
+        if nodes is None:
+            return self._query_engine.query(query_bundle)
+        nodes = self._query_engine._apply_node_postprocessors(
+            nodes, query_bundle=query_bundle
+        )
+        return self._query_engine.synthesize(query_bundle, nodes)
+
+    async def _aquery(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
+        nodes = self.get_article_nodes(query_bundle.query_str)
+        if nodes is None:
+            return await self._query_engine.aquery(query_bundle)
+        nodes = self._query_engine._apply_node_postprocessors(
+            nodes, query_bundle=query_bundle
+        )
+        return await self._query_engine.asynthesize(query_bundle, nodes)
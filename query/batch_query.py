@@ -0,0 +1,203 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import List, Optional, Sequence
+
+from llama_index.core.base.base_query_engine import BaseQueryEngine
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.base.response.schema import RESPONSE_TYPE
+from llama_index.core.indices.vector_store.retrievers import VectorIndexRetriever
+from llama_index.core.query_engine import RetrieverQueryEngine
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from llama_index.core.vector_stores.types import VectorStoreQuery, VectorStoreQueryMode
+from llama_index.embeddings.fastembed import FastEmbedEmbedding
+from llama_index.vector_stores.qdrant import QdrantVectorStore
+from loguru import logger
+from qdrant_client.http import models as rest
+from tqdm import tqdm
+
+from retriever.get_retriever import DENSE_VECTOR_NAME
+from retriever.numpy_vector_store import NumpyVectorStore
+from retriever.quantization import RescoringQdrantVectorStore
+
+
+@dataclass
+class BatchQueryResult:
+    query: str
+    response: Optional[RESPONSE_TYPE] = None
+    error: Optional[Exception] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def embed_queries(embed_model: BaseEmbedding, queries: List[str]) -> List[List[float]]:
+    """Embed queries with one request per `embed_batch_size` queries."""
+    # the models of the index builds are wrapped in a `ScheduledEmbedding`
+    wrapped_model = getattr(embed_model, "wrapped_model", embed_model)
+    if isinstance(wrapped_model, FastEmbedEmbedding):
+        # fastembed embeds queries and passages differently
+        return [
+            embedding.tolist()
+            for embedding in wrapped_model._model.query_embed(queries)
+        ]
+    # the OpenAI and Mistral models embed queries and texts the same way
+    return embed_model.get_text_embedding_batch(queries)
+
+
+def _supports_search_batch(query_engine: BaseQueryEngine) -> bool:
+    if not isinstance(query_engine, RetrieverQueryEngine):
+        return False
+    retriever = query_engine.retriever
+    return (
+        isinstance(retriever, VectorIndexRetriever)
+        and isinstance(retriever._vector_store, (QdrantVectorStore, NumpyVectorStore))
+        and retriever._vector_store_query_mode == VectorStoreQueryMode.DEFAULT
+    )
+
+
+def _get_search_request(
+    vector_store: QdrantVectorStore, query: VectorStoreQuery
+) -> rest.SearchRequest:
+    if isinstance(vector_store, RescoringQdrantVectorStore):
+        # with the rescoring parameters of the quantized collections
+        return vector_store._get_search_request(query)
+    vector = query.query_embedding
+    if vector_store.enable_hybrid:
+        vector = rest.NamedVector(name=DENSE_VECTOR_NAME, vector=vector)
+    return rest.SearchRequest(
+        vector=vector,
+        limit=query.similarity_top_k,
+        filter=vector_store._build_query_filter(query),
+        with_payload=True,
+    )
+
+
+def search_batch(
+    retriever: VectorIndexRetriever, query_bundles: Sequence[QueryBundle]
+) -> List[List[NodeWithScore]]:
+    """Retrieve the nodes of several embedded queries with one Qdrant request, or
+    one scan of a `NumpyVectorStore`."""
+    vector_store = retriever._vector_store
+    queries = [
+        retriever._build_vector_store_query(query_bundle)
+        for query_bundle in query_bundles
+    ]
+    if isinstance(vector_store, NumpyVectorStore):
+        query_results = vector_store.query_batch(queries)
+    else:
+        responses = vector_store.client.search_batch(
+            collection_name=vector_store.collection_name,
+            requests=[_get_search_request(vector_store, query) for query in queries],
+        )
+        query_results = [
+            vector_store.parse_to_query_result(response) for response in responses
+        ]
+    return [
+        retriever._build_node_list_from_query_result(query_result)
+        for query_result in query_results
+    ]
+
+
+def query_many(
+    query_engine: BaseQueryEngine,
+    queries: Sequence[str],
+    search_batch_size: int = 64,
+    max_concurrent_synthesis: int = 8,
+    show_progress: bool = False,
+) -> List[BatchQueryResult]:
+    """
+    Answer many queries at once.
+
+    For the engines returned by `create_query_engine` without query rewrite, hybrid
+    search, article lookup nor response cache, the queries are embedded by batches
+    of the embedding model `embed_batch_size`, their nodes are retrieved with one
+    search per `search_batch_size` queries (a Qdrant `search_batch`, or one matrix
+    product for the numpy backend), and only the synthesis is done query by query.
+    Other engines answer each query with `query`. In both cases at most
+    `max_concurrent_synthesis` queries are answered at a time.
+
+    Parameters
+    ----------
+    query_engine : BaseQueryEngine
+        The query engine, usually from `create_query_engine`.
+    queries : Sequence[str]
+        The queries to answer.
+    search_batch_size : int, optional
+        The number of queries per search, by default 64.
+    max_concurrent_synthesis : int, optional
+        The maximum number of concurrent LLM calls, by default 8.
+    show_progress : bool, optional
+        Whether to show a progress bar over the synthesis, by default False.
+
+    Returns
+    -------
+    List[BatchQueryResult]
+        One result per query, in the order of `queries`. A query that failed at any
+        step has its exception in `error` instead of a `response`.
+    """
+    results = [BatchQueryResult(query=query) for query in queries]
+    query_bundles = [QueryBundle(query) for query in queries]
+
+    if _supports_search_batch(query_engine):
+        retriever: VectorIndexRetriever = query_engine.retriever
+        embed_model = retriever._embed_model
+        embed_batch_size = embed_model.embed_batch_size
+        for start in range(0, len(queries), embed_batch_size):
+            batch = slice(start, start + embed_batch_size)
+            try:
+                embeddings = embed_queries(embed_model, list(queries[batch]))
+            except Exception as exc:
+                logger.error(f"Embedding of queries {start} to {batch.stop} failed.")
+                for result in results[batch]:
+                    result.error = exc
+                continue
+            for query_bundle, embedding in zip(query_bundles[batch], embeddings):
+                query_bundle.embedding = embedding
+
+        retrieved_nodes: List[Optional[List[NodeWithScore]]] = [None] * len(queries)
+        to_search = [i for i, result in enumerate(results) if result.ok]
+        for start in range(0, len(to_search), search_batch_size):
+            ids = to_search[start : start + search_batch_size]
+            try:
+                nodes_lists = search_batch(retriever, [query_bundles[i] for i in ids])
+            except Exception as exc:
+                logger.error(f"Search of {len(ids)} queries failed.")
+                for i in ids:
+                    results[i].error = exc
+                continue
+            for i, nodes in zip(ids, nodes_lists):
+                retrieved_nodes[i] = nodes
+
+        def answer(i: int) -> RESPONSE_TYPE:
+            nodes = query_engine._apply_node_postprocessors(
+                retrieved_nodes[i], query_bundle=query_bundles[i]
+            )
+            return query_engine.synthesize(query_bundles[i], nodes)
+
+    else:
+
+        def answer(i: int) -> RESPONSE_TYPE:
+            return query_engine.query(query_bundles[i])
+
+    def answer_safely(i: int):
+        try:
+            results[i].response = answer(i)
+        except Exception as exc:
+            results[i].error = exc
+
+    to_answer = [i for i, result in enumerate(results) if result.ok]
+    with ThreadPoolExecutor(max_workers=max_concurrent_synthesis) as executor:
+        list(
+            tqdm(
+                executor.map(answer_safely, to_answer),
+                total=len(to_answer),
+                desc="Answering queries ...",
+                disable=not show_progress,
+            )
+        )
+
+    n_errors = sum(not result.ok for result in results)
+    if n_errors:
+        logger.warning(f"{n_errors} of {len(results)} queries failed.")
+    return results
@@ -0,0 +1,184 @@
+from threading import Lock
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from llama_index.core.base.base_selector import (
+    BaseSelector,
+    SelectorResult,
+    SingleSelection,
+)
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.prompts.mixin import PromptDictType, PromptMixinType
+from llama_index.core.schema import QueryBundle
+from llama_index.core.tools.types import ToolMetadata
+from loguru import logger
+
+from retriever.embedding_cache import EmbeddingCache, get_cache_namespace
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+class EmbeddingSimilaritySelector(BaseSelector):
+    """
+    Select a tool by cosine similarity between the query and the tool descriptions.
+
+    The descriptions are embedded once (through the embedding cache), so a clear-cut
+    query costs one query embedding and a dot product. When the score of the best
+    tool is less than `margin_threshold` above the second best, the selection is
+    delegated to `fallback_selector`.
+
+    Parameters
+    ----------
+    embed_model : BaseEmbedding
+        The embedding model used for the descriptions and the queries.
+    fallback_selector : BaseSelector
+        The selector used for ambiguous queries, usually an `LLMMultiSelector`.
+    margin_threshold : float, optional
+        Minimum difference between the two best scores to skip the fallback, by
+        default 0.05.
+    centroids : Dict[str, List[float]], optional
+        Mean embedding of the nodes of each tool, keyed by tool name. When given for
+        every tool, the score of a tool is the weighted mean of its description and
+        centroid similarities.
+    centroid_weight : float, optional
+        Weight of the centroid similarity, by default 0.5.
+    use_embedding_cache : bool, optional
+        Whether to cache the description embeddings on disk, by default True.
+    """
+
+    def __init__(
+        self,
+        embed_model: BaseEmbedding,
+        fallback_selector: BaseSelector,
+        margin_threshold: float = 0.05,
+        centroids: Optional[Dict[str, List[float]]] = None,
+        centroid_weight: float = 0.5,
+        use_embedding_cache: bool = True,
+    ) -> None:
+        self._embed_model = embed_model
+        self._fallback_selector = fallback_selector
+        self.margin_threshold = margin_threshold
+        self.centroid_weight = centroid_weight
+        self._centroids = {
+            name: _normalize(np.asarray(centroid, dtype=np.float32))
+            for name, centroid in (centroids or {}).items()
+        }
+        self._cache = (
+            EmbeddingCache(get_cache_namespace(embed_model))
+            if use_embedding_cache
+            else None
+        )
+        # description embeddings of the choices, keyed by their descriptions
+        self._choice_embeddings: Dict[tuple, np.ndarray] = {}
+        self._lock = Lock()
+        self.n_selections = 0
+        self.n_fallbacks = 0
+
+    @property
+    def fallback_rate(self) -> float:
+        return self.n_fallbacks / self.n_selections if self.n_selections else 0.0
+
+    def log_stats(self):
+        logger.info(
+            f"Embedding router: {self.n_selections} selections, {self.n_fallbacks} "
+            f"fallbacks to the LLM selector ({self.fallback_rate:.1%})."
+        )
+
+    def _get_prompts(self) -> PromptDictType:
+        return {}
+
+    def _update_prompts(self, prompts: PromptDictType) -> None:
+        pass
+
+    def _get_prompt_modules(self) -> PromptMixinType:
+        return {"fallback_selector": self._fallback_selector}
+
+    def _embed_descriptions(self, descriptions: List[str]) -> np.ndarray:
+        embeddings = (
+            self._cache.get_many(descriptions)
+            if self._cache is not None
+            else [None] * len(descriptions)
+        )
+        missing_ids = [i for i, emb in enumerate(embeddings) if emb is None]
+        if missing_ids:
+            missing_texts = [descriptions[i] for i in missing_ids]
+            new_embeddings = self._embed_model.get_text_embedding_batch(missing_texts)
+            if self._cache is not None:
+                self._cache.put_many(missing_texts, new_embeddings)
+            for i, embedding in zip(missing_ids, new_embeddings):
+                embeddings[i] = embedding
+        return _normalize(np.asarray(embeddings, dtype=np.float32))
+
+    def _get_choice_embeddings(self, choices: Sequence[ToolMetadata]) -> np.ndarray:
+        key = tuple(choice.description for choice in choices)
+        with self._lock:
+            if key not in self._choice_embeddings:
+                self._choice_embeddings[key] = self._embed_descriptions(list(key))
+            return self._choice_embeddings[key]
+
+    def _score(
+        self, choices: Sequence[ToolMetadata], query_embedding: List[float]
+    ) -> np.ndarray:
+        query_vector = _normalize(np.asarray(query_embedding, dtype=np.float32))
+        scores = self._get_choice_embeddings(choices) @ query_vector
+        if self._centroids and all(
+            choice.name in self._centroids for choice in choices
+        ):
+            centroid_scores = (
+                np.stack([self._centroids[choice.name] for choice in choices])
+                @ query_vector
+            )
+            scores = (
+                1 - self.centroid_weight
+            ) * scores + self.centroid_weight * centroid_scores
+        return scores
+
+    def _select_by_margin(self, scores: np.ndarray) -> Optional[SelectorResult]:
+        """Return the best choice, or None when it is not clear enough."""
+        self.n_selections += 1
+        ranking = np.argsort(-scores)
+        margin = scores[ranking[0]] - scores[ranking[1]] if len(scores) > 1 else np.inf
+        if margin < self.margin_threshold:
+            self.n_fallbacks += 1
+            logger.debug(
+                f"Embedding router margin {margin:.3f} below "
+                f"{self.margin_threshold}, falling back to the LLM selector."
+            )
+            return None
+        best = int(ranking[0])
+        return SelectorResult(
+            selections=[
+                SingleSelection(
+                    index=best,
+                    reason=(
+                        f"Highest embedding similarity ({scores[best]:.3f}), "
+                        f"{margin:.3f} above the next choice."
+                    ),
+                )
+            ]
+        )
+
+    def _select(
+        self, choices: Sequence[ToolMetadata], query: QueryBundle
+    ) -> SelectorResult:
+        query_embedding = query.embedding or self._embed_model.get_query_embedding(
+            query.query_str
+        )
+        result = self._select_by_margin(self._score(choices, query_embedding))
+        if result is None:
+            return self._fallback_selector.select(choices, query)
+        return result
+
+    async def _aselect(
+        self, choices: Sequence[ToolMetadata], query: QueryBundle
+    ) -> SelectorResult:
+        query_embedding = query.embedding or (
+            await self._embed_model.aget_query_embedding(query.query_str)
+        )
+        result = self._select_by_margin(self._score(choices, query_embedding))
+        if result is None:
+            return await self._fallback_selector.aselect(choices, query)
+        return result
@@ -0,0 +1,58 @@
+import asyncio
+from typing import Dict, List, Tuple
+
+from llama_index.core.retrievers import QueryFusionRetriever
+from llama_index.core.retrievers.fusion_retriever import FUSION_MODES
+from llama_index.core.schema import NodeWithScore, QueryBundle
+
+
+class AsyncQueryFusionRetriever(QueryFusionRetriever):
+    """
+    `QueryFusionRetriever` whose async path never blocks the event loop.
+
+    The queries are generated with `acomplete` instead of `complete`, and every
+    retriever is queried for the original query while the other queries are being
+    generated. The retrievals of the generated queries then run concurrently, so a
+    query costs about one generation and one retrieval round-trip.
+    """
+
+    async def _aget_queries(self, original_query: str) -> List[QueryBundle]:
+        prompt_str = self.query_gen_prompt.format(
+            num_queries=self.num_queries - 1,
+            query=original_query,
+        )
+        response = await self._llm.acomplete(prompt_str)
+
+        # assume LLM proper put each query on a newline
+        queries = response.text.split("\n")
+        # The LLM often returns more queries than we asked for, so trim the list.
+        return [QueryBundle(q) for q in queries[: self.num_queries - 1]]
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        if self.num_queries > 1:
+            generated_queries, original_results = await asyncio.gather(
+                self._aget_queries(query_bundle.query_str),
+                self._run_async_queries([query_bundle]),
+            )
+            results: Dict[Tuple[str, int], List[NodeWithScore]] = {
+                **original_results,
+                **(await self._run_async_queries(generated_queries)),
+            }
+        else:
+            results = await self._run_async_queries([query_bundle])
+        return self._fuse(results)
+
+    def _fuse(
+        self, results: Dict[Tuple[str, int], List[NodeWithScore]]
+    ) -> List[NodeWithScore]:
+        if self.mode == FUSION_MODES.RECIPROCAL_RANK:
+            return self._reciprocal_rerank_fusion(results)[: self.similarity_top_k]
+        if self.mode == FUSION_MODES.RELATIVE_SCORE:
+            return self._relative_score_fusion(results)[: self.similarity_top_k]
+        if self.mode == FUSION_MODES.DIST_BASED_SCORE:
+            return self._relative_score_fusion(results, dist_based=True)[
+                : self.similarity_top_k
+            ]
+        if self.mode == FUSION_MODES.SIMPLE:
+            return self._simple_fusion(results)[: self.similarity_top_k]
+        raise ValueError(f"Invalid fusion mode: {self.mode}")
@@ -0,0 +1,356 @@
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from threading import Lock
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from llama_index.core import Settings
+from llama_index.core.callbacks import CBEventType, EventPayload
+from llama_index.core.callbacks.base_handler import BaseCallbackHandler
+from llama_index.core.schema import MetadataMode
+from loguru import logger
+
+# upper bounds of the latency histogram buckets, in seconds
+DEFAULT_LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+PROMETHEUS_PREFIX = "legal_rag"
+
+
+@dataclass
+class StageSpan:
+    stage: str
+    # seconds, the exclusive duration excludes the children spans
+    duration: float
+    exclusive_duration: float
+    counters: Dict[str, float] = field(default_factory=dict)
+
+
+@dataclass
+class _OpenEvent:
+    stage: str
+    parent_id: str
+    start: float
+    counters: Dict[str, float]
+    children_duration: float = 0.0
+
+
+def get_start_counters(
+    event_type: CBEventType, payload: Optional[Dict[str, Any]]
+) -> Dict[str, float]:
+    payload = payload or {}
+    if event_type == CBEventType.LLM:
+        if EventPayload.PROMPT in payload:
+            return {"prompt_chars": len(payload[EventPayload.PROMPT])}
+        if EventPayload.MESSAGES in payload:
+            return {
+                "prompt_chars": sum(
+                    len(message.content or "")
+                    for message in payload[EventPayload.MESSAGES]
+                )
+            }
+    return {}
+
+
+def get_end_counters(
+    event_type: CBEventType, payload: Optional[Dict[str, Any]]
+) -> Dict[str, float]:
+    payload = payload or {}
+    if event_type == CBEventType.EMBEDDING:
+        return {"texts": len(payload.get(EventPayload.CHUNKS, []))}
+    if event_type == CBEventType.RETRIEVE:
+        return {"nodes": len(payload.get(EventPayload.NODES, []))}
+    if event_type == CBEventType.SYNTHESIZE:
+        source_nodes = getattr(payload.get(EventPayload.RESPONSE), "source_nodes", [])
+        return {
+            "context_nodes": len(source_nodes),
+            "context_chars": sum(
+                len(node.node.get_content(metadata_mode=MetadataMode.LLM))
+                for node in source_nodes
+            ),
+        }
+    if event_type == CBEventType.LLM:
+        response = payload.get(EventPayload.COMPLETION) or payload.get(
+            EventPayload.RESPONSE
+        )
+        # token counts reported by the provider, e.g. OpenAI
+        usage = getattr(response, "additional_kwargs", None) or {}
+        return {
+            name: usage[name]
+            for name in ("prompt_tokens", "completion_tokens")
+            if isinstance(usage.get(name), (int, float))
+        }
+    return {}
+
+
+class StageSink(ABC):
+    """Destination of the spans of a `StageTimingHandler`."""
+
+    @abstractmethod
+    def record(self, span: StageSpan):
+        """Called with every span, from the thread that ended its event."""
+
+
+class LoggingSink(StageSink):
+    def __init__(self, level: str = "DEBUG"):
+        self.level = level
+
+    def record(self, span: StageSpan):
+        counters = "".join(
+            f", {name} {value:g}" for name, value in span.counters.items()
+        )
+        logger.log(
+            self.level,
+            f"{span.stage}: {1000 * span.duration:.1f} ms "
+            f"({1000 * span.exclusive_duration:.1f} ms exclusive){counters}",
+        )
+
+
+@dataclass
+class LatencyHistogram:
+    buckets: Tuple[float, ...] = DEFAULT_LATENCY_BUCKETS
+    # cumulative counts of the observations lower than each bucket, then of all
+    bucket_counts: List[int] = field(default_factory=list)
+    count: int = 0
+    total: float = 0.0
+
+    def __post_init__(self):
+        self.bucket_counts = self.bucket_counts or [0] * (len(self.buckets) + 1)
+
+    def observe(self, value: float):
+        for i, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                self.bucket_counts[i] += 1
+        self.bucket_counts[-1] += 1
+        self.count += 1
+        self.total += value
+
+    def quantile(self, q: float) -> float:
+        """
+        Quantile estimated by linear interpolation in its bucket, like the
+        `histogram_quantile` of Prometheus. The quantiles of the last bucket are
+        its lower bound.
+        """
+        if not self.count:
+            return float("nan")
+        rank = q * self.count
+        i = int(np.searchsorted(self.bucket_counts, rank))
+        if i >= len(self.buckets):
+            return self.buckets[-1]
+        lower_bound = self.buckets[i - 1] if i else 0.0
+        lower_count = self.bucket_counts[i - 1] if i else 0
+        bucket_count = self.bucket_counts[i] - lower_count
+        if not bucket_count:
+            return lower_bound
+        return lower_bound + (self.buckets[i] - lower_bound) * (
+            (rank - lower_count) / bucket_count
+        )
+
+
+class HistogramSink(StageSink):
+    """In-memory latency histograms and counter totals of every stage."""
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.durations: Dict[str, LatencyHistogram] = {}
+        self.exclusive_durations: Dict[str, LatencyHistogram] = {}
+        self.counters: Dict[str, Dict[str, float]] = {}
+        self._lock = Lock()
+
+    def record(self, span: StageSpan):
+        with self._lock:
+            for histograms, value in (
+                (self.durations, span.duration),
+                (self.exclusive_durations, span.exclusive_duration),
+            ):
+                histograms.setdefault(
+                    span.stage, LatencyHistogram(self.buckets)
+                ).observe(value)
+            stage_counters = self.counters.setdefault(span.stage, {})
+            for name, value in span.counters.items():
+                stage_counters[name] = stage_counters.get(name, 0) + value
+
+    def get_histogram(self, stage: str, exclusive: bool = False) -> LatencyHistogram:
+        histograms = self.exclusive_durations if exclusive else self.durations
+        return histograms.get(stage, LatencyHistogram(self.buckets))
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Count, mean and percentiles in milliseconds, and counter totals, of every
+        stage."""
+        with self._lock:
+            summary = {}
+            for stage, histogram in sorted(self.durations.items()):
+                exclusive_histogram = self.exclusive_durations[stage]
+                summary[stage] = {
+                    "count": histogram.count,
+                    "mean_ms": 1000 * histogram.total / histogram.count,
+                    "exclusive_mean_ms": 1000
+                    * exclusive_histogram.total
+                    / exclusive_histogram.count,
+                    **{
+                        f"p{percentile}_ms": 1000 * histogram.quantile(percentile / 100)
+                        for percentile in (50, 95, 99)
+                    },
+                    **self.counters[stage],
+                }
+            return summary
+
+    def reset(self):
+        with self._lock:
+            self.durations.clear()
+            self.exclusive_durations.clear()
+            self.counters.clear()
+
+
+def _format_prometheus_histogram(
+    name: str, histograms: Dict[str, LatencyHistogram]
+) -> List[str]:
+    lines = []
+    for stage, histogram in sorted(histograms.items()):
+        upper_bounds = [f"{bound:g}" for bound in histogram.buckets] + ["+Inf"]
+        for upper_bound, count in zip(upper_bounds, histogram.bucket_counts):
+            lines.append(f'{name}_bucket{{stage="{stage}",le="{upper_bound}"}} {count}')
+        lines.append(f'{name}_sum{{stage="{stage}"}} {histogram.total:.6f}')
+        lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+    return lines
+
+
+def render_prometheus(sink: HistogramSink, prefix: str = PROMETHEUS_PREFIX) -> str:
+    """The histograms and counters of `sink` in the Prometheus text format."""
+    with sink._lock:
+        lines = []
+        for name, description, histograms in (
+            (
+                f"{prefix}_stage_duration_seconds",
+                "Duration of the query pipeline stages.",
+                sink.durations,
+            ),
+            (
+                f"{prefix}_stage_exclusive_duration_seconds",
+                "Duration of the query pipeline stages, without their sub-stages.",
+                sink.exclusive_durations,
+            ),
+        ):
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} histogram"]
+            lines += _format_prometheus_histogram(name, histograms)
+
+        name = f"{prefix}_stage_counter_total"
+        lines += [
+            f"# HELP {name} Counters of the query pipeline stages (nodes, tokens, ...).",
+            f"# TYPE {name} counter",
+        ]
+        for stage, counters in sorted(sink.counters.items()):
+            for counter, value in sorted(counters.items()):
+                lines.append(f'{name}{{stage="{stage}",counter="{counter}"}} {value:g}')
+        return "\n".join(lines) + "\n"
+
+
+class StageTimingHandler(BaseCallbackHandler):
+    """
+    Callback handler timing the events of the query engines (query embedding,
+    retrieval, LLM calls, synthesis, ...), which report to the global llama-index
+    callback manager, and sending every event as a `StageSpan` to its sinks.
+
+    The stage of a span is the path of its event types from the outermost event,
+    e.g. "query.retrieve.embedding" for the query embedding or "query.retrieve.llm"
+    for the query generation of the query rewrite. The exclusive duration of a span
+    excludes its children: the one of "query.retrieve" is the vector search, the one
+    of "query" is the node postprocessing.
+    """
+
+    def __init__(self, sinks: List[StageSink]):
+        # the exception events are never ended
+        super().__init__(
+            event_starts_to_ignore=[CBEventType.EXCEPTION],
+            event_ends_to_ignore=[CBEventType.EXCEPTION],
+        )
+        self.sinks = sinks
+        self._open_events: Dict[str, _OpenEvent] = {}
+        self._lock = Lock()
+
+    def on_event_start(
+        self,
+        event_type: CBEventType,
+        payload: Optional[Dict[str, Any]] = None,
+        event_id: str = "",
+        parent_id: str = "",
+        **kwargs: Any,
+    ) -> str:
+        counters = get_start_counters(event_type, payload)
+        with self._lock:
+            parent = self._open_events.get(parent_id)
+            stage = event_type.value
+            if parent is not None:
+                stage = f"{parent.stage}.{stage}"
+            self._open_events[event_id] = _OpenEvent(
+                stage=stage,
+                parent_id=parent_id,
+                start=time.perf_counter(),
+                counters=counters,
+            )
+        return event_id
+
+    def on_event_end(
+        self,
+        event_type: CBEventType,
+        payload: Optional[Dict[str, Any]] = None,
+        event_id: str = "",
+        **kwargs: Any,
+    ) -> None:
+        end = time.perf_counter()
+        with self._lock:
+            event = self._open_events.pop(event_id, None)
+            if event is None:
+                return
+            duration = end - event.start
+            parent = self._open_events.get(event.parent_id)
+            if parent is not None:
+                parent.children_duration += duration
+        span = StageSpan(
+            stage=event.stage,
+            duration=duration,
+            # concurrent children, e.g. the sub-queries of the async query rewrite,
+            # can last longer than their parent
+            exclusive_duration=max(0.0, duration - event.children_duration),
+            counters={**event.counters, **get_end_counters(event_type, payload)},
+        )
+        for sink in self.sinks:
+            sink.record(span)
+
+    def start_trace(self, trace_id: Optional[str] = None) -> None:
+        pass
+
+    def end_trace(
+        self,
+        trace_id: Optional[str] = None,
+        trace_map: Optional[Dict[str, List[str]]] = None,
+    ) -> None:
+        pass
+
+
+def enable_stage_timing(
+    sinks: Optional[List[StageSink]] = None,
+) -> StageTimingHandler:
+    """Time the stages of every engine, built before or after, by default in the
+    logs."""
+    handler = StageTimingHandler(sinks if sinks is not None else [LoggingSink()])
+    Settings.callback_manager.add_handler(handler)
+    return handler
+
+
+def disable_stage_timing(handler: StageTimingHandler):
+    Settings.callback_manager.remove_handler(handler)
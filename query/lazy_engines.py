@@ -0,0 +1,104 @@
+from collections import OrderedDict
+from threading import Lock, Thread
+from typing import Callable, Dict, Iterable, Optional
+
+from llama_index.core.base.base_query_engine import BaseQueryEngine
+from llama_index.core.base.response.schema import RESPONSE_TYPE
+from llama_index.core.prompts.mixin import PromptMixinType
+from llama_index.core.schema import QueryBundle
+from loguru import logger
+
+
+class EngineCache:
+    """
+    Least recently used query engines, keyed by code name.
+
+    At most `max_resident_engines` engines are kept; building the same engine from
+    several threads only builds it once.
+    """
+
+    def __init__(self, max_resident_engines: int = 3):
+        self.max_resident_engines = max_resident_engines
+        self._engines: OrderedDict = OrderedDict()
+        self._lock = Lock()
+        self._build_locks: Dict[str, Lock] = {}
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._engines
+
+    def get(
+        self, key: str, build_engine: Callable[[], BaseQueryEngine]
+    ) -> BaseQueryEngine:
+        with self._lock:
+            if key in self._engines:
+                self._engines.move_to_end(key)
+                return self._engines[key]
+            build_lock = self._build_locks.setdefault(key, Lock())
+
+        with build_lock:
+            with self._lock:
+                if key in self._engines:
+                    self._engines.move_to_end(key)
+                    return self._engines[key]
+            logger.info(f"Building query engine for {key} ...")
+            engine = build_engine()
+
+        with self._lock:
+            self._engines[key] = engine
+            self._engines.move_to_end(key)
+            while len(self._engines) > self.max_resident_engines:
+                evicted_key, _ = self._engines.popitem(last=False)
+                logger.info(f"Evicted query engine for {evicted_key}.")
+        return engine
+
+
+class LazyQueryEngine(BaseQueryEngine):
+    """
+    Query engine proxy that builds the underlying engine on its first query and
+    keeps it in a shared `EngineCache`.
+    """
+
+    def __init__(
+        self,
+        key: str,
+        build_engine: Callable[[], BaseQueryEngine],
+        engine_cache: EngineCache,
+    ) -> None:
+        self.key = key
+        self._build_engine = build_engine
+        self._engine_cache = engine_cache
+        super().__init__(callback_manager=None)
+
+    @property
+    def engine(self) -> BaseQueryEngine:
+        return self._engine_cache.get(self.key, self._build_engine)
+
+    def _get_prompt_modules(self) -> PromptMixinType:
+        # the prompts of the underlying engine are only known once it is built
+        return {}
+
+    def _query(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
+        return self.engine.query(query_bundle)
+
+    async def _aquery(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
+        return await self.engine.aquery(query_bundle)
+
+
+def warm_up_in_background(
+    lazy_engines: Iterable[LazyQueryEngine],
+    before: Optional[Callable[[], None]] = None,
+) -> Thread:
+    """Build the given engines in a background thread, after calling `before`."""
+
+    def warm_up():
+        try:
+            if before is not None:
+                before()
+            for lazy_engine in lazy_engines:
+                lazy_engine.engine
+        except Exception as exc:
+            logger.error(f"Query engines warm-up failed: {exc!r}")
+
+    thread = Thread(target=warm_up, daemon=True)
+    thread.start()
+    return thread
@@ -1,9 +1,109 @@
+import json
+from functools import partial
+from typing import Dict, List, Optional
+from weakref import WeakKeyDictionary
+
 from llama_index.core.query_engine import BaseQueryEngine, RetrieverQueryEngine
 from llama_index.core import PromptTemplate, VectorStoreIndex
-from llama_index.core.retrievers import QueryFusionRetriever
+from llama_index.core.retrievers import BaseRetriever, QueryFusionRetriever
+from llama_index.core.vector_stores.types import (
+    FilterOperator,
+    MetadataFilter,
+    MetadataFilters,
+)
+from loguru import logger
 
-from retriever.get_retriever import index_nodes
+from data_ingestion.nodes_processing import CODE_NAME_METADATA_KEY
+from retriever.article_index import load_article_index
+from retriever.bm25 import BM25Index, load_bm25_index
+from retriever.embedding_scheduler import EmbeddingRateLimits
+from retriever.get_retriever import get_collection_generation, index_nodes
+from retriever.hierarchy import CodeScope, get_scope_filters, load_code_hierarchy
+from retriever.hybrid_retriever import BM25HybridRetriever
+from query.article_lookup import ArticleLookupQueryEngine
 from query.constants import QUERY_GEN_PROMPT
+from query.fusion_retriever import AsyncQueryFusionRetriever
+from query.response_cache import CachedQueryEngine, SemanticResponseCache
+from schema import SparseIndexBackend, VectorQuantization, VectorStoreBackend
+
+# parameters of `create_query_engine` that do not change the responses of an engine
+RUNTIME_ENGINE_PARAMETERS = [
+    "recreate_collection",
+    "reload_data",
+    "response_cache",
+    "use_async",
+    "embedding_rate_limits",
+]
+
+# parameters of `create_query_engine` that change the responses of the engines
+# of a collection
+RETRIEVAL_PARAMETERS = [
+    "similarity_top_k",
+    "sparse_top_k",
+    "hybrid_search",
+    "hybrid_search_alpha",
+    "sparse_index",
+    "query_rewrite",
+    "num_generated_questions",
+    "nodes_window_size",
+    "query_time_window",
+    "article_lookup",
+    "rescore_oversampling",
+]
+
+# the parameters of the engines built by `create_query_engine` and
+# `create_routing_engine`, which identify them in the evaluation store
+_query_engine_configs: "WeakKeyDictionary[BaseQueryEngine, dict]" = WeakKeyDictionary()
+
+
+def register_query_engine_config(query_engine: BaseQueryEngine, parameters: dict):
+    _query_engine_configs[query_engine] = {
+        name: value
+        for name, value in parameters.items()
+        if name not in RUNTIME_ENGINE_PARAMETERS
+    }
+
+
+def get_query_engine_config(query_engine: BaseQueryEngine) -> Optional[dict]:
+    """The parameters the engine was built with, None for the engines not built by
+    `create_query_engine` or `create_routing_engine`."""
+    return _query_engine_configs.get(query_engine)
+
+
+def get_cache_namespace(
+    collection_name: str, scope: Optional[CodeScope], retrieval_parameters: dict
+) -> str:
+    # the engines of a collection with other scopes or retrieval parameters must
+    # not share their responses
+    namespace = (
+        f"{collection_name}|"
+        f"{json.dumps(retrieval_parameters, sort_keys=True, default=str)}"
+    )
+    if scope is None:
+        return namespace
+    return f"{namespace}|{json.dumps(scope.headers, ensure_ascii=False)}"
+
+
+def get_retrieval_filters(
+    scope: Optional[CodeScope] = None, code_names: Optional[List[str]] = None
+) -> Optional[MetadataFilters]:
+    """The filters on the headers of the scope and, in a collection shared by
+    several codes, on the code names."""
+    filters = get_scope_filters(scope.headers if scope is not None else {})
+    if len(code_names or []) == 1:
+        filters.filters.append(
+            MetadataFilter(key=CODE_NAME_METADATA_KEY, value=code_names[0])
+        )
+    elif code_names:
+        filters.filters.append(
+            MetadataFilter(
+                key=CODE_NAME_METADATA_KEY,
+                # the Qdrant vector store only takes comma-separated values
+                value=",".join(code_names),
+                operator=FilterOperator.IN,
+            )
+        )
+    return filters if filters.filters else None
 
 
 def update_prompts_for_query_engine(query_engine: BaseQueryEngine) -> BaseQueryEngine:
@@ -23,16 +123,37 @@ def update_prompts_for_query_engine(query_engine: BaseQueryEngine) -> BaseQueryE
     return query_engine
 
 
-def get_query_fusion_retrieval(
+def get_index_retriever(
     index: VectorStoreIndex,
-    postprocessors_list: list,
     similarity_top_k: int = 5,
     sparse_top_k: int = 0,
     hybrid_search_alpha: float = 0.5,
     hybrid_search: bool = False,
-    num_generated_questions: int = 4,
-) -> BaseQueryEngine:
-    kwargs = {"similarity_top_k": similarity_top_k}
+    bm25_index: Optional[BM25Index] = None,
+    scope: Optional[CodeScope] = None,
+    code_names: Optional[List[str]] = None,
+) -> BaseRetriever:
+    """
+    Retriever of the index. The hybrid search fuses the dense results with the ones
+    of `bm25_index` when given, else with the Qdrant sparse vectors of the collection.
+    With a `scope`, both searches only consider the nodes of the scope, and with
+    `code_names`, the nodes of these codes of a collection shared by several codes.
+    """
+    filters = get_retrieval_filters(scope, code_names)
+    if hybrid_search and bm25_index is not None:
+        return BM25HybridRetriever(
+            dense_retriever=index.as_retriever(
+                similarity_top_k=similarity_top_k, filters=filters
+            ),
+            bm25_index=bm25_index,
+            vector_store=index.vector_store,
+            similarity_top_k=similarity_top_k,
+            sparse_top_k=sparse_top_k,
+            alpha=hybrid_search_alpha,
+            node_ids=scope.node_ids if scope is not None else None,
+        )
+
+    kwargs = {"similarity_top_k": similarity_top_k, "filters": filters}
     if hybrid_search:
         kwargs.update(
             {
@@ -41,21 +162,51 @@ def get_query_fusion_retrieval(
                 "alpha": hybrid_search_alpha,
             }
         )
+    return index.as_retriever(**kwargs)
 
-    retriever = index.as_retriever(**kwargs)
 
-    retriever = QueryFusionRetriever(
+def get_query_fusion_retrieval(
+    index: VectorStoreIndex,
+    postprocessors_list: list,
+    similarity_top_k: int = 5,
+    sparse_top_k: int = 0,
+    hybrid_search_alpha: float = 0.5,
+    hybrid_search: bool = False,
+    num_generated_questions: int = 4,
+    use_async: bool = False,
+    bm25_index: Optional[BM25Index] = None,
+    scope: Optional[CodeScope] = None,
+    code_names: Optional[List[str]] = None,
+) -> BaseQueryEngine:
+    retriever = get_index_retriever(
+        index,
+        similarity_top_k=similarity_top_k,
+        sparse_top_k=sparse_top_k,
+        hybrid_search_alpha=hybrid_search_alpha,
+        hybrid_search=hybrid_search,
+        bm25_index=bm25_index,
+        scope=scope,
+        code_names=code_names,
+    )
+
+    fusion_retriever_class = (
+        AsyncQueryFusionRetriever if use_async else QueryFusionRetriever
+    )
+    retriever = fusion_retriever_class(
         [retriever],
         similarity_top_k=similarity_top_k,
         num_queries=num_generated_questions,  # set this to 1 to disable query generation
         mode="reciprocal_rerank",
-        use_async=False,
+        use_async=use_async,
         verbose=False,
         query_gen_prompt=QUERY_GEN_PROMPT,
+        callback_manager=retriever.callback_manager,
     )
 
     query_engine = RetrieverQueryEngine.from_args(
-        retriever=retriever, node_postprocessors=postprocessors_list
+        retriever=retriever,
+        node_postprocessors=postprocessors_list,
+        use_async=use_async,
     )
     query_engine = update_prompts_for_query_engine(query_engine)
     return query_engine
@@ -68,20 +219,26 @@ def get_query_engine_based_on_index(
     sparse_top_k: int = 0,
     hybrid_search_alpha: float = 0.5,
     hybrid_search: bool = False,
+    use_async: bool = False,
+    bm25_index: Optional[BM25Index] = None,
+    scope: Optional[CodeScope] = None,
+    code_names: Optional[List[str]] = None,
 ) -> BaseQueryEngine:
-    kwargs = {
-        "node_postprocessors": postprocessors_list,
-        "similarity_top_k": similarity_top_k,
-    }
-    if hybrid_search:
-        kwargs.update(
-            {
-                "vector_store_query_mode": "hybrid",
-                "sparse_top_k": sparse_top_k,
-                "alpha": hybrid_search_alpha,
-            }
-        )
-    query_engine = index.as_query_engine(**kwargs)
+    retriever = get_index_retriever(
+        index,
+        similarity_top_k=similarity_top_k,
+        sparse_top_k=sparse_top_k,
+        hybrid_search_alpha=hybrid_search_alpha,
+        hybrid_search=hybrid_search,
+        bm25_index=bm25_index,
+        scope=scope,
+        code_names=code_names,
+    )
+    query_engine = RetrieverQueryEngine.from_args(
+        retriever=retriever,
+        node_postprocessors=postprocessors_list,
+        use_async=use_async,
+    )
     query_engine = update_prompts_for_query_engine(query_engine)
     return query_engine
 
@@ -99,6 +256,22 @@ def create_query_engine(
     nodes_window_size: int = 3,
     recreate_collection: bool = False,
     reload_data: bool = False,
+    query_time_window: bool = False,
+    max_tokens_per_node: Optional[int] = None,
+    chunk_overlap_tokens: int = 0,
+    response_cache: Optional[SemanticResponseCache] = None,
+    use_async: bool = False,
+    vector_store_backend: VectorStoreBackend = VectorStoreBackend.QDRANT,
+    vectors_dtype: str = "float32",
+    sparse_index: SparseIndexBackend = SparseIndexBackend.BM25,
+    article_lookup: bool = False,
+    scope: Optional[Dict[str, str]] = None,
+    embedding_dimensions: Optional[int] = None,
+    vector_quantization: VectorQuantization = VectorQuantization.NONE,
+    rescore_oversampling: float = 2.0,
+    shared_collection: bool = False,
+    code_names: Optional[List[str]] = None,
+    embedding_rate_limits: Optional[EmbeddingRateLimits] = None,
 ) -> BaseQueryEngine:
     """
     Create a Llama index query engine with the given configuration.
@@ -107,7 +280,7 @@ def create_query_engine(
     ----------
 
     code_name : str, optional
-        The name of the code to index, by default "code_civil"
+        The name of the code to index, by default "Code civil"
 
     embedding_model : str, optional
         The name of the embedding model in the retriever, by default "text-embedding-ada-002"
@@ -115,8 +288,17 @@ def create_query_engine(
     similarity_top_k : int, optional
         The number of top similar nodes to return, by default 5
 
-    use_relations : bool, optional
-        Whether to include relationships between nodes, by default False
+    sparse_top_k : int, optional
+        The number of nodes returned by the sparse search of the hybrid search,
+        by default 0 for `similarity_top_k`
+
+    hybrid_search : bool, optional
+        Whether to fuse the dense search with a sparse search, see `sparse_index`,
+        by default False
+
+    hybrid_search_alpha : float, optional
+        The weight of the dense scores in the hybrid search, the sparse scores
+        getting `1 - hybrid_search_alpha`, by default 0.5
 
     use_window_nodes : bool, optional
         Whether to include window nodes, by default False
@@ -128,7 +310,6 @@ def create_query_engine(
         The number of generated questions by question for the query rewrite, by default 4.
         This option is only used when query_rewrite is set to True.
 
-
     nodes_window_size : int, optional
         The size of the window nodes, by default 3
 
@@ -138,16 +319,137 @@ def create_query_engine(
     reload_data : bool, optional
         Whether to reload the data from the legifrance API, by default False
 
+    query_time_window : bool, optional
+        Whether to rebuild the window of the retrieved nodes at query time instead of
+        storing it in every node. The nodes are then indexed in the same collection as
+        without window nodes, and `nodes_window_size` only applies at query time.
+        This option is only used when use_window_nodes is set to True. By default False
+
+    max_tokens_per_node : int, optional
+        The maximum number of tokens of the embedded text of a node, longer articles
+        are split into several nodes. By default the input limit of the embedding model
+
+    chunk_overlap_tokens : int, optional
+        The number of tokens shared by consecutive chunks of a long article, by default 0
+
+    response_cache : SemanticResponseCache, optional
+        A cache of responses to answer repeated or similar queries from, by default None.
+        It can be shared by the engines of several codes.
+
+    use_async : bool, optional
+        Whether to create an engine for `aquery`: the vector store gets an async Qdrant
+        client, the generated questions of the query rewrite are retrieved concurrently
+        and the response is synthesized asynchronously, by default False
+
+    vector_store_backend : VectorStoreBackend, optional
+        Where the nodes are indexed: "qdrant" for the Qdrant server, or "numpy" for a
+        `NumpyVectorStore` persisted in `./data/vector_stores` and queried in process.
+        By default "qdrant"
+
+    vectors_dtype : str, optional
+        The type of the vectors of the numpy backend, "float32" or "float16", by default
+        "float32"
+
+    sparse_index : SparseIndexBackend, optional
+        The sparse side of the hybrid search: "bm25" for a French BM25 index built at
+        ingestion in `./data/bm25`, or "qdrant" for the sparse vectors computed by the
+        Qdrant vector store with a SPLADE model. By default "bm25"
+
+    article_lookup : bool, optional
+        Whether to answer the queries citing articles of the code, e.g. "que dit
+        l'article 1240 du Code civil ?", from these articles without retrieval,
+        by default False
+
+    scope : Dict[str, str], optional
+        Restrict the retrieval to a part of the code, given by the titles of its
+        headers, e.g. {"livre": "Des personnes", "titre": "Du mariage"}. The titles
+        are matched ignoring case and accents, and can be abbreviated as long as
+        they stay unambiguous. By default the whole code
+
+    embedding_dimensions : int, optional
+        Shorten the embeddings to this number of dimensions, only supported by the
+        Matryoshka models (text-embedding-3-small and text-embedding-3-large).
+        By default the full embeddings
+
+    vector_quantization : VectorQuantization, optional
+        Search compact codes of the vectors instead of the vectors: "int8" for
+        scalar quantization, 4 times smaller than float32, or "binary" for the
+        sign bits, 32 times smaller. The best candidates are rescored with the
+        full-precision vectors. By default "none"
+
+    rescore_oversampling : float, optional
+        The number of candidates rescored by retrieved node when the vectors are
+        quantized, by default 2.0
+
+    shared_collection : bool, optional
+        Whether to index the code in a collection shared by every code indexed with
+        the same configuration, its searches being filtered on the "Nom du code"
+        payload field, instead of a collection of its own. By default False
+
+    code_names : List[str], optional
+        Search the nodes of these codes at once instead of `code_name`, with one
+        search of the shared collection. The article lookup, the scope and the BM25
+        hybrid search are per code and are not supported. By default None
+
+    embedding_rate_limits : EmbeddingRateLimits, optional
+        The budgets, batch sizes and concurrency of the embedding requests of the
+        indexing. By default the limits of the first usage tier of the provider
+
     """
-    index, postprocessors_list = index_nodes(
-        code_name=code_name,
-        embedding_model=embedding_model,
-        use_window_nodes=use_window_nodes,
-        nodes_window_size=nodes_window_size,
-        hybrid_search=hybrid_search,
-        recreate_collection=recreate_collection,
-        reload_data=reload_data,
-    )
+    parameters = dict(locals())
+    if code_names is not None and not shared_collection:
+        raise ValueError("Several codes can only be searched in a shared collection.")
+    if code_names is not None and (
+        scope
+        or (
+            hybrid_search
+            and SparseIndexBackend(sparse_index) == SparseIndexBackend.BM25
+        )
+    ):
+        raise ValueError(
+            "The scopes and the BM25 indexes are per code, they cannot be used to "
+            "search several codes."
+        )
+    postprocessors_list, nodes_configs = [], []
+    for indexed_code_name in code_names or [code_name]:
+        index, code_postprocessors, nodes_config = index_nodes(
+            code_name=indexed_code_name,
+            embedding_model=embedding_model,
+            use_window_nodes=use_window_nodes,
+            nodes_window_size=nodes_window_size,
+            hybrid_search=hybrid_search,
+            recreate_collection=recreate_collection,
+            reload_data=reload_data,
+            query_time_window=query_time_window,
+            max_tokens_per_node=max_tokens_per_node,
+            chunk_overlap_tokens=chunk_overlap_tokens,
+            use_async=use_async,
+            vector_store_backend=vector_store_backend,
+            vectors_dtype=vectors_dtype,
+            sparse_index=sparse_index,
+            embedding_dimensions=embedding_dimensions,
+            vector_quantization=vector_quantization,
+            rescore_oversampling=rescore_oversampling,
+            shared_collection=shared_collection,
+            embedding_rate_limits=embedding_rate_limits,
+        )
+        # the windows rebuilt at query time are the ones of the nodes of the code,
+        # and the replacement by the stored windows is idempotent
+        postprocessors_list += code_postprocessors
+        nodes_configs.append(nodes_config)
+    # the per-code data (article index, hierarchy, BM25 index) of a single code
+    nodes_config = nodes_configs[0]
+    collection_name = index.vector_store.collection_name
+    code_scope = None
+    if scope:
+        code_scope = load_code_hierarchy(nodes_config).get_scope(scope)
+        logger.info(
+            f"Scoped retrieval over {len(code_scope.node_ids)} nodes of "
+            f"{code_scope.headers}."
+        )
+    bm25_index = None
+    if hybrid_search and SparseIndexBackend(sparse_index) == SparseIndexBackend.BM25:
+        bm25_index = load_bm25_index(nodes_config)
     kwargs_query_engine = {
         "index": index,
         "postprocessors_list": postprocessors_list,
@@ -155,10 +457,40 @@ def create_query_engine(
         "sparse_top_k": sparse_top_k,
         "hybrid_search_alpha": hybrid_search_alpha,
         "hybrid_search": hybrid_search,
+        "use_async": use_async,
+        "bm25_index": bm25_index,
+        "scope": code_scope,
+        "code_names": (code_names or [code_name]) if shared_collection else None,
     }
     if query_rewrite:
-        return get_query_fusion_retrieval(
+        query_engine = get_query_fusion_retrieval(
             **kwargs_query_engine, num_generated_questions=num_generated_questions
         )
+    else:
+        query_engine = get_query_engine_based_on_index(**kwargs_query_engine)
+
+    if article_lookup and code_names is None:
+        article_index = load_article_index(nodes_config)
+        if article_index is not None:
+            query_engine = ArticleLookupQueryEngine(
+                query_engine=query_engine,
+                article_index=article_index,
+                vector_store=index.vector_store,
+            )
 
-    return get_query_engine_based_on_index(**kwargs_query_engine)
+    if response_cache is not None:
+        query_engine = CachedQueryEngine(
+            query_engine=query_engine,
+            # the model of the index: the cached query embeddings are reused by its
+            # retriever, so they must have the dimensions of the collection
+            embed_model=index._embed_model,
+            response_cache=response_cache,
+            namespace=get_cache_namespace(
+                "+".join(nodes_configs),
+                code_scope,
+                {name: parameters[name] for name in RETRIEVAL_PARAMETERS},
+            ),
+            get_generation=partial(get_collection_generation, collection_name),
+        )
+    register_query_engine_config(query_engine, parameters)
+    return query_engine
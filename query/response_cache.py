@@ -0,0 +1,301 @@
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import Lock
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+from llama_index.core.base.base_query_engine import BaseQueryEngine
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.base.response.schema import RESPONSE_TYPE, Response
+from llama_index.core.prompts.mixin import PromptMixinType
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from loguru import logger
+
+from query.article_lookup import parse_article_references
+from retriever.article_index import normalize_article_number
+
+
+def normalize_query(query: str) -> str:
+    """Lowercase the query and drop the spacing and punctuation differences."""
+    query = unicodedata.normalize("NFKC", query).lower()
+    query = re.sub(r"[\s'’\"«»]+", " ", query)
+    return query.strip(" ?!.;:,")
+
+
+def get_cited_articles(query: str) -> List[Tuple[str, Optional[str]]]:
+    return [
+        (
+            normalize_article_number(first_article),
+            last_article and normalize_article_number(last_article),
+        )
+        for first_article, last_article in parse_article_references(query)
+    ]
+
+
+@dataclass
+class CachedResponse:
+    response: Optional[str]
+    source_nodes: List[NodeWithScore]
+    query_embedding: np.ndarray
+    cited_articles: List[Tuple[str, Optional[str]]]
+    latency: float
+    created_at: float
+
+
+class SemanticResponseCache:
+    """
+    In-memory cache of query engine responses.
+
+    A query hits the cache when its normalized text was already answered, or when
+    the cosine similarity between its embedding and the embedding of an answered
+    query is at least `similarity_threshold` and both queries cite the same
+    articles: "article 1240" and "article 1241" are too close to be told apart by
+    their embeddings. Entries are evicted in least recently
+    used order beyond `max_size`, and expire after `ttl_seconds`.
+
+    Entries are stored per namespace, the collection name and retrieval parameters
+    of the engine, and a namespace is emptied when its generation changes, see
+    `retriever.get_retriever.get_collection_generation`.
+
+    Parameters
+    ----------
+    max_size : int, optional
+        Maximum number of cached responses, by default 1000.
+    ttl_seconds : float, optional
+        Lifetime of a cached response, by default None (no expiry).
+    similarity_threshold : float, optional
+        Minimum cosine similarity between two queries to share a response, by
+        default 0.95. Set it above 1 to only match normalized queries.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 1000,
+        ttl_seconds: Optional[float] = None,
+        similarity_threshold: float = 0.95,
+    ):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        # (namespace, normalized query) -> response
+        self._entries: OrderedDict = OrderedDict()
+        self._generations = {}
+        self._lock = Lock()
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+    @property
+    def hit_ratio(self) -> float:
+        n_lookups = self.exact_hits + self.semantic_hits + self.misses
+        return (self.exact_hits + self.semantic_hits) / n_lookups if n_lookups else 0.0
+
+    def log_stats(self):
+        logger.info(
+            f"Response cache: {self.exact_hits} exact hits, {self.semantic_hits} "
+            f"semantic hits, {self.misses} misses (hit ratio {self.hit_ratio:.1%}), "
+            f"{self.saved_seconds:.1f}s saved."
+        )
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _invalidate(self, namespace: Optional[str]) -> None:
+        # called with the lock held
+        for key in list(self._entries):
+            if namespace is None or key[0] == namespace:
+                del self._entries[key]
+
+    def invalidate(self, namespace: Optional[str] = None) -> None:
+        """Drop the responses of `namespace`, or every response if None."""
+        with self._lock:
+            self._invalidate(namespace)
+
+    def check_generation(self, namespace: str, generation: int) -> None:
+        """Drop the responses of `namespace` if its collection changed since."""
+        with self._lock:
+            if self._generations.get(namespace, generation) != generation:
+                logger.info(
+                    f"Collection {namespace} changed, invalidating its responses."
+                )
+                self._invalidate(namespace)
+            self._generations[namespace] = generation
+
+    def _is_expired(self, entry: CachedResponse, now: float) -> bool:
+        return (
+            self.ttl_seconds is not None and now - entry.created_at > self.ttl_seconds
+        )
+
+    def get(
+        self, namespace: str, query: str, query_embedding: List[float]
+    ) -> Optional[CachedResponse]:
+        now = time.time()
+        key = (namespace, normalize_query(query))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._is_expired(entry, now):
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self.exact_hits += 1
+            else:
+                key, entry = self._most_similar(
+                    namespace, query_embedding, get_cited_articles(query), now
+                )
+                if entry is None:
+                    self.misses += 1
+                    return None
+                self.semantic_hits += 1
+            self._entries.move_to_end(key)
+            self.saved_seconds += entry.latency
+            return entry
+
+    def _most_similar(
+        self,
+        namespace: str,
+        query_embedding: List[float],
+        cited_articles: List[Tuple[str, Optional[str]]],
+        now: float,
+    ):
+        keys = [
+            key
+            for key, entry in self._entries.items()
+            if key[0] == namespace
+            and entry.cited_articles == cited_articles
+            and not self._is_expired(entry, now)
+        ]
+        if not keys or self.similarity_threshold > 1:
+            return None, None
+        query_vector = np.asarray(query_embedding, dtype=np.float32)
+        query_vector /= np.linalg.norm(query_vector) or 1
+        similarities = (
+            np.stack([self._entries[key].query_embedding for key in keys])
+            @ query_vector
+        )
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.similarity_threshold:
+            return None, None
+        return keys[best], self._entries[keys[best]]
+
+    def put(
+        self,
+        namespace: str,
+        query: str,
+        query_embedding: List[float],
+        response: RESPONSE_TYPE,
+        latency: float,
+    ) -> None:
+        query_vector = np.asarray(query_embedding, dtype=np.float32)
+        query_vector /= np.linalg.norm(query_vector) or 1
+        entry = CachedResponse(
+            response=response.response,
+            source_nodes=list(response.source_nodes),
+            query_embedding=query_vector,
+            cited_articles=get_cited_articles(query),
+            latency=latency,
+            created_at=time.time(),
+        )
+        with self._lock:
+            key = (namespace, normalize_query(query))
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+class CachedQueryEngine(BaseQueryEngine):
+    """
+    Query engine answering from a `SemanticResponseCache` when possible.
+
+    Parameters
+    ----------
+    query_engine : BaseQueryEngine
+        The engine answering the cache misses.
+    embed_model : BaseEmbedding
+        The embedding model of the engine, its query embeddings are computed once
+        and passed to `query_engine` in the query bundle.
+    response_cache : SemanticResponseCache
+        The cache, possibly shared by several engines.
+    namespace : str
+        The collection name and retrieval parameters of the engine, see
+        `query.query_engine.get_cache_namespace`.
+    get_generation : Callable[[], int], optional
+        Returns the current generation of the collection.
+    """
+
+    def __init__(
+        self,
+        query_engine: BaseQueryEngine,
+        embed_model: BaseEmbedding,
+        response_cache: SemanticResponseCache,
+        namespace: str,
+        get_generation: Optional[Callable[[], int]] = None,
+    ) -> None:
+        self._query_engine = query_engine
+        self._embed_model = embed_model
+        self._response_cache = response_cache
+        self._namespace = namespace
+        self._get_generation = get_generation
+        super().__init__(callback_manager=query_engine.callback_manager)
+
+    def _get_prompt_modules(self) -> PromptMixinType:
+        return {"query_engine": self._query_engine}
+
+    def _lookup(self, query_bundle: QueryBundle) -> Optional[Response]:
+        if self._get_generation is not None:
+            self._response_cache.check_generation(
+                self._namespace, self._get_generation()
+            )
+        entry = self._response_cache.get(
+            self._namespace, query_bundle.query_str, query_bundle.embedding
+        )
+        if entry is None:
+            return None
+        return Response(
+            response=entry.response,
+            source_nodes=entry.source_nodes,
+            metadata={"cached": True},
+        )
+
+    def _store(
+        self, query_bundle: QueryBundle, response: RESPONSE_TYPE, start: float
+    ) -> None:
+        self._response_cache.put(
+            self._namespace,
+            query_bundle.query_str,
+            query_bundle.embedding,
+            response,
+            latency=time.perf_counter() - start,
+        )
+
+    def _query(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
+        start = time.perf_counter()
+        if query_bundle.embedding is None:
+            query_bundle.embedding = self._embed_model.get_agg_embedding_from_queries(
+                query_bundle.embedding_strs
+            )
+        cached_response = self._lookup(query_bundle)
+        if cached_response is not None:
+            return cached_response
+        response = self._query_engine.query(query_bundle)
+        self._store(query_bundle, response, start)
+        return response
+
+    async def _aquery(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
+        start = time.perf_counter()
+        if query_bundle.embedding is None:
+            query_bundle.embedding = (
+                await self._embed_model.aget_agg_embedding_from_queries(
+                    query_bundle.embedding_strs
+                )
+            )
+        cached_response = self._lookup(query_bundle)
+        if cached_response is not None:
+            return cached_response
+        response = await self._query_engine.aquery(query_bundle)
+        self._store(query_bundle, response, start)
+        return response
@@ -1,8 +1,36 @@
+import inspect
+from functools import partial
+from typing import Callable, Dict, List, Optional
+
+from llama_index.core.base.base_query_engine import BaseQueryEngine
+from llama_index.core.base.base_selector import SelectorResult
+from llama_index.core.base.response.schema import RESPONSE_TYPE
+from llama_index.core.callbacks import CBEventType, EventPayload
 from llama_index.core.query_engine import RouterQueryEngine
+from llama_index.core.schema import QueryBundle
 from llama_index.core.selectors import LLMMultiSelector
 from llama_index.core.tools import QueryEngineTool
+from loguru import logger
+from qdrant_client import QdrantClient
 
-from query.query_engine import create_query_engine
+from data_ingestion.nodes_processing import CodeNodes
+from data_ingestion.preprocess_legifrance_data import fetch_codes
+from query.embedding_router import EmbeddingSimilaritySelector
+from query.lazy_engines import EngineCache, LazyQueryEngine, warm_up_in_background
+from query.query_engine import create_query_engine, register_query_engine_config
+from retriever.embeddings import get_embeddings
+from retriever.get_retriever import (
+    get_collection_centroid,
+    get_collection_name,
+    get_local_collection_centroid,
+    get_numpy_vector_store,
+)
+from schema import (
+    OpenAISupportedModels,
+    SparseIndexBackend,
+    VectorQuantization,
+    VectorStoreBackend,
+)
 
 
 codes_to_description = {
@@ -14,22 +42,273 @@ codes_to_description = {
 }
 
 
-def get_tools():
+def get_tools(engine_cache: EngineCache, **engine_kwargs):
+    """
+    Create one tool per code. The query engine of a code is only built the first
+    time the code is selected, and at most `engine_cache.max_resident_engines`
+    engines are kept in memory.
+    """
     tools = []
     for code_name, code_description in codes_to_description.items():
-        query_engine = create_query_engine(code_name=code_name)
+        query_engine = LazyQueryEngine(
+            key=code_name,
+            build_engine=partial(
+                create_query_engine, code_name=code_name, **engine_kwargs
+            ),
+            engine_cache=engine_cache,
+        )
         tool = QueryEngineTool.from_defaults(
             query_engine=query_engine,
+            name=code_name,
             description=code_description,
         )
         tools.append(tool)
     return tools
 
 
-def create_routing_engine():
-    query_engine_tools = get_tools()
-    query_engine = RouterQueryEngine(
-        selector=LLMMultiSelector.from_defaults(),
-        query_engine_tools=query_engine_tools,
+def get_code_centroids(
+    embedding_model: str,
+    vector_store_backend: VectorStoreBackend = VectorStoreBackend.QDRANT,
+    hybrid_search: bool = False,
+    use_window_nodes: bool = False,
+    nodes_window_size: int = 3,
+    query_time_window: bool = False,
+    max_tokens_per_node: Optional[int] = None,
+    chunk_overlap_tokens: int = 0,
+    sparse_index: SparseIndexBackend = SparseIndexBackend.BM25,
+    embedding_dimensions: Optional[int] = None,
+    vector_quantization: VectorQuantization = VectorQuantization.NONE,
+    vectors_dtype: str = "float32",
+    rescore_oversampling: float = 2.0,
+    shared_collection: bool = False,
+) -> Dict[str, List[float]]:
+    """
+    Mean embedding of the indexed nodes of each code, for the codes already indexed.
+    The parameters are the ones of `create_query_engine`, which give the collections
+    of the codes.
+    """
+    local = VectorStoreBackend(vector_store_backend) == VectorStoreBackend.NUMPY
+    client = None if local else QdrantClient("localhost", port=6333)
+    centroids = {}
+    for code_name in codes_to_description:
+        code_nodes = CodeNodes(
+            code_name=code_name,
+            use_window_nodes=use_window_nodes,
+            nodes_window_size=nodes_window_size,
+            embedding_model_name=embedding_model,
+            max_tokens_per_node=max_tokens_per_node,
+            chunk_overlap_tokens=chunk_overlap_tokens,
+            query_time_window=query_time_window,
+        )
+        collection_name = get_collection_name(
+            code_nodes,
+            embedding_model,
+            hybrid_search,
+            sparse_index,
+            embedding_dimensions=embedding_dimensions,
+            vector_quantization=vector_quantization,
+            shared_collection=shared_collection,
+        )
+        shared_code_name = code_name if shared_collection else None
+        if local:
+            centroid = get_local_collection_centroid(
+                get_numpy_vector_store(
+                    collection_name,
+                    shared_collection,
+                    vectors_dtype,
+                    vector_quantization,
+                    rescore_oversampling,
+                ),
+                code_name=shared_code_name,
+            )
+        else:
+            centroid = get_collection_centroid(
+                client, collection_name, code_name=shared_code_name
+            )
+        if centroid is not None:
+            centroids[code_name] = centroid
+    return centroids
+
+
+class SharedCollectionRouterQueryEngine(RouterQueryEngine):
+    """
+    Router over the codes indexed in a shared collection. A query selecting several
+    codes is answered from one search of the collection filtered on these codes,
+    instead of one search and one response by code summarized together. The
+    `similarity_top_k` nodes of this search are then the best ones of all the
+    selected codes.
+
+    The engines of the combinations of codes are built by `build_engine` with the
+    `code_names` argument, and kept in `engine_cache` with the ones of the codes.
+    """
+
+    def __init__(
+        self,
+        selector,
+        query_engine_tools: List[QueryEngineTool],
+        engine_cache: EngineCache,
+        build_engine: Callable[..., BaseQueryEngine],
+        **kwargs,
+    ) -> None:
+        super().__init__(
+            selector=selector, query_engine_tools=query_engine_tools, **kwargs
+        )
+        self._engine_cache = engine_cache
+        self._build_engine = build_engine
+
+    def _get_selected_engine(self, result: SelectorResult) -> LazyQueryEngine:
+        # the engines of the tools are the lazy engines of `get_tools`
+        if len(result.inds) == 1:
+            return self._query_engines[result.ind]
+        code_names = [self._metadatas[ind].name for ind in sorted(result.inds)]
+        return LazyQueryEngine(
+            key=" + ".join(code_names),
+            build_engine=partial(self._build_engine, code_names=code_names),
+            engine_cache=self._engine_cache,
+        )
+
+    def _add_selector_result(
+        self, result: SelectorResult, response: RESPONSE_TYPE
+    ) -> RESPONSE_TYPE:
+        response.metadata = response.metadata or {}
+        response.metadata["selector_result"] = result
+        return response
+
+    def _query(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
+        with self.callback_manager.event(
+            CBEventType.QUERY, payload={EventPayload.QUERY_STR: query_bundle.query_str}
+        ) as query_event:
+            result = self._selector.select(self._metadatas, query_bundle)
+            engine = self._get_selected_engine(result)
+            logger.info(f"Selecting query engine {engine.key}: {result.reasons}.")
+            response = self._add_selector_result(result, engine.query(query_bundle))
+            query_event.on_end(payload={EventPayload.RESPONSE: response})
+        return response
+
+    async def _aquery(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
+        with self.callback_manager.event(
+            CBEventType.QUERY, payload={EventPayload.QUERY_STR: query_bundle.query_str}
+        ) as query_event:
+            result = await self._selector.aselect(self._metadatas, query_bundle)
+            engine = self._get_selected_engine(result)
+            logger.info(f"Selecting query engine {engine.key}: {result.reasons}.")
+            response = self._add_selector_result(
+                result, await engine.aquery(query_bundle)
+            )
+            query_event.on_end(payload={EventPayload.RESPONSE: response})
+        return response
+
+
+def create_routing_engine(
+    max_resident_engines: int = 3,
+    warm_up_codes: Optional[List[str]] = None,
+    prefetch_data: bool = False,
+    use_embedding_router: bool = True,
+    router_margin_threshold: float = 0.05,
+    use_centroids: bool = False,
+    **engine_kwargs,
+):
+    """
+    Create a router over the query engines of every code in `codes_to_description`.
+
+    Parameters
+    ----------
+
+    max_resident_engines : int, optional
+        The maximum number of code query engines kept in memory, the least recently
+        used one is dropped beyond that, by default 3
+
+    warm_up_codes : List[str], optional
+        Codes whose query engine is built in a background thread right away instead
+        of on their first selection, by default None
+
+    prefetch_data : bool, optional
+        Whether to fetch the codes that are not saved yet from Legifrance in the
+        background thread before building the warm-up engines, which needs the
+        Legifrance API keys, by default False
+
+    use_embedding_router : bool, optional
+        Whether to select the codes by embedding similarity between the query and
+        the code descriptions, only calling the LLM selector when the two best codes
+        are too close, by default True
+
+    router_margin_threshold : float, optional
+        The minimum similarity margin between the two best codes to skip the LLM
+        selector, by default 0.05
+
+    use_centroids : bool, optional
+        Whether to also score the codes against the mean embedding of their indexed
+        nodes. Only used when every code is already indexed, by default False
+
+    engine_kwargs :
+        Passed to `create_query_engine` for every code. With `shared_collection`,
+        the queries selecting several codes are answered from one search of the
+        shared collection, see `SharedCollectionRouterQueryEngine`, unless the
+        hybrid search uses the per-code BM25 indexes.
+    """
+    router_parameters = {
+        "use_embedding_router": use_embedding_router,
+        "router_margin_threshold": router_margin_threshold,
+        "use_centroids": use_centroids,
+    }
+    engine_cache = EngineCache(max_resident_engines=max_resident_engines)
+    query_engine_tools = get_tools(engine_cache, **engine_kwargs)
+    selector = LLMMultiSelector.from_defaults()
+    if use_embedding_router:
+        embedding_model = engine_kwargs.get(
+            "embedding_model", OpenAISupportedModels.ADA.value
+        )
+        # the centroids of the collections have their number of dimensions
+        embedding_dimensions = engine_kwargs.get("embedding_dimensions")
+        centroids = None
+        if use_centroids:
+            centroid_parameters = inspect.signature(get_code_centroids).parameters
+            centroid_kwargs = {
+                name: value
+                for name, value in engine_kwargs.items()
+                if name in centroid_parameters
+            }
+            # the default model of the engines when not in `engine_kwargs`
+            centroid_kwargs["embedding_model"] = embedding_model
+            centroids = get_code_centroids(**centroid_kwargs)
+        selector = EmbeddingSimilaritySelector(
+            embed_model=get_embeddings(
+                embedding_model, dimensions=embedding_dimensions
+            ),
+            fallback_selector=selector,
+            margin_threshold=router_margin_threshold,
+            centroids=centroids,
+        )
+    bm25_hybrid_search = engine_kwargs.get("hybrid_search", False) and (
+        SparseIndexBackend(engine_kwargs.get("sparse_index", SparseIndexBackend.BM25))
+        == SparseIndexBackend.BM25
+    )
+    if engine_kwargs.get("shared_collection", False) and not bm25_hybrid_search:
+        query_engine = SharedCollectionRouterQueryEngine(
+            selector=selector,
+            query_engine_tools=query_engine_tools,
+            engine_cache=engine_cache,
+            build_engine=partial(create_query_engine, **engine_kwargs),
+        )
+    else:
+        query_engine = RouterQueryEngine(
+            selector=selector,
+            query_engine_tools=query_engine_tools,
+        )
+
+    if warm_up_codes or prefetch_data:
+        code_names = list(codes_to_description)
+        warm_up_in_background(
+            [
+                tool.query_engine
+                for code_name, tool in zip(code_names, query_engine_tools)
+                if code_name in (warm_up_codes or [])
+            ],
+            # fetch the codes that are not saved yet concurrently rather than one
+            # by one when each query engine is built
+            before=partial(fetch_codes, code_names) if prefetch_data else None,
+        )
+    register_query_engine_config(
+        query_engine, {"router": router_parameters, **engine_kwargs}
     )
     return query_engine
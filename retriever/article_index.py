@@ -0,0 +1,129 @@
+import json
+import os
+import re
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from llama_index.core.schema import BaseNode
+from loguru import logger
+
+from data_ingestion.nodes_processing import CODE_NAME_METADATA_KEY
+from .constants import path_dir_article_index
+
+ARTICLE_NUMBER_METADATA_KEY = "Article numero"
+
+
+def get_article_index_path(collection_name: str) -> str:
+    return os.path.join(path_dir_article_index, f"{collection_name}.json")
+
+
+def normalize_article_number(article_number: str) -> str:
+    """Remove the spaces and dots of an article number: "L. 121-1" is "L121-1"."""
+    return re.sub(r"[\s.]", "", article_number).upper()
+
+
+def get_article_sort_key(article_number: str) -> Tuple[str, Tuple[int, ...]]:
+    """Order of the articles in the code: "L121-2" < "L121-10" < "L122"."""
+    prefix, numbers = re.match(r"([A-Z]*)(.*)", article_number).groups()
+    return prefix, tuple(int(number) for number in re.findall(r"\d+", numbers))
+
+
+class ArticleIndex:
+    """
+    Map the article numbers of a code to the ids of their nodes. The numbers are
+    sorted in the order of the code, so that ranges of articles can be resolved.
+    """
+
+    def __init__(self, code_name: str, articles: Dict[str, List[str]]):
+        self.code_name = code_name
+        self.articles = articles
+        self.article_numbers = sorted(articles, key=get_article_sort_key)
+        self.positions = {
+            article_number: position
+            for position, article_number in enumerate(self.article_numbers)
+        }
+
+    @classmethod
+    def from_nodes(cls, nodes: Iterable[BaseNode]) -> "ArticleIndex":
+        builder = ArticleIndexBuilder()
+        for node in nodes:
+            builder.add(node)
+        return builder.build()
+
+    @classmethod
+    def load(cls, path: str) -> "ArticleIndex":
+        with open(path) as f:
+            data = json.load(f)
+        return cls(data["code_name"], dict(data["articles"]))
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {"code_name": self.code_name, "articles": list(self.articles.items())},
+                f,
+                ensure_ascii=False,
+            )
+        os.replace(tmp_path, path)
+
+    def get_node_ids(
+        self, first_article: str, last_article: Optional[str] = None
+    ) -> Optional[List[str]]:
+        """
+        The node ids of an article, or of the articles from `first_article` to
+        `last_article` included. None if one of the articles is not in the code.
+        """
+        first = self.positions.get(normalize_article_number(first_article))
+        last = first
+        if last_article is not None:
+            last = self.positions.get(normalize_article_number(last_article))
+        if first is None or last is None or last < first:
+            return None
+        return [
+            node_id
+            for article_number in self.article_numbers[first : last + 1]
+            for node_id in self.articles[article_number]
+        ]
+
+
+class ArticleIndexBuilder:
+    """Build an `ArticleIndex` one node at a time, e.g. from a stream of nodes."""
+
+    def __init__(self):
+        self.code_name = None
+        self.articles: Dict[str, List[str]] = {}
+
+    def add(self, node: BaseNode):
+        self.code_name = node.metadata.get(CODE_NAME_METADATA_KEY, self.code_name)
+        article_number = normalize_article_number(
+            node.metadata[ARTICLE_NUMBER_METADATA_KEY]
+        )
+        # the chunks of a long article share its number
+        self.articles.setdefault(article_number, []).append(node.node_id)
+
+    def build(self) -> ArticleIndex:
+        return ArticleIndex(self.code_name, self.articles)
+
+
+def build_article_index(
+    collection_name: str, nodes: Iterable[BaseNode] | ArticleIndexBuilder
+) -> ArticleIndex:
+    """Build the article index of `nodes`, or of the nodes added to the builder,
+    and save it."""
+    if isinstance(nodes, ArticleIndexBuilder):
+        article_index = nodes.build()
+    else:
+        article_index = ArticleIndex.from_nodes(nodes)
+    article_index.save(get_article_index_path(collection_name))
+    logger.info(
+        f"Article index of {collection_name} built with "
+        f"{len(article_index.articles)} articles."
+    )
+    return article_index
+
+
+def load_article_index(collection_name: str) -> Optional[ArticleIndex]:
+    path = get_article_index_path(collection_name)
+    if not os.path.exists(path):
+        return None
+    return ArticleIndex.load(path)
@@ -0,0 +1,304 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import unicodedata
+from collections import Counter
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from llama_index.core.schema import BaseNode, MetadataMode
+from loguru import logger
+
+from data_ingestion.nodes_processing import PAYLOAD_HASH_METADATA_KEY
+
+from .constants import path_dir_bm25
+
+META_FILE_NAME = "meta.json"
+VOCABULARY_FILE_NAME = "vocabulary.json"
+NODE_IDS_FILE_NAME = "node_ids.txt"
+# start of the postings of every term in the postings arrays, plus the total length
+TERM_OFFSETS_FILE_NAME = "term_offsets.npy"
+POSTINGS_DOCS_FILE_NAME = "postings_docs.npy"
+# BM25 weight of the term in the document, so that a query is only a sum
+POSTINGS_WEIGHTS_FILE_NAME = "postings_weights.npy"
+
+ELISION_PATTERN = re.compile(r"\b(?:[cdjlmnst]|qu|jusqu|lorsqu|puisqu)['’]")
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+# accent-folded, as they are compared to folded tokens
+FRENCH_STOPWORDS = frozenset("""
+    a ai au aux avec ce ces cet cette dans de des du elle elles en est et etre eu
+    il ils je la le les leur leurs lui ma mais me meme mes moi mon ne nos notre nous
+    on ont ou par pas pour qu que qui sa se ses si son sont sur ta te tes toi ton tu
+    un une vos votre vous y sans sous entre dont lorsque puis donc ni or car
+    cela celui celle ceux celles ceci aussi tout tous toute toutes autre autres
+    """.split())
+
+
+def get_bm25_dir(collection_name: str) -> str:
+    return os.path.join(path_dir_bm25, collection_name)
+
+
+def fold_accents(text: str) -> str:
+    text = text.replace("œ", "oe").replace("æ", "ae")
+    return "".join(
+        char
+        for char in unicodedata.normalize("NFKD", text)
+        if not unicodedata.combining(char)
+    )
+
+
+def stem_french(token: str) -> str:
+    """
+    Light French stemmer, after Lucene's `FrenchMinimalStemmer`: only the plural
+    and feminine endings are removed, so that different words rarely collide.
+    """
+    if len(token) < 6:
+        return token
+    if token.endswith("x"):
+        if token.endswith("aux"):
+            return token[:-3] + "al"
+        return token[:-1]
+    # the second "e" stands for the "é" of the original, folded by the tokenizer
+    for ending in "sree":
+        if token.endswith(ending):
+            token = token[:-1]
+    if len(token) > 2 and token[-1] == token[-2] and token[-1].isalpha():
+        token = token[:-1]
+    return token
+
+
+def tokenize_french(text: str) -> List[str]:
+    """Lowercase, split the elisions, fold the accents, drop the stopwords and stem."""
+    text = fold_accents(ELISION_PATTERN.sub(" ", text.lower()))
+    return [
+        stem_french(token)
+        for token in TOKEN_PATTERN.findall(text)
+        if token not in FRENCH_STOPWORDS
+    ]
+
+
+def get_bm25_text(node: BaseNode) -> str:
+    # the embedded text: the article with its code, headers and number
+    return node.get_content(metadata_mode=MetadataMode.EMBED)
+
+
+def get_node_key(node: BaseNode) -> str:
+    return f"{node.node_id}:{node.metadata.get(PAYLOAD_HASH_METADATA_KEY)}"
+
+
+def get_nodes_fingerprint(node_keys: Iterable[str]) -> str:
+    return hashlib.sha256("\n".join(sorted(node_keys)).encode("utf-8")).hexdigest()
+
+
+class BM25Index:
+    """
+    BM25 index of the nodes of a collection, stored on disk as an inverted index.
+
+    The postings of each term are contiguous in two arrays, the documents and their
+    precomputed BM25 weight, and the arrays are memory-mapped when the index is
+    loaded. A query is therefore a `bincount` over the postings of its terms.
+    """
+
+    def __init__(self, index_dir: str):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, META_FILE_NAME)) as f:
+            self.meta = json.load(f)
+        with open(os.path.join(index_dir, VOCABULARY_FILE_NAME)) as f:
+            self.vocabulary: Dict[str, int] = {
+                term: term_id for term_id, term in enumerate(json.load(f))
+            }
+        with open(os.path.join(index_dir, NODE_IDS_FILE_NAME)) as f:
+            self.node_ids = f.read().splitlines()
+        self.term_offsets = np.load(os.path.join(index_dir, TERM_OFFSETS_FILE_NAME))
+        self.postings_docs = np.load(
+            os.path.join(index_dir, POSTINGS_DOCS_FILE_NAME), mmap_mode="r"
+        )
+        self.postings_weights = np.load(
+            os.path.join(index_dir, POSTINGS_WEIGHTS_FILE_NAME), mmap_mode="r"
+        )
+
+    @property
+    def fingerprint(self) -> str:
+        return self.meta["fingerprint"]
+
+    @classmethod
+    def build(
+        cls,
+        nodes: Iterable[BaseNode],
+        index_dir: str,
+        k1: float = 1.2,
+        b: float = 0.75,
+    ) -> "BM25Index":
+        """Build the index of `nodes` in `index_dir`, replacing any existing index."""
+        builder = BM25IndexBuilder()
+        for node in nodes:
+            builder.add(node)
+        return builder.build(index_dir, k1=k1, b=b)
+
+    def get_doc_mask(self, node_ids: Iterable[str]) -> np.ndarray:
+        """Boolean mask of the documents of `node_ids`, for `query`."""
+        node_ids = set(node_ids)
+        return np.fromiter(
+            (node_id in node_ids for node_id in self.node_ids),
+            dtype=bool,
+            count=len(self.node_ids),
+        )
+
+    def query(
+        self, query_str: str, top_k: int, doc_mask: Optional[np.ndarray] = None
+    ) -> List[Tuple[str, float]]:
+        """
+        The ids and BM25 scores of the `top_k` best matching nodes, among the
+        documents of `doc_mask` if given.
+        """
+        term_ids = {
+            self.vocabulary[token]
+            for token in tokenize_french(query_str)
+            if token in self.vocabulary
+        }
+        if not term_ids or top_k <= 0:
+            return []
+        slices = [
+            slice(self.term_offsets[term_id], self.term_offsets[term_id + 1])
+            for term_id in term_ids
+        ]
+        scores = np.bincount(
+            np.concatenate([self.postings_docs[s] for s in slices]),
+            weights=np.concatenate([self.postings_weights[s] for s in slices]),
+            minlength=len(self.node_ids),
+        )
+        if doc_mask is not None:
+            scores[~doc_mask] = 0
+        top_k = min(top_k, int(np.count_nonzero(scores)))
+        if top_k == 0:
+            return []
+        top_docs = np.argpartition(-scores, top_k - 1)[:top_k]
+        top_docs = top_docs[np.argsort(-scores[top_docs])]
+        return [(self.node_ids[doc], float(scores[doc])) for doc in top_docs]
+
+
+def bm25_index_exists(collection_name: str) -> bool:
+    return os.path.exists(os.path.join(get_bm25_dir(collection_name), META_FILE_NAME))
+
+
+class BM25IndexBuilder:
+    """Tokenize nodes one at a time, e.g. from a stream of nodes, and write the
+    `BM25Index` of all of them at the end."""
+
+    def __init__(self):
+        self.vocabulary: Dict[str, int] = {}
+        self.node_ids, self.node_keys, self.doc_lengths = [], [], []
+        self.docs, self.terms, self.frequencies = [], [], []
+
+    @property
+    def fingerprint(self) -> str:
+        return get_nodes_fingerprint(self.node_keys)
+
+    def add(self, node: BaseNode):
+        doc = len(self.node_ids)
+        tokens = tokenize_french(get_bm25_text(node))
+        self.node_ids.append(node.node_id)
+        self.node_keys.append(get_node_key(node))
+        self.doc_lengths.append(len(tokens))
+        for token, frequency in Counter(tokens).items():
+            self.docs.append(doc)
+            self.terms.append(self.vocabulary.setdefault(token, len(self.vocabulary)))
+            self.frequencies.append(frequency)
+
+    def build(self, index_dir: str, k1: float = 1.2, b: float = 0.75) -> BM25Index:
+        """Write the index in `index_dir`, replacing any existing index."""
+        docs = np.asarray(self.docs, dtype=np.int32)
+        terms = np.asarray(self.terms, dtype=np.int32)
+        frequencies = np.asarray(self.frequencies, dtype=np.float32)
+        doc_lengths = np.asarray(self.doc_lengths, dtype=np.float32)
+
+        n_docs = len(self.node_ids)
+        document_frequencies = np.bincount(terms, minlength=len(self.vocabulary))
+        idf = np.log1p(
+            (n_docs - document_frequencies + 0.5) / (document_frequencies + 0.5)
+        ).astype(np.float32)
+        length_norm = 1 - b + b * doc_lengths / max(doc_lengths.mean(), 1)
+        weights = (
+            idf[terms] * frequencies * (k1 + 1) / (frequencies + k1 * length_norm[docs])
+        )
+
+        order = np.argsort(terms, kind="stable")
+        term_offsets = np.zeros(len(self.vocabulary) + 1, dtype=np.int64)
+        np.cumsum(document_frequencies, out=term_offsets[1:])
+
+        tmp_dir = index_dir.rstrip("/") + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        np.save(os.path.join(tmp_dir, TERM_OFFSETS_FILE_NAME), term_offsets)
+        np.save(os.path.join(tmp_dir, POSTINGS_DOCS_FILE_NAME), docs[order])
+        np.save(
+            os.path.join(tmp_dir, POSTINGS_WEIGHTS_FILE_NAME),
+            weights[order].astype(np.float32),
+        )
+        with open(os.path.join(tmp_dir, VOCABULARY_FILE_NAME), "w") as f:
+            json.dump(list(self.vocabulary), f, ensure_ascii=False)
+        with open(os.path.join(tmp_dir, NODE_IDS_FILE_NAME), "w") as f:
+            f.write("\n".join(self.node_ids))
+        with open(os.path.join(tmp_dir, META_FILE_NAME), "w") as f:
+            json.dump(
+                {
+                    "k1": k1,
+                    "b": b,
+                    "n_docs": n_docs,
+                    "n_terms": len(self.vocabulary),
+                    "fingerprint": self.fingerprint,
+                },
+                f,
+            )
+        shutil.rmtree(index_dir, ignore_errors=True)
+        os.replace(tmp_dir, index_dir)
+        return BM25Index(index_dir)
+
+
+def load_bm25_index(collection_name: str) -> Optional[BM25Index]:
+    if not bm25_index_exists(collection_name):
+        return None
+    return BM25Index(get_bm25_dir(collection_name))
+
+
+def update_bm25_index(
+    collection_name: str, get_nodes: Callable[[], Iterable[BaseNode]]
+) -> BM25Index:
+    """
+    Load the BM25 index of the collection, and build it first if it does not exist
+    or was built from other nodes, as told by the ids and payload hashes of the
+    nodes. `get_nodes` is called once to check the index and once more to build it,
+    so that it can stream the nodes.
+    """
+    bm25_index = load_bm25_index(collection_name)
+    if bm25_index is not None and bm25_index.fingerprint == get_nodes_fingerprint(
+        get_node_key(node) for node in get_nodes()
+    ):
+        return bm25_index
+
+    logger.info(f"Building the BM25 index of {collection_name} ...")
+    bm25_index = BM25Index.build(get_nodes(), get_bm25_dir(collection_name))
+    logger.info(
+        f"BM25 index built with {bm25_index.meta['n_docs']} nodes and "
+        f"{bm25_index.meta['n_terms']} terms."
+    )
+    return bm25_index
+
+
+def save_bm25_index(collection_name: str, builder: BM25IndexBuilder) -> BM25Index:
+    """Same as `update_bm25_index`, for nodes already tokenized by `builder` while
+    they were streamed to the vector store."""
+    bm25_index = load_bm25_index(collection_name)
+    if bm25_index is not None and bm25_index.fingerprint == builder.fingerprint:
+        return bm25_index
+
+    logger.info(f"Building the BM25 index of {collection_name} ...")
+    bm25_index = builder.build(get_bm25_dir(collection_name))
+    logger.info(
+        f"BM25 index built with {bm25_index.meta['n_docs']} nodes and "
+        f"{bm25_index.meta['n_terms']} terms."
+    )
+    return bm25_index
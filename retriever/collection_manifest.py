@@ -0,0 +1,121 @@
+"""
+Manifests of the collections: for every code indexed in a collection, a fingerprint
+of everything its points were built from, and the number of points, recorded once
+the collection is up to date.
+
+While the fingerprint of a code matches, its engine attaches to the collection
+without loading, chunking and hashing the articles of the code, and without
+rebuilding the article index, hierarchy and BM25 index built alongside the points.
+The fingerprint covers the source data file (size and modification time, as for the
+article store), the chunking parameters, the window settings and the parameters of
+the index, embedding model included.
+"""
+
+import json
+import os
+from threading import Lock
+from typing import Optional
+
+from data_ingestion.article_store import get_source_signature
+from data_ingestion.nodes_processing import CodeNodes
+from schema import VectorStoreBackend
+from utils import hash_text, load_json, save_json
+
+from .constants import path_dir_manifests
+
+# to be incremented whenever the same data and parameters give other nodes
+MANIFEST_FORMAT_VERSION = 1
+
+# the engines of the codes of a shared collection write to the same manifest
+_manifests_lock = Lock()
+
+
+def get_manifest_path(
+    collection_name: str, vector_store_backend: VectorStoreBackend
+) -> str:
+    backend = VectorStoreBackend(vector_store_backend).value
+    return os.path.join(path_dir_manifests, backend, f"{collection_name}.json")
+
+
+def get_code_fingerprint(
+    code_nodes: CodeNodes, index_parameters: dict
+) -> Optional[str]:
+    """
+    Fingerprint of the points of a code, None when the source data of the code is
+    not on disk. `index_parameters` are the other parameters the points, or the
+    data built alongside them, depend on.
+    """
+    source = get_source_signature(code_nodes.code_name)
+    if source is None:
+        return None
+    parameters = {
+        "version": MANIFEST_FORMAT_VERSION,
+        "source": source,
+        "code_name": code_nodes.code_name,
+        "nodes_config": code_nodes.nodes_config,
+        "chunking_config": code_nodes.chunking_config,
+        # the windows rebuilt at query time are not stored in the points
+        "stores_windows": code_nodes.stores_windows,
+        "nodes_window_size": (
+            code_nodes.nodes_window_size if code_nodes.stores_windows else None
+        ),
+        **index_parameters,
+    }
+    return hash_text(json.dumps(parameters, sort_keys=True))
+
+
+def load_manifest(
+    collection_name: str, vector_store_backend: VectorStoreBackend
+) -> dict:
+    path = get_manifest_path(collection_name, vector_store_backend)
+    if not os.path.exists(path):
+        return {}
+    return load_json(path)
+
+
+def get_manifest_entry(
+    collection_name: str, vector_store_backend: VectorStoreBackend, code_name: str
+) -> Optional[dict]:
+    return load_manifest(collection_name, vector_store_backend).get(code_name)
+
+
+def _update_manifest(
+    collection_name: str,
+    vector_store_backend: VectorStoreBackend,
+    code_name: str,
+    entry: Optional[dict],
+):
+    path = get_manifest_path(collection_name, vector_store_backend)
+    with _manifests_lock:
+        manifest = load_manifest(collection_name, vector_store_backend)
+        if entry is None and code_name not in manifest:
+            return
+        if entry is None:
+            del manifest[code_name]
+        else:
+            manifest[code_name] = entry
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        save_json(manifest, path)
+
+
+def save_manifest_entry(
+    collection_name: str,
+    vector_store_backend: VectorStoreBackend,
+    code_name: str,
+    fingerprint: str,
+    n_points: int,
+):
+    _update_manifest(
+        collection_name,
+        vector_store_backend,
+        code_name,
+        {"fingerprint": fingerprint, "n_points": n_points},
+    )
+
+
+def delete_manifest_entry(
+    collection_name: str, vector_store_backend: VectorStoreBackend, code_name: str
+):
+    """Invalidate the entry of a code before its points are modified, so that an
+    interrupted indexing is never mistaken for an up-to-date collection."""
+    _update_manifest(collection_name, vector_store_backend, code_name, None)
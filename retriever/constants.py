@@ -0,0 +1,7 @@
+path_dir_embeddings_cache = "./data/embeddings_cache"
+path_dir_vector_stores = "./data/vector_stores"
+path_dir_bm25 = "./data/bm25"
+path_dir_article_index = "./data/article_index"
+path_dir_hierarchy = "./data/hierarchy"
+path_dir_fastembed_cache = "./data/fastembed_cache"
+path_dir_manifests = "./data/manifests"
@@ -0,0 +1,187 @@
+import json
+import os
+import threading
+from typing import List, Optional, Sequence
+
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.schema import BaseNode, MetadataMode
+from loguru import logger
+
+from utils import hash_text
+from .constants import path_dir_embeddings_cache
+
+VECTORS_FILE_NAME = "vectors.f32"
+KEYS_FILE_NAME = "keys.txt"
+META_FILE_NAME = "meta.json"
+
+
+def get_cache_namespace(embed_model: BaseEmbedding) -> str:
+    """Name under which the embeddings of a model are cached.
+
+    Models that can truncate their output (like the OpenAI v3 models with
+    `dimensions`) produce different vectors for the same text, so the number of
+    dimensions is part of the namespace.
+    """
+    namespace = embed_model.model_name
+    dimensions = getattr(embed_model, "dimensions", None)
+    if dimensions:
+        namespace += f"_d{dimensions}"
+    return namespace.replace("/", "_")
+
+
+class EmbeddingCache:
+    """
+    Content-addressed embedding cache persisted on disk.
+
+    The vectors of one embedding model are stored as rows of a float32 matrix in
+    `vectors.f32`, which is memory-mapped for reads and only ever appended to.
+    `keys.txt` holds the sha256 of the embedded text of each row, line `i`
+    corresponding to row `i`.
+
+    Parameters
+    ----------
+    namespace : str
+        Usually the embedding model name, see `get_cache_namespace`.
+    cache_dir : str, optional
+        Root directory of the cache, by default `./data/embeddings_cache`.
+    """
+
+    def __init__(self, namespace: str, cache_dir: str = path_dir_embeddings_cache):
+        self.namespace = namespace
+        self.dir_path = os.path.join(cache_dir, namespace)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._dim: Optional[int] = None
+        self._key_to_row: dict = {}
+        self._vectors: Optional[np.memmap] = None
+        self._load()
+
+    @property
+    def _vectors_path(self) -> str:
+        return os.path.join(self.dir_path, VECTORS_FILE_NAME)
+
+    @property
+    def _keys_path(self) -> str:
+        return os.path.join(self.dir_path, KEYS_FILE_NAME)
+
+    @property
+    def _meta_path(self) -> str:
+        return os.path.join(self.dir_path, META_FILE_NAME)
+
+    def __len__(self) -> int:
+        return len(self._key_to_row)
+
+    def _load(self):
+        if not os.path.exists(self._meta_path):
+            return
+        with open(self._meta_path, "r") as js:
+            self._dim = json.load(js)["dim"]
+        keys = []
+        if os.path.exists(self._keys_path):
+            with open(self._keys_path, "r") as f:
+                # a torn last line has no line break
+                keys = f.read().split("\n")[:-1]
+        vectors_size = (
+            os.path.getsize(self._vectors_path)
+            if os.path.exists(self._vectors_path)
+            else 0
+        )
+        # vectors are written before keys, so a crash can only leave extra rows and
+        # a torn key, which are dropped so that the next rows are appended at the
+        # offsets of their keys
+        keys = keys[: min(len(keys), vectors_size // (4 * self._dim))]
+        self._truncate(self._keys_path, sum(len(key) + 1 for key in keys))
+        self._truncate(self._vectors_path, len(keys) * 4 * self._dim)
+        self._key_to_row = {key: row for row, key in enumerate(keys)}
+        self._map_vectors()
+
+    @staticmethod
+    def _truncate(path: str, size: int):
+        if os.path.exists(path) and os.path.getsize(path) > size:
+            with open(path, "r+b") as f:
+                f.truncate(size)
+
+    def _map_vectors(self):
+        n_rows = len(self._key_to_row)
+        if n_rows == 0:
+            self._vectors = None
+            return
+        self._vectors = np.memmap(
+            self._vectors_path, dtype=np.float32, mode="r", shape=(n_rows, self._dim)
+        )
+
+    def get_many(self, texts: Sequence[str]) -> List[Optional[List[float]]]:
+        keys = [hash_text(text) for text in texts]
+        embeddings = []
+        # `put_many` adds keys whose rows are only in the next map of the vectors
+        with self._lock:
+            for key in keys:
+                row = self._key_to_row.get(key)
+                if row is None:
+                    self.misses += 1
+                    embeddings.append(None)
+                else:
+                    self.hits += 1
+                    embeddings.append(self._vectors[row].tolist())
+        return embeddings
+
+    def put_many(self, texts: Sequence[str], embeddings: Sequence[List[float]]):
+        with self._lock:
+            new_keys, new_rows = {}, []
+            for text, embedding in zip(texts, embeddings):
+                key = hash_text(text)
+                if key in self._key_to_row or key in new_keys:
+                    continue
+                new_keys[key] = len(new_rows)
+                new_rows.append(embedding)
+            if not new_keys:
+                return
+
+            matrix = np.asarray(new_rows, dtype=np.float32)
+            if self._dim is None:
+                self._dim = matrix.shape[1]
+                os.makedirs(self.dir_path, exist_ok=True)
+                with open(self._meta_path, "w") as js:
+                    json.dump({"namespace": self.namespace, "dim": self._dim}, js)
+            with open(self._vectors_path, "ab") as f:
+                f.write(matrix.tobytes())
+            with open(self._keys_path, "a") as f:
+                f.write("".join(key + "\n" for key in new_keys))
+
+            n_rows = len(self._key_to_row)
+            for key, i in new_keys.items():
+                self._key_to_row[key] = n_rows + i
+            self._map_vectors()
+
+    def log_stats(self):
+        logger.info(
+            f"Embedding cache `{self.namespace}`: {self.hits} hits, {self.misses} misses."
+        )
+
+
+def embed_nodes_with_cache(
+    nodes: Sequence[BaseNode],
+    embed_model: BaseEmbedding,
+    cache: EmbeddingCache,
+    show_progress: bool = False,
+) -> None:
+    """
+    Set `node.embedding` for every node, only calling the embedding provider for
+    texts that are not in the cache. The new embeddings are added to the cache.
+    """
+    texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+    cached_embeddings = cache.get_many(texts)
+
+    missing_ids = [i for i, emb in enumerate(cached_embeddings) if emb is None]
+    missing_texts = [texts[i] for i in missing_ids]
+    new_embeddings = embed_model.get_text_embedding_batch(
+        missing_texts, show_progress=show_progress
+    )
+    cache.put_many(missing_texts, new_embeddings)
+
+    for i, embedding in zip(missing_ids, new_embeddings):
+        cached_embeddings[i] = embedding
+    for node, embedding in zip(nodes, cached_embeddings):
+        node.embedding = embedding
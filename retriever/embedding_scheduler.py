@@ -0,0 +1,576 @@
+import asyncio
+import math
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Any, Callable, Deque, List, Optional, Sequence
+
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.callbacks import CBEventType, EventPayload
+from loguru import logger
+from tqdm import tqdm
+
+from data_ingestion.chunking import get_token_counter
+from schema import HASHING_EMBEDDING_PREFIX, MistralSupportedModels
+
+# seconds of budget that can be spent at once after an idle period, the providers
+# enforce their per-minute limits over shorter periods
+BURST_SECONDS = 1.0
+# a batch spends at most these seconds of the tokens budget, the providers count the
+# tokens of a request when it arrives while the scheduler pays for them before
+BATCH_BUDGET_SECONDS = 3.0
+# the refill rate of the budgets is multiplied by this factor on every rate-limit
+# error, and recovers by this step on every successful request
+RATE_DECREASE_FACTOR = 0.7
+RATE_RECOVERY_STEP = 0.05
+MIN_RATE_FACTOR = 0.1
+# status codes and messages of the errors
+RATE_LIMIT_STATUS_CODES = (429,)
+TRANSIENT_STATUS_CODES = (408, 409, 500, 502, 503, 504)
+BATCH_TOO_LARGE_STATUS_CODES = (400, 413)
+BATCH_TOO_LARGE_MESSAGES = (
+    "too many tokens",
+    "tokens per request",
+    "too many inputs",
+    "too large",
+)
+# a 429 for an exhausted quota or billing is not retried
+QUOTA_EXCEEDED_MESSAGES = ("insufficient_quota", "quota exceeded")
+TRANSIENT_ERROR_NAMES = ("Timeout", "Connection")
+
+
+@dataclass
+class EmbeddingRateLimits:
+    """Budgets of an embedding provider, `None` for no limit."""
+
+    requests_per_minute: Optional[float] = None
+    tokens_per_minute: Optional[float] = None
+    # size of a request, in texts and in tokens
+    max_batch_size: int = 2048
+    max_batch_tokens: Optional[int] = None
+    # number of requests in flight
+    max_concurrency: int = 1
+    # retries of a batch, after rate-limit or transient errors
+    max_retries: int = 8
+    # seconds, the backoff before the retry `i` is drawn in
+    # [0, min(max_backoff, initial_backoff * 2 ** i)]
+    initial_backoff: float = 1.0
+    max_backoff: float = 60.0
+
+
+# published limits of the first usage tiers, a quota of its own can be given to
+# `ScheduledEmbedding`
+OPENAI_RATE_LIMITS = EmbeddingRateLimits(
+    requests_per_minute=3000,
+    tokens_per_minute=1_000_000,
+    max_batch_size=2048,
+    max_batch_tokens=300_000,
+    max_concurrency=8,
+)
+MISTRAL_RATE_LIMITS = EmbeddingRateLimits(
+    requests_per_minute=300,
+    tokens_per_minute=500_000,
+    max_batch_size=512,
+    max_batch_tokens=16_384,
+    max_concurrency=4,
+)
+# the FastEmbed model shards its batches over its worker processes
+FASTEMBED_RATE_LIMITS = EmbeddingRateLimits(max_batch_size=8192)
+HASHING_RATE_LIMITS = EmbeddingRateLimits()
+
+
+def get_default_rate_limits(embedding_model_name: str) -> EmbeddingRateLimits:
+    if embedding_model_name == MistralSupportedModels.MISTRAL_EMBED.value:
+        return MISTRAL_RATE_LIMITS
+    if "text-embedding" in embedding_model_name:
+        return OPENAI_RATE_LIMITS
+    if "multilingual" in embedding_model_name:
+        return FASTEMBED_RATE_LIMITS
+    if embedding_model_name.startswith(HASHING_EMBEDDING_PREFIX):
+        return HASHING_RATE_LIMITS
+    raise ValueError(
+        f"Unknown rate limits for embeddings model {embedding_model_name}."
+    )
+
+
+class ErrorKind(str, Enum):
+    RATE_LIMIT = "rate_limit"
+    BATCH_TOO_LARGE = "batch_too_large"
+    TRANSIENT = "transient"
+    FATAL = "fatal"
+
+
+def get_status_code(exc: Exception) -> Optional[int]:
+    # `status_code` for OpenAI and httpx, `http_status` for Mistral
+    for source in (exc, getattr(exc, "response", None)):
+        for attribute in ("status_code", "http_status"):
+            status_code = getattr(source, attribute, None)
+            if isinstance(status_code, int):
+                return status_code
+    return None
+
+
+def get_retry_after(exc: Exception) -> Optional[float]:
+    """Seconds to wait before retrying, asked by the provider."""
+    retry_after = getattr(exc, "retry_after", None)
+    if retry_after is None:
+        headers = getattr(exc, "headers", None) or getattr(
+            getattr(exc, "response", None), "headers", None
+        )
+        retry_after = (headers or {}).get("retry-after")
+    try:
+        return float(retry_after) if retry_after is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def classify_error(exc: Exception) -> ErrorKind:
+    status_code = get_status_code(exc)
+    message = str(exc).lower()
+    if status_code in RATE_LIMIT_STATUS_CODES or "rate limit" in message:
+        if any(quota in message for quota in QUOTA_EXCEEDED_MESSAGES):
+            return ErrorKind.FATAL
+        return ErrorKind.RATE_LIMIT
+    if status_code in BATCH_TOO_LARGE_STATUS_CODES and any(
+        too_large in message for too_large in BATCH_TOO_LARGE_MESSAGES
+    ):
+        return ErrorKind.BATCH_TOO_LARGE
+    if status_code in TRANSIENT_STATUS_CODES or isinstance(
+        exc, (TimeoutError, ConnectionError)
+    ):
+        return ErrorKind.TRANSIENT
+    if any(name in type(exc).__name__ for name in TRANSIENT_ERROR_NAMES):
+        return ErrorKind.TRANSIENT
+    return ErrorKind.FATAL
+
+
+class TokenBucket:
+    """
+    Budget of `per_minute` units, holding at most `BURST_SECONDS` of it. The units
+    are reserved in advance, the bucket going in debt: `reserve` returns the
+    seconds to wait before spending them, so that the reservations are served in
+    order and a request larger than the bucket waits for its whole budget.
+    """
+
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60
+        self.capacity = max(1.0, self.rate * BURST_SECONDS)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, amount: float, at: float, rate_factor: float = 1.0) -> float:
+        rate = self.rate * rate_factor
+        self.level = min(self.capacity, self.level + max(0.0, at - self.updated) * rate)
+        self.updated = max(self.updated, at)
+        self.level -= amount
+        return max(0.0, -self.level / rate)
+
+    def refund(self, amount: float):
+        self.level = min(self.capacity, self.level + amount)
+
+
+@dataclass
+class EmbeddingSchedulerStats:
+    n_texts: int = 0
+    n_tokens: int = 0
+    n_requests: int = 0
+    n_rate_limited: int = 0
+    n_retries: int = 0
+    n_splits: int = 0
+    # seconds
+    duration: float = 0.0
+
+    @property
+    def texts_per_second(self) -> float:
+        return self.n_texts / self.duration if self.duration else 0.0
+
+    @property
+    def tokens_per_minute(self) -> float:
+        return 60 * self.n_tokens / self.duration if self.duration else 0.0
+
+    @property
+    def requests_per_minute(self) -> float:
+        return 60 * self.n_requests / self.duration if self.duration else 0.0
+
+    def describe(self) -> str:
+        return (
+            f"{self.n_texts} texts, {self.n_tokens} tokens in {self.duration:.1f} s "
+            f"({self.texts_per_second:.1f} texts/s, {self.tokens_per_minute:.0f} "
+            f"tokens/min, {self.requests_per_minute:.1f} requests/min), "
+            f"{self.n_requests} requests, {self.n_rate_limited} rate limited, "
+            f"{self.n_retries} retries, {self.n_splits} splits"
+        )
+
+
+@dataclass
+class _EmbeddingRun:
+    """Texts of an `EmbeddingScheduler.embed` call, shared by its workers."""
+
+    texts: Sequence[str]
+    token_counts: List[int]
+    embeddings: List[Optional[List[float]]]
+    # indices of the texts not sent yet, split batches are put back in front
+    pending: Deque[List[int]]
+    progress_bar: tqdm
+    remaining_tokens: int = 0
+    stats: EmbeddingSchedulerStats = field(default_factory=EmbeddingSchedulerStats)
+    start: float = field(default_factory=time.perf_counter)
+    last_report: float = field(default_factory=time.perf_counter)
+    error: Optional[Exception] = None
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+
+class EmbeddingScheduler:
+    """
+    Embeds texts with `embed_model` within `limits`, see `ScheduledEmbedding`.
+
+    The budgets are the ones of this scheduler, the concurrent `embed` calls
+    share them.
+    """
+
+    def __init__(
+        self,
+        embed_model: BaseEmbedding,
+        limits: Optional[EmbeddingRateLimits] = None,
+        count_tokens: Optional[Callable[[str], int]] = None,
+        progress_interval: float = 10.0,
+    ):
+        self.embed_model = embed_model
+        self.limits = limits or get_default_rate_limits(embed_model.model_name)
+        self._count_tokens = count_tokens
+        self.progress_interval = progress_interval
+        self._requests_bucket = (
+            TokenBucket(self.limits.requests_per_minute)
+            if self.limits.requests_per_minute
+            else None
+        )
+        self._tokens_bucket = (
+            TokenBucket(self.limits.tokens_per_minute)
+            if self.limits.tokens_per_minute
+            else None
+        )
+        self._rate_factor = 1.0
+        self._resume_at = 0.0
+        # tokens of a batch, lowered when the provider rejects a batch as too large
+        self._batch_tokens = self.limits.max_batch_tokens or math.inf
+        if self.limits.tokens_per_minute:
+            self._batch_tokens = min(
+                self._batch_tokens,
+                self.limits.tokens_per_minute / 60 * BATCH_BUDGET_SECONDS,
+            )
+        self._lock = threading.Lock()
+        self.last_stats: Optional[EmbeddingSchedulerStats] = None
+
+    @property
+    def count_tokens(self) -> Callable[[str], int]:
+        # the tokenizer is only loaded by the first embedding, not by the engines
+        # attaching to an existing collection
+        if self._count_tokens is None:
+            self._count_tokens = get_token_counter(self.embed_model.model_name)
+        return self._count_tokens
+
+    def embed(
+        self, texts: Sequence[str], show_progress: bool = False
+    ) -> List[List[float]]:
+        if not texts:
+            return []
+        token_counts = [self.count_tokens(text) for text in texts]
+        run = _EmbeddingRun(
+            texts=texts,
+            token_counts=token_counts,
+            embeddings=[None] * len(texts),
+            pending=deque([[i] for i in range(len(texts))]),
+            progress_bar=tqdm(
+                total=len(texts), desc="Embedding", disable=not show_progress
+            ),
+            remaining_tokens=sum(token_counts),
+        )
+        n_workers = min(self.limits.max_concurrency, len(texts))
+        with run.progress_bar:
+            if n_workers == 1:
+                self._run_worker(run)
+            else:
+                with ThreadPoolExecutor(n_workers) as executor:
+                    for future in [
+                        executor.submit(self._run_worker, run) for _ in range(n_workers)
+                    ]:
+                        future.result()
+        if run.error is not None:
+            raise run.error
+        run.stats.duration = time.perf_counter() - run.start
+        self.last_stats = run.stats
+        if len(texts) > self.limits.max_batch_size or run.stats.n_retries:
+            logger.info(f"Embedded {run.stats.describe()}.")
+        return run.embeddings
+
+    def _next_batch(self, run: _EmbeddingRun) -> Optional[List[int]]:
+        """
+        The next texts to send, up to the batch size and the token target. The
+        target is lowered so that the last texts still fill every worker.
+        """
+        with run.lock:
+            if run.error is not None or not run.pending:
+                return None
+            with self._lock:
+                target_tokens = self._batch_tokens
+            target_tokens = min(
+                target_tokens,
+                math.ceil(run.remaining_tokens / self.limits.max_concurrency),
+            )
+            batch, batch_tokens = [], 0
+            while run.pending and len(batch) < self.limits.max_batch_size:
+                indices = run.pending[0]
+                tokens = sum(run.token_counts[i] for i in indices)
+                if batch and (
+                    batch_tokens + tokens > target_tokens
+                    or len(batch) + len(indices) > self.limits.max_batch_size
+                ):
+                    break
+                batch += run.pending.popleft()
+                batch_tokens += tokens
+            run.remaining_tokens -= batch_tokens
+            return batch
+
+    def _run_worker(self, run: _EmbeddingRun):
+        while (batch := self._next_batch(run)) is not None:
+            try:
+                self._embed_batch(run, batch)
+            except Exception as exc:
+                with run.lock:
+                    run.error = run.error or exc
+
+    def _wait_for_budget(self, n_tokens: int):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._resume_at)
+            wait = start - now
+            for bucket, amount in (
+                (self._requests_bucket, 1),
+                (self._tokens_bucket, n_tokens),
+            ):
+                if bucket is not None:
+                    wait = max(
+                        wait,
+                        start - now + bucket.reserve(amount, start, self._rate_factor),
+                    )
+        time.sleep(wait)
+
+    def _refund_tokens(self, n_tokens: int):
+        # the tokens of the rejected requests are not counted by the providers
+        with self._lock:
+            if self._tokens_bucket is not None:
+                self._tokens_bucket.refund(n_tokens)
+
+    def _get_backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        # full jitter, so that the workers do not retry together
+        if retry_after is not None:
+            return retry_after + random.uniform(0, self.limits.initial_backoff)
+        return random.uniform(
+            0, min(self.limits.max_backoff, self.limits.initial_backoff * 2**attempt)
+        )
+
+    def _embed_batch(self, run: _EmbeddingRun, batch: List[int]):
+        batch_tokens = sum(run.token_counts[i] for i in batch)
+        attempt = 0
+        while True:
+            with self._lock:
+                target_tokens = self._batch_tokens
+            # batches formed before a smaller one was rejected are split first
+            if len(batch) > 1 and batch_tokens > target_tokens:
+                self._split_batch(run, batch, batch_tokens)
+                return
+            self._wait_for_budget(batch_tokens)
+            try:
+                embeddings = self.embed_model._get_text_embeddings(
+                    [run.texts[i] for i in batch]
+                )
+            except Exception as exc:
+                kind = classify_error(exc)
+                if kind == ErrorKind.BATCH_TOO_LARGE:
+                    self._refund_tokens(batch_tokens)
+                if kind == ErrorKind.BATCH_TOO_LARGE and len(batch) > 1:
+                    with self._lock:
+                        self._batch_tokens = min(
+                            self._batch_tokens, max(1, batch_tokens // 2)
+                        )
+                    logger.debug(
+                        f"Batch of {batch_tokens} tokens too large, batches of at "
+                        f"most {self._batch_tokens} tokens from now on."
+                    )
+                    self._split_batch(run, batch, batch_tokens)
+                    return
+                if (
+                    kind not in (ErrorKind.RATE_LIMIT, ErrorKind.TRANSIENT)
+                    or attempt >= self.limits.max_retries
+                ):
+                    raise
+                delay = self._get_backoff(attempt, get_retry_after(exc))
+                with self._lock:
+                    now = time.monotonic()
+                    if kind == ErrorKind.RATE_LIMIT:
+                        # every worker waits, and the budgets refill slower, once
+                        # for the concurrent requests rejected together
+                        if now >= self._resume_at:
+                            self._rate_factor = max(
+                                MIN_RATE_FACTOR,
+                                self._rate_factor * RATE_DECREASE_FACTOR,
+                            )
+                        self._resume_at = max(self._resume_at, now + delay)
+                with run.lock:
+                    run.stats.n_retries += 1
+                    run.stats.n_rate_limited += kind == ErrorKind.RATE_LIMIT
+                logger.debug(
+                    f"Embedding batch of {len(batch)} texts failed ({exc!r}), "
+                    f"retry {attempt + 1} in {delay:.1f} s."
+                )
+                attempt += 1
+                time.sleep(delay)
+                continue
+
+            with self._lock:
+                self._rate_factor = min(1.0, self._rate_factor + RATE_RECOVERY_STEP)
+            self._add_embeddings(run, batch, batch_tokens, embeddings)
+            return
+
+    def _split_batch(self, run: _EmbeddingRun, batch: List[int], batch_tokens: int):
+        middle = len(batch) // 2
+        with run.lock:
+            run.pending.extendleft([batch[middle:], batch[:middle]])
+            run.remaining_tokens += batch_tokens
+            run.stats.n_splits += 1
+
+    def _add_embeddings(
+        self,
+        run: _EmbeddingRun,
+        batch: List[int],
+        batch_tokens: int,
+        embeddings: List[List[float]],
+    ):
+        with run.lock:
+            for i, embedding in zip(batch, embeddings):
+                run.embeddings[i] = embedding
+            run.stats.n_texts += len(batch)
+            run.stats.n_tokens += batch_tokens
+            run.stats.n_requests += 1
+            run.progress_bar.update(len(batch))
+            now = time.perf_counter()
+            if now - run.last_report < self.progress_interval:
+                return
+            run.last_report = now
+            run.stats.duration = now - run.start
+            remaining = len(run.texts) - run.stats.n_texts
+            eta = remaining / run.stats.texts_per_second
+            logger.info(
+                f"Embedded {run.stats.n_texts}/{len(run.texts)} texts "
+                f"({run.stats.tokens_per_minute:.0f} tokens/min, "
+                f"{run.stats.requests_per_minute:.1f} requests/min, "
+                f"{run.stats.n_retries} retries), about {eta:.0f} s left."
+            )
+
+
+class ScheduledEmbedding(BaseEmbedding):
+    """
+    Embedding model sending the text batches of `embed_model` through an
+    `EmbeddingScheduler`. The queries are embedded by `embed_model` directly.
+
+    The texts are packed into batches of about `max_batch_tokens` tokens, sent by
+    `max_concurrency` threads within the requests and tokens per minute of the
+    provider, both token buckets. A rate-limit error pauses every thread for the
+    delay asked by the provider, or a backoff with jitter, and slows the buckets
+    down until the next successes. A batch too large is split, the transient errors
+    are retried and the other errors raised.
+
+    It has the name and the dimensions of `embed_model`, so that both share their
+    cached embeddings and collections.
+    """
+
+    dimensions: Optional[int] = Field(
+        default=None, description="Number of dimensions kept, by default all."
+    )
+    _embed_model: BaseEmbedding = PrivateAttr()
+    _scheduler: EmbeddingScheduler = PrivateAttr()
+
+    def __init__(
+        self,
+        embed_model: BaseEmbedding,
+        limits: Optional[EmbeddingRateLimits] = None,
+        count_tokens: Optional[Callable[[str], int]] = None,
+        progress_interval: float = 10.0,
+        **kwargs: Any,
+    ):
+        kwargs.setdefault("embed_batch_size", embed_model.embed_batch_size)
+        super().__init__(
+            model_name=embed_model.model_name,
+            dimensions=getattr(embed_model, "dimensions", None),
+            callback_manager=embed_model.callback_manager,
+            **kwargs,
+        )
+        self._embed_model = embed_model
+        self._scheduler = EmbeddingScheduler(
+            embed_model, limits, count_tokens, progress_interval
+        )
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "ScheduledEmbedding"
+
+    @property
+    def wrapped_model(self) -> BaseEmbedding:
+        return self._embed_model
+
+    @property
+    def scheduler(self) -> EmbeddingScheduler:
+        return self._scheduler
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._embed_model._get_query_embedding(query)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return await self._embed_model._aget_query_embedding(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._scheduler.embed([text])[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self._scheduler.embed(texts)
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return await asyncio.to_thread(self._scheduler.embed, texts)
+
+    def get_text_embedding_batch(
+        self, texts: List[str], show_progress: bool = False, **kwargs: Any
+    ) -> List[List[float]]:
+        # all the texts at once, the scheduler makes the batches
+        with self.callback_manager.event(
+            CBEventType.EMBEDDING, payload={EventPayload.SERIALIZED: self.to_dict()}
+        ) as event:
+            embeddings = self._scheduler.embed(texts, show_progress=show_progress)
+            event.on_end(
+                payload={
+                    EventPayload.CHUNKS: texts,
+                    EventPayload.EMBEDDINGS: embeddings,
+                }
+            )
+        return embeddings
+
+    async def aget_text_embedding_batch(
+        self, texts: List[str], show_progress: bool = False
+    ) -> List[List[float]]:
+        with self.callback_manager.event(
+            CBEventType.EMBEDDING, payload={EventPayload.SERIALIZED: self.to_dict()}
+        ) as event:
+            embeddings = await asyncio.to_thread(
+                self._scheduler.embed, texts, show_progress
+            )
+            event.on_end(
+                payload={
+                    EventPayload.CHUNKS: texts,
+                    EventPayload.EMBEDDINGS: embeddings,
+                }
+            )
+        return embeddings
@@ -1,10 +1,98 @@
+import asyncio
+import hashlib
 import os
-
+import re
+import time
+from typing import Any, List, Optional
+
+import numpy as np
+from llama_index.core import Settings
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.bridge.pydantic import Field
 from llama_index.embeddings.mistralai import MistralAIEmbedding
 from llama_index.embeddings.openai import OpenAIEmbedding
 from llama_index.embeddings.fastembed import FastEmbedEmbedding
 
-from schema import MistralSupportedModels, OpenAISupportedModels
+from schema import (
+    HASHING_EMBEDDING_PREFIX,
+    MATRYOSHKA_MODELS,
+    MistralSupportedModels,
+    OpenAISupportedModels,
+)
+
+from .fastembed_pool import DEFAULT_QUERY_THREADS, ParallelFastEmbedEmbedding
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+class HashingEmbedding(BaseEmbedding):
+    """
+    Bag of words embedding: every word is hashed to one of `embed_dim` dimensions.
+
+    Texts sharing words get similar embeddings, which is enough to exercise retrieval
+    without a model, as the offline benchmarks do. Every call, single or batched,
+    sleeps `latency` seconds. With `dimensions`, the embeddings are truncated to their
+    first dimensions and normalized again, like the ones of the Matryoshka models.
+    """
+
+    embed_dim: int = Field(default=256, description="Number of dimensions.")
+    latency: float = Field(default=0.0, description="Seconds slept by each call.")
+    dimensions: Optional[int] = Field(
+        default=None, description="Number of dimensions kept, by default all."
+    )
+
+    def __init__(
+        self,
+        embed_dim: int = 256,
+        latency: float = 0.0,
+        dimensions: Optional[int] = None,
+        **kwargs: Any,
+    ):
+        super().__init__(
+            embed_dim=embed_dim,
+            latency=latency,
+            dimensions=dimensions,
+            model_name=f"hashing-{embed_dim}",
+            **kwargs,
+        )
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "HashingEmbedding"
+
+    def embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.embed_dim, dtype=np.float32)
+        for word in WORD_PATTERN.findall(text.lower()):
+            digest = hashlib.md5(word.encode("utf-8")).digest()
+            index = int.from_bytes(digest[:4], "little") % self.embed_dim
+            vector[index] += 1.0 if digest[4] % 2 else -1.0
+        vector = vector[: self.dimensions]
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        time.sleep(self.latency)
+        return self.embed(query)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        await asyncio.sleep(self.latency)
+        return self.embed(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        time.sleep(self.latency)
+        return self.embed(text)
+
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        await asyncio.sleep(self.latency)
+        return self.embed(text)
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        time.sleep(self.latency)
+        return [self.embed(text) for text in texts]
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        await asyncio.sleep(self.latency)
+        return [self.embed(text) for text in texts]
 
 
 def get_mistral_embeddings(
@@ -25,35 +113,76 @@ def get_mistral_embeddings(
 
 def get_openai_embeddings(
     embeddings_model_name: OpenAISupportedModels = OpenAISupportedModels.ADA,
+    dimensions: Optional[int] = None,
 ):
 
-    embed_model = OpenAIEmbedding(model=embeddings_model_name)
+    embed_model = OpenAIEmbedding(model=embeddings_model_name, dimensions=dimensions)
     return embed_model
 
 
 def get_fastembed_embeddings(
     embeddings_model_name: str = "fastembed",
+    n_workers: Optional[int] = None,
+    query_threads: int = DEFAULT_QUERY_THREADS,
 ):
-
-    embed_model = FastEmbedEmbedding(model_name=embeddings_model_name)
+    """
+    The FastEmbed model, embedding the documents in `n_workers` processes, by
+    default one per core not used by the `query_threads` threads of the queries.
+    """
+    embed_model = ParallelFastEmbedEmbedding(
+        model_name=embeddings_model_name,
+        n_workers=n_workers,
+        query_threads=query_threads,
+    )
     return embed_model
 
 
+def get_hashing_embeddings(
+    embeddings_model_name: str = "hashing-256", dimensions: Optional[int] = None
+):
+    """Deterministic local embedding of the offline benchmarks, "hashing-<dim>"."""
+    _, _, embed_dim = embeddings_model_name.partition("-")
+    return HashingEmbedding(embed_dim=int(embed_dim or 256), dimensions=dimensions)
+
+
 def get_embeddings(
     embeddings_model_name: str = "ada",
+    dimensions: Optional[int] = None,
 ) -> MistralAIEmbedding | OpenAIEmbedding | FastEmbedEmbedding:
+    """
+    The embedding model `embeddings_model_name`. With `dimensions`, the embeddings
+    are shortened to this number of dimensions, which only the Matryoshka models
+    (and the hashing embedding) support.
+    """
+    is_hashing_model = embeddings_model_name.startswith(HASHING_EMBEDDING_PREFIX)
+    if dimensions and not (
+        embeddings_model_name in MATRYOSHKA_MODELS or is_hashing_model
+    ):
+        raise ValueError(
+            f"Embeddings model {embeddings_model_name} does not support reduced "
+            f"dimensions, only {list(MATRYOSHKA_MODELS)} do."
+        )
+
     if "mistral" in embeddings_model_name:
         model_name = MistralSupportedModels(embeddings_model_name)
-        return get_mistral_embeddings(model_name)
+        embed_model = get_mistral_embeddings(model_name)
     elif "text-embedding" in embeddings_model_name:
         model_name = OpenAISupportedModels(embeddings_model_name)
-        return get_openai_embeddings(model_name)
+        embed_model = get_openai_embeddings(model_name, dimensions)
 
     elif "multilingual" in embeddings_model_name:
-        return get_fastembed_embeddings(embeddings_model_name)
+        embed_model = get_fastembed_embeddings(embeddings_model_name)
+
+    elif is_hashing_model:
+        embed_model = get_hashing_embeddings(embeddings_model_name, dimensions)
 
     else:
         raise ValueError(
             f"Embeddings model {embeddings_model_name} not supported."
-            f"Supported models include `mistral-embed` and `openai-embed` and `fastembed`."
+            f"Supported models include `mistral-embed` and `openai-embed` and `fastembed`, "
+            f"and `hashing-<dim>` for offline benchmarks."
         )
+
+    # report to the global callback manager, like the models resolved by llama-index
+    embed_model.callback_manager = Settings.callback_manager
+    return embed_model
@@ -0,0 +1,169 @@
+import asyncio
+import math
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_all_start_methods, get_context
+from typing import Dict, Iterator, List, Literal, Optional, Sequence, Tuple
+
+import numpy as np
+from fastembed import TextEmbedding
+from llama_index.core.bridge.pydantic import Field
+from llama_index.embeddings.fastembed import FastEmbedEmbedding
+from loguru import logger
+
+from .constants import path_dir_fastembed_cache
+
+# threads of the in-process ONNX session
+DEFAULT_QUERY_THREADS = 2
+# documents of the ONNX batches of the workers
+DEFAULT_WORKER_BATCH_SIZE = 64
+# the maximum `embed_batch_size` of llama-index
+MAX_EMBED_BATCH_SIZE = 2048
+
+# model of a worker process, loaded by `_load_worker_model`
+_worker_model: Optional[TextEmbedding] = None
+
+# the pools of the process, by model, cache directory, number of workers and
+# maximum length
+_pools: Dict[Tuple[str, str, int, int], "FastEmbedPool"] = {}
+_pools_lock = threading.Lock()
+
+
+def get_default_n_workers(query_threads: int = DEFAULT_QUERY_THREADS) -> int:
+    return max(1, (os.cpu_count() or 1) - query_threads)
+
+
+def _load_worker_model(model_name: str, cache_dir: str, max_length: int):
+    global _worker_model
+    _worker_model = TextEmbedding(
+        model_name=model_name, max_length=max_length, cache_dir=cache_dir, threads=1
+    )
+
+
+def _embed_shard(documents: List[str], passage: bool = False) -> np.ndarray:
+    embed = _worker_model.passage_embed if passage else _worker_model.embed
+    return np.stack(list(embed(documents, batch_size=len(documents))))
+
+
+class FastEmbedPool:
+    """Worker processes embedding documents with their own copy of a model."""
+
+    def __init__(
+        self, model_name: str, cache_dir: str, n_workers: int, max_length: int = 512
+    ):
+        # the ONNX runtime threads do not survive a fork
+        start_method = (
+            "forkserver" if "forkserver" in get_all_start_methods() else "spawn"
+        )
+        self.n_workers = n_workers
+        self._executor = ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=get_context(start_method),
+            initializer=_load_worker_model,
+            initargs=(model_name, cache_dir, max_length),
+        )
+
+    def iter_embeddings(
+        self, documents: Sequence[str], batch_size: int, passage: bool = False
+    ) -> Iterator[np.ndarray]:
+        """
+        The embeddings of consecutive shards of `documents`, in order. The shards
+        are smaller than `batch_size` when there are too few documents to give
+        one to every worker.
+        """
+        shard_size = max(1, min(batch_size, math.ceil(len(documents) / self.n_workers)))
+        shards = [
+            list(documents[start : start + shard_size])
+            for start in range(0, len(documents), shard_size)
+        ]
+        yield from self._executor.map(_embed_shard, shards, [passage] * len(shards))
+
+    def shutdown(self):
+        self._executor.shutdown(cancel_futures=True)
+
+
+def get_fastembed_pool(
+    model_name: str, cache_dir: str, n_workers: int, max_length: int = 512
+) -> FastEmbedPool:
+    key = (model_name, os.path.abspath(cache_dir), n_workers, max_length)
+    with _pools_lock:
+        if key not in _pools:
+            logger.info(f"Starting {n_workers} FastEmbed workers for {model_name}.")
+            _pools[key] = FastEmbedPool(model_name, cache_dir, n_workers, max_length)
+        return _pools[key]
+
+
+def shutdown_fastembed_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.shutdown()
+        _pools.clear()
+
+
+class ParallelFastEmbedEmbedding(FastEmbedEmbedding):
+    """
+    FastEmbed model embedding the batches of documents in a pool of `n_workers`
+    processes. The queries, and the batches of less than `batch_size` documents,
+    are embedded in process with `query_threads` threads, so that they do not
+    compete with an indexing.
+
+    Every worker runs a single-threaded ONNX session and the embeddings come back
+    in the order of the documents. The pools live as long as the process, each
+    worker loading the model once from `cache_dir`, persisted unlike the temporary
+    directory FastEmbed uses by default.
+    """
+
+    n_workers: int = Field(default=1, description="Number of worker processes.")
+    batch_size: int = Field(
+        default=DEFAULT_WORKER_BATCH_SIZE,
+        description="Number of documents of the ONNX batches.",
+    )
+
+    def __init__(
+        self,
+        model_name: str,
+        max_length: int = 512,
+        cache_dir: str = path_dir_fastembed_cache,
+        query_threads: int = DEFAULT_QUERY_THREADS,
+        n_workers: Optional[int] = None,
+        batch_size: int = DEFAULT_WORKER_BATCH_SIZE,
+        doc_embed_type: Literal["default", "passage"] = "default",
+    ):
+        # the model is downloaded to the cache directory here, before the workers
+        # load it
+        super().__init__(
+            model_name=model_name,
+            max_length=max_length,
+            cache_dir=cache_dir,
+            threads=query_threads,
+            doc_embed_type=doc_embed_type,
+        )
+        self.cache_dir = cache_dir
+        self.n_workers = n_workers or get_default_n_workers(query_threads)
+        self.batch_size = batch_size
+        # the texts of `get_text_embedding_batch` are sharded over the workers
+        self.embed_batch_size = MAX_EMBED_BATCH_SIZE
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "ParallelFastEmbedEmbedding"
+
+    def iter_embeddings(self, texts: Sequence[str]) -> Iterator[np.ndarray]:
+        """The embeddings of `texts`, batch by batch and in order."""
+        passage = self.doc_embed_type == "passage"
+        if len(texts) < self.batch_size:
+            embed = self._model.passage_embed if passage else self._model.embed
+            yield from embed(list(texts), batch_size=self.batch_size)
+            return
+        pool = get_fastembed_pool(
+            self.model_name, self.cache_dir, self.n_workers, self.max_length
+        )
+        for shard_embeddings in pool.iter_embeddings(texts, self.batch_size, passage):
+            yield from shard_embeddings
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return [embedding.tolist() for embedding in self.iter_embeddings(texts)]
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return await asyncio.to_thread(self._get_text_embeddings, texts)
@@ -1,16 +1,427 @@
+import os
+from threading import Lock
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
 from llama_index.core import VectorStoreIndex
 from llama_index.core import StorageContext
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.schema import TextNode
 from llama_index.embeddings.mistralai import MistralAIEmbedding
 from llama_index.embeddings.openai import OpenAIEmbedding
 from llama_index.embeddings.fastembed import FastEmbedEmbedding
 from llama_index.vector_stores.qdrant import QdrantVectorStore
-from qdrant_client import QdrantClient
+from qdrant_client import AsyncQdrantClient, QdrantClient
+from qdrant_client.http import models as rest
 from qdrant_client.http.exceptions import UnexpectedResponse
 from loguru import logger
 
-from data_ingestion.nodes_processing import CodeNodes
+from data_ingestion.nodes_processing import (
+    CODE_NAME_METADATA_KEY,
+    CodeNodes,
+    PAYLOAD_HASH_METADATA_KEY,
+)
+from schema import SparseIndexBackend, VectorQuantization, VectorStoreBackend
 
+from .article_index import (
+    ArticleIndexBuilder,
+    build_article_index,
+    get_article_index_path,
+)
+from .bm25 import (
+    BM25IndexBuilder,
+    bm25_index_exists,
+    save_bm25_index,
+    update_bm25_index,
+)
+from .collection_manifest import (
+    delete_manifest_entry,
+    get_code_fingerprint,
+    get_manifest_entry,
+    save_manifest_entry,
+)
+from .embedding_scheduler import EmbeddingRateLimits, ScheduledEmbedding
 from .embeddings import get_embeddings
+from .hierarchy import (
+    CodeHierarchy,
+    build_code_hierarchy,
+    create_header_payload_indexes,
+    get_hierarchy_path,
+)
+from .embedding_cache import EmbeddingCache, embed_nodes_with_cache, get_cache_namespace
+from .ingestion_pipeline import delete_points, run_ingestion_pipeline
+from .numpy_vector_store import NumpyVectorStore, get_persist_dir
+from .quantization import (
+    DENSE_VECTOR_NAME,
+    RescoringQdrantVectorStore,
+    apply_collection_quantization,
+)
+
+# first part of the name of the collections shared by every code, instead of the
+# code name
+SHARED_COLLECTION_PREFIX = "all_codes"
+
+# incremented every time a collection is modified by this process, so that the
+# caches built on top of a collection can tell when they are stale
+_collection_generations: Dict[str, int] = {}
+_shared_numpy_vector_stores: Dict[str, NumpyVectorStore] = {}
+_shared_numpy_vector_stores_lock = Lock()
+
+
+def get_collection_generation(collection_name: str) -> int:
+    return _collection_generations.get(collection_name, 0)
+
+
+def _bump_collection_generation(collection_name: str) -> None:
+    _collection_generations[collection_name] = (
+        get_collection_generation(collection_name) + 1
+    )
+
+
+def embed_with_cache(
+    nodes: List[TextNode],
+    embedding_model: MistralAIEmbedding | OpenAIEmbedding | FastEmbedEmbedding,
+) -> None:
+    cache = EmbeddingCache(get_cache_namespace(embedding_model))
+    embed_nodes_with_cache(nodes, embedding_model, cache, show_progress=True)
+    cache.log_stats()
+
+
+def get_code_filter(code_name: Optional[str]) -> Optional[rest.Filter]:
+    """Filter on the points of a code in a collection shared by several codes, None
+    for the whole collection."""
+    if code_name is None:
+        return None
+    return rest.Filter(
+        must=[
+            rest.FieldCondition(
+                key=CODE_NAME_METADATA_KEY, match=rest.MatchValue(value=code_name)
+            )
+        ]
+    )
+
+
+def get_stored_payload_hashes(
+    client: QdrantClient,
+    collection_name: str,
+    scroll_batch_size: int = 1000,
+    code_name: Optional[str] = None,
+) -> Dict[str, Optional[str]]:
+    """Map the id of every point of the collection, or of the points of `code_name`
+    only, to its stored payload hash."""
+    if not client.collection_exists(collection_name):
+        return {}
+
+    stored_hashes = {}
+    offset = None
+    while True:
+        points, offset = client.scroll(
+            collection_name=collection_name,
+            scroll_filter=get_code_filter(code_name),
+            limit=scroll_batch_size,
+            offset=offset,
+            with_payload=[PAYLOAD_HASH_METADATA_KEY],
+            with_vectors=False,
+        )
+        for point in points:
+            stored_hashes[str(point.id)] = (point.payload or {}).get(
+                PAYLOAD_HASH_METADATA_KEY
+            )
+        if offset is None:
+            return stored_hashes
+
+
+def get_vector_store_hashes(
+    vector_store: QdrantVectorStore | NumpyVectorStore,
+    code_name: Optional[str] = None,
+) -> Dict[str, Optional[str]]:
+    """`get_stored_payload_hashes` for both vector store backends."""
+    if not isinstance(vector_store, NumpyVectorStore):
+        return get_stored_payload_hashes(
+            vector_store.client, vector_store.collection_name, code_name=code_name
+        )
+    stored_hashes = vector_store.get_metadata_values(PAYLOAD_HASH_METADATA_KEY)
+    if code_name is None:
+        return stored_hashes
+    code_names = vector_store.get_metadata_values(CODE_NAME_METADATA_KEY)
+    return {
+        node_id: payload_hash
+        for node_id, payload_hash in stored_hashes.items()
+        if code_names[node_id] == code_name
+    }
+
+
+def delete_code_points(
+    vector_store: QdrantVectorStore | NumpyVectorStore, code_name: str
+) -> None:
+    """Delete the points of a code from a collection shared by several codes."""
+    if isinstance(vector_store, NumpyVectorStore):
+        node_ids = list(get_vector_store_hashes(vector_store, code_name))
+        if node_ids:
+            vector_store.delete_nodes(node_ids)
+    elif vector_store.client.collection_exists(vector_store.collection_name):
+        vector_store.client.delete(
+            collection_name=vector_store.collection_name,
+            points_selector=rest.FilterSelector(filter=get_code_filter(code_name)),
+        )
+    _bump_collection_generation(vector_store.collection_name)
+
+
+def create_code_payload_index(client: QdrantClient, collection_name: str):
+    """Index the code names of the payloads of a shared collection, so that the
+    searches of a code only visit its points."""
+    if not client.collection_exists(collection_name):
+        return
+    payload_schema = client.get_collection(collection_name).payload_schema
+    if CODE_NAME_METADATA_KEY not in payload_schema:
+        client.create_payload_index(
+            collection_name=collection_name,
+            field_name=CODE_NAME_METADATA_KEY,
+            field_schema=rest.PayloadSchemaType.KEYWORD,
+        )
+
+
+def get_collection_centroid(
+    client: QdrantClient,
+    collection_name: str,
+    scroll_batch_size: int = 1000,
+    code_name: Optional[str] = None,
+) -> Optional[List[float]]:
+    """Mean of the dense vectors of the collection, or of the points of `code_name`
+    only, None if it does not exist."""
+    if not client.collection_exists(collection_name):
+        return None
+
+    total, n_points = None, 0
+    offset = None
+    while True:
+        points, offset = client.scroll(
+            collection_name=collection_name,
+            scroll_filter=get_code_filter(code_name),
+            limit=scroll_batch_size,
+            offset=offset,
+            with_payload=False,
+            with_vectors=True,
+        )
+        for point in points:
+            vector = point.vector
+            if isinstance(vector, dict):
+                # hybrid collections store named dense and sparse vectors
+                vector = vector[DENSE_VECTOR_NAME]
+            vector = np.asarray(vector, dtype=np.float64)
+            total = vector if total is None else total + vector
+            n_points += 1
+        if offset is None:
+            break
+    if total is None:
+        return None
+    return (total / n_points).tolist()
+
+
+def get_local_collection_centroid(
+    vector_store: NumpyVectorStore, code_name: Optional[str] = None
+) -> Optional[List[float]]:
+    """`get_collection_centroid` for the collections stored in a
+    `NumpyVectorStore`."""
+    node_ids = None
+    if code_name is not None:
+        node_ids = get_vector_store_hashes(vector_store, code_name)
+    centroid = vector_store.get_mean_vector(node_ids)
+    return centroid.tolist() if centroid is not None else None
+
+
+def sync_nodes_with_collection(
+    code_nodes: CodeNodes,
+    vector_store: QdrantVectorStore | NumpyVectorStore,
+    embedding_model: MistralAIEmbedding | OpenAIEmbedding | FastEmbedEmbedding,
+    use_embedding_cache: bool = True,
+    code_name: Optional[str] = None,
+) -> VectorStoreIndex:
+    """
+    Bring the collection up to date with `code_nodes` without rebuilding it: only
+    new or modified nodes are embedded and upserted, and points that no longer
+    correspond to a node are deleted. In a collection shared by several codes, only
+    the points of `code_name` are compared with the nodes.
+    """
+    stored_hashes = get_vector_store_hashes(vector_store, code_name)
+    current_nodes = {node.node_id: node for node in code_nodes.nodes}
+    nodes_to_upsert = [
+        node
+        for node_id, node in current_nodes.items()
+        if stored_hashes.get(node_id) != node.metadata[PAYLOAD_HASH_METADATA_KEY]
+    ]
+    ids_to_delete = [
+        node_id for node_id in stored_hashes if node_id not in current_nodes
+    ]
+    logger.info(
+        f"Syncing collection {vector_store.collection_name}: "
+        f"{len(current_nodes) - len(nodes_to_upsert)} unchanged nodes, "
+        f"{len(nodes_to_upsert)} to upsert, {len(ids_to_delete)} to delete."
+    )
+
+    if nodes_to_upsert or ids_to_delete:
+        _bump_collection_generation(vector_store.collection_name)
+    if use_embedding_cache and nodes_to_upsert:
+        embed_with_cache(nodes_to_upsert, embedding_model)
+
+    index = VectorStoreIndex.from_vector_store(
+        vector_store,
+        embed_model=embedding_model,
+    )
+    index.insert_nodes(nodes_to_upsert)
+
+    if ids_to_delete:
+        delete_points(vector_store, ids_to_delete)
+    return index
+
+
+def get_shared_numpy_vector_store(
+    collection_name: str,
+    vectors_dtype: str = "float32",
+    vector_quantization: VectorQuantization = VectorQuantization.NONE,
+    rescore_oversampling: float = 2.0,
+) -> NumpyVectorStore:
+    """
+    The store of a collection shared by several codes, opened once by process: a
+    store only knows the rows stored when it was opened and the ones it appended
+    since, so the engines of the codes must all write to the same one.
+    """
+    with _shared_numpy_vector_stores_lock:
+        vector_store = _shared_numpy_vector_stores.get(collection_name)
+        if vector_store is None:
+            vector_store = NumpyVectorStore(
+                get_persist_dir(collection_name),
+                dtype=vectors_dtype,
+                quantization=vector_quantization,
+                oversampling=rescore_oversampling,
+            )
+            _shared_numpy_vector_stores[collection_name] = vector_store
+        elif vector_store.oversampling != rescore_oversampling:
+            raise ValueError(
+                f"The store of {collection_name} is already open with an "
+                f"oversampling of {vector_store.oversampling}."
+            )
+        return vector_store
+
+
+def get_numpy_vector_store(
+    collection_name: str,
+    shared_collection: bool = False,
+    vectors_dtype: str = "float32",
+    vector_quantization: VectorQuantization = VectorQuantization.NONE,
+    rescore_oversampling: float = 2.0,
+) -> NumpyVectorStore:
+    if shared_collection:
+        return get_shared_numpy_vector_store(
+            collection_name, vectors_dtype, vector_quantization, rescore_oversampling
+        )
+    return NumpyVectorStore(
+        get_persist_dir(collection_name),
+        dtype=vectors_dtype,
+        quantization=vector_quantization,
+        oversampling=rescore_oversampling,
+    )
+
+
+def get_qdrant_vector_store(
+    collection_name: str,
+    hybrid_search: bool,
+    use_async: bool = False,
+    vector_quantization: VectorQuantization = VectorQuantization.NONE,
+    rescore_oversampling: float = 2.0,
+    client: Optional[QdrantClient] = None,
+) -> QdrantVectorStore:
+    """The store of a Qdrant collection, searched with rescoring when quantized."""
+    vector_store_kwargs = {
+        "collection_name": collection_name,
+        "client": client or QdrantClient("localhost", port=6333),
+        "aclient": AsyncQdrantClient("localhost", port=6333) if use_async else None,
+        "enable_hybrid": hybrid_search,
+    }
+    if VectorQuantization(vector_quantization) != VectorQuantization.NONE:
+        return RescoringQdrantVectorStore(
+            **vector_store_kwargs, oversampling=rescore_oversampling
+        )
+    return QdrantVectorStore(**vector_store_kwargs)
+
+
+def count_points(
+    client: QdrantClient, collection_name: str, code_name: Optional[str] = None
+) -> int:
+    """Number of points of the collection, or of the points of `code_name` only, 0
+    if it does not exist."""
+    try:
+        return client.count(
+            collection_name, count_filter=get_code_filter(code_name), exact=True
+        ).count
+    except UnexpectedResponse:
+        return 0
+
+
+def count_local_points(
+    vector_store: NumpyVectorStore, code_name: Optional[str] = None
+) -> int:
+    """`count_points` for the collections stored in a `NumpyVectorStore`."""
+    if code_name is None:
+        return vector_store.n_nodes
+    return len(get_vector_store_hashes(vector_store, code_name))
+
+
+def index_given_nodes_locally(
+    code_nodes: CodeNodes,
+    embedding_model: MistralAIEmbedding | OpenAIEmbedding | FastEmbedEmbedding,
+    recreate_collection: bool = False,
+    use_embedding_cache: bool = True,
+    streaming_ingestion: bool = False,
+    ingestion_batch_size: int = 64,
+    vectors_dtype: str = "float32",
+    vector_quantization: VectorQuantization = VectorQuantization.NONE,
+    rescore_oversampling: float = 2.0,
+    collection_name: Optional[str] = None,
+    on_node: Optional[Callable[[TextNode], None]] = None,
+) -> VectorStoreIndex:
+    """
+    Same as `index_given_nodes`, with the collection stored in a `NumpyVectorStore`
+    instead of the Qdrant server. The collection is always synced incrementally.
+    """
+    code_name = get_shared_code_name(code_nodes, collection_name)
+    collection_name = collection_name or code_nodes.nodes_config
+    vector_store = get_numpy_vector_store(
+        collection_name,
+        code_name is not None,
+        vectors_dtype,
+        vector_quantization,
+        rescore_oversampling,
+    )
+    if recreate_collection and code_name is not None:
+        delete_code_points(vector_store, code_name)
+    elif recreate_collection:
+        vector_store.clear()
+        _bump_collection_generation(collection_name)
+
+    if streaming_ingestion:
+        report = run_ingestion_pipeline(
+            code_nodes,
+            vector_store,
+            embedding_model,
+            batch_size=ingestion_batch_size,
+            use_embedding_cache=use_embedding_cache,
+            stored_hashes=get_vector_store_hashes(vector_store, code_name),
+            on_node=on_node,
+        )
+        if report.stages["upsert"].n_items or report.n_deleted:
+            _bump_collection_generation(collection_name)
+    else:
+        sync_nodes_with_collection(
+            code_nodes, vector_store, embedding_model, use_embedding_cache, code_name
+        )
+
+    if vector_store.n_deleted_rows:
+        vector_store.compact()
+    return VectorStoreIndex.from_vector_store(
+        vector_store,
+        embed_model=embedding_model,
+    )
 
 
 def index_given_nodes(
@@ -18,6 +429,15 @@ def index_given_nodes(
     embedding_model: MistralAIEmbedding | OpenAIEmbedding | FastEmbedEmbedding,
     hybrid_search: bool,
     recreate_collection: bool = False,
+    use_embedding_cache: bool = True,
+    incremental_sync: bool = True,
+    streaming_ingestion: bool = False,
+    ingestion_batch_size: int = 64,
+    use_async: bool = False,
+    vector_quantization: VectorQuantization = VectorQuantization.NONE,
+    rescore_oversampling: float = 2.0,
+    collection_name: Optional[str] = None,
+    on_node: Optional[Callable[[TextNode], None]] = None,
 ) -> VectorStoreIndex:
     """
     Given a list of nodes, create a new index or use an existing one.
@@ -32,26 +452,100 @@ def index_given_nodes(
         Whether to enable hybrid search.
     recreate_collection : bool, optional
         Whether to recreate the collection, by default False.
+    use_embedding_cache : bool, optional
+        Whether to look up the nodes embeddings in the on-disk embedding cache
+        before calling the embedding provider, by default True.
+    incremental_sync : bool, optional
+        Whether to update an existing collection with only the nodes that changed
+        (see `sync_nodes_with_collection`) instead of comparing node counts and
+        rebuilding the collection on mismatch, by default True.
+    streaming_ingestion : bool, optional
+        Whether to build the collection with `run_ingestion_pipeline`, which never
+        holds all the nodes of the code in memory, by default False.
+    ingestion_batch_size : int, optional
+        Number of nodes embedded and upserted at once by the streaming ingestion,
+        by default 64.
+    use_async : bool, optional
+        Whether to give the vector store an async client, needed to query the index
+        asynchronously, by default False.
+    vector_quantization : VectorQuantization, optional
+        The quantization of the dense vectors, see `apply_collection_quantization`,
+        by default "none".
+    rescore_oversampling : float, optional
+        The number of candidates rescored by result of a query of a quantized
+        collection, by default 2.0.
+    collection_name : str, optional
+        The name of the collection, by default the nodes config of `code_nodes`.
+        Any other name is a collection shared by several codes, in which only the
+        points of the code of `code_nodes` are synced, recreated or deleted.
+    on_node : Callable[[TextNode], None], optional
+        Called with every node streamed by the streaming ingestion, see
+        `run_ingestion_pipeline`.
 
     """
 
-    collection_name = code_nodes.nodes_config
+    code_name = get_shared_code_name(code_nodes, collection_name)
+    collection_name = collection_name or code_nodes.nodes_config
     client = QdrantClient("localhost", port=6333)
-    if recreate_collection:
+
+    def get_vector_store() -> QdrantVectorStore:
+        return get_qdrant_vector_store(
+            collection_name,
+            hybrid_search,
+            use_async,
+            vector_quantization,
+            rescore_oversampling,
+            client=client,
+        )
+
+    vector_store = get_vector_store()
+
+    def delete_code_collection():
+        nonlocal vector_store
+        if code_name is not None:
+            delete_code_points(vector_store, code_name)
+            return
         client.delete_collection(collection_name)
+        _bump_collection_generation(collection_name)
+        # the vector store only creates the collection if it did not exist when
+        # the store was created
+        vector_store = get_vector_store()
 
-    try:
-        count = client.count(collection_name).count
-    except UnexpectedResponse:
-        count = 0
+    if recreate_collection:
+        delete_code_collection()
+
+    if streaming_ingestion:
+        stored_hashes = None
+        if incremental_sync:
+            stored_hashes = get_stored_payload_hashes(
+                client, collection_name, code_name=code_name
+            )
+        else:
+            delete_code_collection()
+        report = run_ingestion_pipeline(
+            code_nodes,
+            vector_store,
+            embedding_model,
+            batch_size=ingestion_batch_size,
+            use_embedding_cache=use_embedding_cache,
+            stored_hashes=stored_hashes,
+            on_node=on_node,
+        )
+        if report.stages["upsert"].n_items or report.n_deleted:
+            _bump_collection_generation(collection_name)
+        return VectorStoreIndex.from_vector_store(
+            vector_store,
+            embed_model=embedding_model,
+        )
 
+    if incremental_sync:
+        return sync_nodes_with_collection(
+            code_nodes, vector_store, embedding_model, use_embedding_cache, code_name
+        )
+
+    count = count_points(client, collection_name, code_name)
     if count == len(code_nodes.nodes):
         logger.info(f"Found {count} existing nodes. Using the existing collection.")
-        vector_store = QdrantVectorStore(
-            collection_name=collection_name,
-            client=client,
-            enable_hybrid=hybrid_search,
-        )
         return VectorStoreIndex.from_vector_store(
             vector_store,
             embed_model=embedding_model,
@@ -60,13 +554,12 @@ def index_given_nodes(
         f"Found {count} existing nodes. Creating a new index with {len(code_nodes.nodes)} nodes. This may take a while."
     )
     if count > 0:
-        client.delete_collection(collection_name)
+        delete_code_collection()
+    _bump_collection_generation(collection_name)
+
+    if use_embedding_cache:
+        embed_with_cache(code_nodes.nodes, embedding_model)
 
-    vector_store = QdrantVectorStore(
-        collection_name=collection_name,
-        client=client,
-        enable_hybrid=hybrid_search,
-    )
     storage_context = StorageContext.from_defaults(vector_store=vector_store)
     index = VectorStoreIndex(
         code_nodes.nodes,
@@ -76,6 +569,65 @@ def index_given_nodes(
     return index
 
 
+def get_shared_code_name(
+    code_nodes: CodeNodes, collection_name: Optional[str]
+) -> Optional[str]:
+    """The code of `code_nodes` when `collection_name` is shared by several codes."""
+    if collection_name is None or collection_name == code_nodes.nodes_config:
+        return None
+    return code_nodes.code_name
+
+
+def get_collection_name(
+    code_nodes: CodeNodes,
+    embedding_model: str,
+    hybrid_search: bool,
+    sparse_index: SparseIndexBackend = SparseIndexBackend.BM25,
+    embedding_dimensions: Optional[int] = None,
+    vector_quantization: VectorQuantization = VectorQuantization.NONE,
+    shared_collection: bool = False,
+) -> str:
+    collection_name = code_nodes.nodes_config
+    if shared_collection:
+        nodes_type = "window" if code_nodes.stores_windows else "base"
+        collection_name = f"{SHARED_COLLECTION_PREFIX}_{nodes_type}"
+    # only the Qdrant sparse vectors are stored in the collection
+    if hybrid_search and SparseIndexBackend(sparse_index) == SparseIndexBackend.QDRANT:
+        collection_name += "_hybrid"
+    collection_name += f"_{embedding_model.replace('/', '_')}"
+    if embedding_dimensions:
+        collection_name += f"_d{embedding_dimensions}"
+    if VectorQuantization(vector_quantization) != VectorQuantization.NONE:
+        collection_name += f"_{VectorQuantization(vector_quantization).value}"
+    return collection_name
+
+
+class StreamedCodeData:
+    """
+    Article index, hierarchy and BM25 index of a code, built from the nodes
+    streamed by `run_ingestion_pipeline` so that the articles of the code are
+    loaded and chunked once, by the pipeline.
+    """
+
+    def __init__(self, nodes_config: str, build_bm25_index: bool):
+        self.nodes_config = nodes_config
+        self.article_index = ArticleIndexBuilder()
+        self.hierarchy = CodeHierarchy.from_nodes([])
+        self.bm25_index = BM25IndexBuilder() if build_bm25_index else None
+
+    def add(self, node: TextNode):
+        self.article_index.add(node)
+        self.hierarchy.add_node(node)
+        if self.bm25_index is not None:
+            self.bm25_index.add(node)
+
+    def save(self):
+        build_article_index(self.nodes_config, self.article_index)
+        build_code_hierarchy(self.nodes_config, self.hierarchy)
+        if self.bm25_index is not None:
+            save_bm25_index(self.nodes_config, self.bm25_index)
+
+
 def index_nodes(
     code_name: str,
     embedding_model: str,
@@ -84,22 +636,239 @@ def index_nodes(
     hybrid_search: bool,
     recreate_collection: bool = False,
     reload_data: bool = False,
-) -> tuple[VectorStoreIndex, list]:
+    use_embedding_cache: bool = True,
+    incremental_sync: bool = True,
+    streaming_ingestion: bool = False,
+    ingestion_batch_size: int = 64,
+    query_time_window: bool = False,
+    max_tokens_per_node: Optional[int] = None,
+    chunk_overlap_tokens: int = 0,
+    use_async: bool = False,
+    vector_store_backend: VectorStoreBackend = VectorStoreBackend.QDRANT,
+    vectors_dtype: str = "float32",
+    sparse_index: SparseIndexBackend = SparseIndexBackend.BM25,
+    embedding_dimensions: Optional[int] = None,
+    vector_quantization: VectorQuantization = VectorQuantization.NONE,
+    rescore_oversampling: float = 2.0,
+    shared_collection: bool = False,
+    embedding_rate_limits: Optional[EmbeddingRateLimits] = None,
+) -> tuple[VectorStoreIndex, list, str]:
+    """
+    Index the nodes of a code, see `create_query_engine` for the parameters.
+
+    Return the index, the node postprocessors and the name of the per-code data
+    built alongside (article index, hierarchy, BM25 index), which is also the name
+    of the collection unless `shared_collection`.
 
-    embed_model = get_embeddings(embedding_model)
+    When the manifest of the collection matches the data and parameters of the
+    code (see `collection_manifest`), the existing collection is used without
+    building the nodes of the code.
+    """
+
+    embed_model = ScheduledEmbedding(
+        get_embeddings(embedding_model, dimensions=embedding_dimensions),
+        limits=embedding_rate_limits,
+    )
     logger.info("Creating text nodes ...")
     code_nodes = CodeNodes(
         code_name=code_name,
         use_window_nodes=use_window_nodes,
         nodes_window_size=nodes_window_size,
+        embedding_model_name=embedding_model,
+        max_tokens_per_node=max_tokens_per_node,
+        chunk_overlap_tokens=chunk_overlap_tokens,
         reload_data=reload_data,
+        query_time_window=query_time_window,
+    )
+    # both names are derived from the nodes config of the code, set last
+    collection_name = get_collection_name(
+        code_nodes,
+        embedding_model,
+        hybrid_search,
+        sparse_index,
+        embedding_dimensions=embedding_dimensions,
+        vector_quantization=vector_quantization,
+        shared_collection=shared_collection,
+    )
+    code_nodes.nodes_config = get_collection_name(
+        code_nodes,
+        embedding_model,
+        hybrid_search,
+        sparse_index,
+        embedding_dimensions=embedding_dimensions,
+        vector_quantization=vector_quantization,
     )
-    if hybrid_search:
-        code_nodes.nodes_config += "_hybrid"
-
-    code_nodes.nodes_config += f"_{embedding_model.replace('/', '_')}"
     logger.info("Text nodes creation finished.")
-    index = index_given_nodes(
-        code_nodes, embed_model, hybrid_search, recreate_collection
+    qdrant_sparse_vectors = (
+        hybrid_search and SparseIndexBackend(sparse_index) == SparseIndexBackend.QDRANT
+    )
+    vector_store_backend = VectorStoreBackend(vector_store_backend)
+    if vector_store_backend == VectorStoreBackend.NUMPY and qdrant_sparse_vectors:
+        raise ValueError(
+            "Qdrant sparse vectors are only supported by the Qdrant backend."
+        )
+    build_bm25_index = hybrid_search and not qdrant_sparse_vectors
+    fingerprint_parameters = {
+        "embedding_model": embedding_model,
+        "embedding_dimensions": embedding_dimensions,
+        "vector_quantization": VectorQuantization(vector_quantization).value,
+        "vectors_dtype": (
+            vectors_dtype if vector_store_backend == VectorStoreBackend.NUMPY else None
+        ),
+        "bm25_index": build_bm25_index,
+    }
+    fingerprint = get_code_fingerprint(code_nodes, fingerprint_parameters)
+    if not (recreate_collection or reload_data) and fingerprint is not None:
+        index = attach_to_collection(
+            code_nodes,
+            embed_model,
+            fingerprint,
+            collection_name,
+            vector_store_backend,
+            qdrant_sparse_vectors,
+            build_bm25_index,
+            use_async=use_async,
+            vectors_dtype=vectors_dtype,
+            vector_quantization=vector_quantization,
+            rescore_oversampling=rescore_oversampling,
+        )
+        if index is not None:
+            return index, code_nodes.post_processors, code_nodes.nodes_config
+    delete_manifest_entry(collection_name, vector_store_backend, code_name)
+
+    # the streaming ingestion never holds all the nodes, the data built alongside
+    # the points is built from the nodes it streams
+    code_data = None
+    if streaming_ingestion:
+        code_data = StreamedCodeData(code_nodes.nodes_config, build_bm25_index)
+    else:
+        build_article_index(code_nodes.nodes_config, code_nodes.nodes)
+        build_code_hierarchy(code_nodes.nodes_config, code_nodes.nodes)
+        if build_bm25_index:
+            update_bm25_index(code_nodes.nodes_config, lambda: code_nodes.nodes)
+    on_node = code_data.add if code_data is not None else None
+
+    shared_code_name = get_shared_code_name(code_nodes, collection_name)
+    if vector_store_backend == VectorStoreBackend.NUMPY:
+        index = index_given_nodes_locally(
+            code_nodes,
+            embed_model,
+            recreate_collection,
+            use_embedding_cache=use_embedding_cache,
+            streaming_ingestion=streaming_ingestion,
+            ingestion_batch_size=ingestion_batch_size,
+            vectors_dtype=vectors_dtype,
+            vector_quantization=vector_quantization,
+            rescore_oversampling=rescore_oversampling,
+            collection_name=collection_name,
+            on_node=on_node,
+        )
+        n_points = count_local_points(index.vector_store, shared_code_name)
+    else:
+        index = index_given_nodes(
+            code_nodes,
+            embed_model,
+            qdrant_sparse_vectors,
+            recreate_collection,
+            use_embedding_cache=use_embedding_cache,
+            incremental_sync=incremental_sync,
+            streaming_ingestion=streaming_ingestion,
+            ingestion_batch_size=ingestion_batch_size,
+            use_async=use_async,
+            vector_quantization=vector_quantization,
+            rescore_oversampling=rescore_oversampling,
+            collection_name=collection_name,
+            on_node=on_node,
+        )
+        client = index.vector_store.client
+        create_header_payload_indexes(client, collection_name)
+        if shared_collection:
+            create_code_payload_index(client, collection_name)
+        apply_collection_quantization(
+            client,
+            collection_name,
+            vector_quantization,
+            hybrid_search=qdrant_sparse_vectors,
+        )
+        n_points = count_points(client, collection_name, shared_code_name)
+
+    if code_data is not None:
+        code_data.save()
+    if reload_data:
+        # the articles fetched from Legifrance were saved over the source file
+        fingerprint = get_code_fingerprint(code_nodes, fingerprint_parameters)
+    if fingerprint is not None:
+        save_manifest_entry(
+            collection_name, vector_store_backend, code_name, fingerprint, n_points
+        )
+    return index, code_nodes.post_processors, code_nodes.nodes_config
+
+
+def attach_to_collection(
+    code_nodes: CodeNodes,
+    embedding_model: BaseEmbedding,
+    fingerprint: str,
+    collection_name: str,
+    vector_store_backend: VectorStoreBackend,
+    hybrid_search: bool,
+    with_bm25_index: bool,
+    use_async: bool = False,
+    vectors_dtype: str = "float32",
+    vector_quantization: VectorQuantization = VectorQuantization.NONE,
+    rescore_oversampling: float = 2.0,
+) -> Optional[VectorStoreIndex]:
+    """
+    The index of the collection when the manifest entry of the code matches
+    `fingerprint`, the data built alongside the points is on disk, and the
+    collection still holds the number of points recorded in the entry; None
+    otherwise. The nodes of the code are never built, checking the collection
+    takes a single count of its points.
+    """
+    manifest_entry = get_manifest_entry(
+        collection_name, vector_store_backend, code_nodes.code_name
+    )
+    if manifest_entry is None or manifest_entry["fingerprint"] != fingerprint:
+        return None
+    nodes_config = code_nodes.nodes_config
+    if not (
+        os.path.exists(get_article_index_path(nodes_config))
+        and os.path.exists(get_hierarchy_path(nodes_config))
+        and (bm25_index_exists(nodes_config) or not with_bm25_index)
+    ):
+        return None
+
+    code_name = get_shared_code_name(code_nodes, collection_name)
+    if vector_store_backend == VectorStoreBackend.NUMPY:
+        vector_store = get_numpy_vector_store(
+            collection_name,
+            code_name is not None,
+            vectors_dtype,
+            vector_quantization,
+            rescore_oversampling,
+        )
+        n_points = count_local_points(vector_store, code_name)
+    else:
+        client = QdrantClient("localhost", port=6333)
+        n_points = count_points(client, collection_name, code_name)
+    if n_points != manifest_entry["n_points"]:
+        logger.info(
+            f"The collection {collection_name} holds {n_points} points of "
+            f"{code_nodes.code_name} instead of the {manifest_entry['n_points']} "
+            "of its manifest."
+        )
+        return None
+
+    if vector_store_backend == VectorStoreBackend.QDRANT:
+        vector_store = get_qdrant_vector_store(
+            collection_name,
+            hybrid_search,
+            use_async,
+            vector_quantization,
+            rescore_oversampling,
+            client=client,
+        )
+    logger.info(
+        f"Using the collection {collection_name}, up to date with its manifest: "
+        f"{n_points} points of {code_nodes.code_name}."
     )
-    return index, code_nodes.post_processors
+    return VectorStoreIndex.from_vector_store(vector_store, embed_model=embedding_model)
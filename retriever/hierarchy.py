@@ -0,0 +1,258 @@
+import json
+import os
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (
+    FilterCondition,
+    MetadataFilter,
+    MetadataFilters,
+)
+from loguru import logger
+from qdrant_client import QdrantClient
+from qdrant_client.http import models as rest
+
+from .bm25 import fold_accents
+from .constants import path_dir_hierarchy
+
+# the headers of `possible_headers`, from the outermost to the innermost
+HEADER_LEVELS = [
+    "livre",
+    "titre",
+    "sous-titre",
+    "chapitre",
+    "section",
+    "sous-section",
+    "paragraphe",
+]
+
+
+def get_hierarchy_path(collection_name: str) -> str:
+    return os.path.join(path_dir_hierarchy, f"{collection_name}.json")
+
+
+def _fold(title: str) -> str:
+    return " ".join(fold_accents(title.lower()).split())
+
+
+@dataclass
+class HierarchyNode:
+    level: Optional[str] = None
+    title: Optional[str] = None
+    # keyed by (level, title)
+    children: Dict[Tuple[str, str], "HierarchyNode"] = field(default_factory=dict)
+    # the nodes directly under this header, not under one of its children
+    node_ids: List[str] = field(default_factory=list)
+
+    @property
+    def n_nodes(self) -> int:
+        return len(self.node_ids) + sum(
+            child.n_nodes for child in self.children.values()
+        )
+
+    def iter_node_ids(self) -> Iterable[str]:
+        yield from self.node_ids
+        for child in self.children.values():
+            yield from child.iter_node_ids()
+
+    def find_child(self, level: str, title: str) -> "HierarchyNode":
+        """
+        The child header of `level` matching `title`, ignoring case and accents.
+        A title matching no child exactly can be the unique one containing it.
+        """
+        children = [child for child in self.children.values() if child.level == level]
+        folded_title = _fold(title)
+        matches = [child for child in children if _fold(child.title) == folded_title]
+        if not matches:
+            matches = [
+                child for child in children if folded_title in _fold(child.title)
+            ]
+        if len(matches) == 1:
+            return matches[0]
+        message = (
+            f"{'Several' if matches else 'No'} {level} matching {title!r} under "
+            f"{self.title or 'the code'}"
+        )
+        candidates = [child.title for child in (matches or children)]
+        if candidates:
+            message += f", expected one of {candidates}"
+        raise ValueError(message + ".")
+
+    def to_dict(self) -> dict:
+        return {
+            "level": self.level,
+            "title": self.title,
+            "node_ids": self.node_ids,
+            "children": [child.to_dict() for child in self.children.values()],
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "HierarchyNode":
+        children = [cls.from_dict(child) for child in data["children"]]
+        return cls(
+            level=data["level"],
+            title=data["title"],
+            children={(child.level, child.title): child for child in children},
+            node_ids=data["node_ids"],
+        )
+
+
+@dataclass
+class CodeScope:
+    # the exact titles of every header from the code to the scope
+    headers: Dict[str, str]
+    node_ids: List[str]
+
+
+class CodeHierarchy:
+    """
+    Tree of the headers of a code (livre, titre, chapitre, ...), with the ids of the
+    nodes under each header.
+
+    A scope is a mapping from header levels to titles, e.g. `{"livre": "Des
+    personnes", "titre": "Du mariage"}`. The titles are the ones of the Legifrance
+    headers, without their numbering, which the API data does not keep.
+    """
+
+    def __init__(self, root: HierarchyNode):
+        self.root = root
+
+    @classmethod
+    def from_nodes(cls, nodes: Iterable[BaseNode]) -> "CodeHierarchy":
+        hierarchy = cls(HierarchyNode())
+        for node in nodes:
+            hierarchy.add_node(node)
+        return hierarchy
+
+    def add_node(self, node: BaseNode):
+        header = self.root
+        for level in HEADER_LEVELS:
+            title = node.metadata.get(level)
+            if title is None:
+                continue
+            header = header.children.setdefault(
+                (level, title), HierarchyNode(level=level, title=title)
+            )
+        header.node_ids.append(node.node_id)
+
+    @classmethod
+    def load(cls, path: str) -> "CodeHierarchy":
+        with open(path) as f:
+            return cls(HierarchyNode.from_dict(json.load(f)))
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.root.to_dict(), f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def find_path(self, scope: Dict[str, str]) -> List[HierarchyNode]:
+        """
+        The headers from the code to the scope, raise a ValueError if the scope is
+        not in the code. The intermediate levels can be omitted, e.g. the "chapitre"
+        of a "section" whose title is unique in its "titre".
+        """
+        unknown_levels = set(scope) - set(HEADER_LEVELS)
+        if unknown_levels:
+            raise ValueError(
+                f"Unknown header levels {sorted(unknown_levels)}, "
+                f"expected some of {HEADER_LEVELS}."
+            )
+        path = []
+        for level in HEADER_LEVELS:
+            if level in scope:
+                header = path[-1] if path else self.root
+                path += self._find_descendant_path(header, level, scope[level])
+        return path
+
+    @staticmethod
+    def _find_descendant_path(
+        header: HierarchyNode, level: str, title: str
+    ) -> List[HierarchyNode]:
+        try:
+            return [header.find_child(level, title)]
+        except ValueError as error:
+            paths = []
+            for child in header.children.values():
+                try:
+                    paths.append(
+                        [child]
+                        + CodeHierarchy._find_descendant_path(child, level, title)
+                    )
+                except ValueError:
+                    continue
+            if len(paths) == 1:
+                return paths[0]
+            raise error
+
+    def get_scope(self, scope: Dict[str, str]) -> "CodeScope":
+        path = self.find_path(scope)
+        return CodeScope(
+            headers={header.level: header.title for header in path},
+            node_ids=list((path[-1] if path else self.root).iter_node_ids()),
+        )
+
+    def describe(self, max_depth: int = 2) -> str:
+        """Indented outline of the headers, with their number of nodes."""
+        lines = []
+
+        def add_lines(header: HierarchyNode, depth: int):
+            for child in header.children.values():
+                lines.append(
+                    f"{'  ' * depth}{child.level}: {child.title} ({child.n_nodes})"
+                )
+                if depth + 1 < max_depth:
+                    add_lines(child, depth + 1)
+
+        add_lines(self.root, 0)
+        return "\n".join(lines)
+
+
+def get_scope_filters(scope: Dict[str, str]) -> MetadataFilters:
+    return MetadataFilters(
+        filters=[
+            MetadataFilter(key=level, value=title) for level, title in scope.items()
+        ],
+        condition=FilterCondition.AND,
+    )
+
+
+def build_code_hierarchy(
+    collection_name: str, nodes: Iterable[BaseNode] | CodeHierarchy
+) -> CodeHierarchy:
+    """Build the hierarchy of `nodes`, or take the one built with `add_node`, and
+    save it."""
+    if isinstance(nodes, CodeHierarchy):
+        hierarchy = nodes
+    else:
+        hierarchy = CodeHierarchy.from_nodes(nodes)
+    hierarchy.save(get_hierarchy_path(collection_name))
+    logger.info(
+        f"Hierarchy of {collection_name} built with "
+        f"{len(hierarchy.root.children)} top-level headers."
+    )
+    return hierarchy
+
+
+def load_code_hierarchy(collection_name: str) -> Optional[CodeHierarchy]:
+    path = get_hierarchy_path(collection_name)
+    if not os.path.exists(path):
+        return None
+    return CodeHierarchy.load(path)
+
+
+def create_header_payload_indexes(client: QdrantClient, collection_name: str):
+    """Index the headers of the payloads, so that the scoped searches only visit
+    the points of the scope."""
+    if not client.collection_exists(collection_name):
+        return
+    payload_schema = client.get_collection(collection_name).payload_schema
+    for level in HEADER_LEVELS:
+        if level not in payload_schema:
+            client.create_payload_index(
+                collection_name=collection_name,
+                field_name=level,
+                field_schema=rest.PayloadSchemaType.KEYWORD,
+            )
@@ -0,0 +1,111 @@
+from typing import Dict, List, Optional, Sequence
+
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.callbacks import CallbackManager
+from llama_index.core.schema import BaseNode, NodeWithScore, QueryBundle
+from llama_index.core.vector_stores.types import VectorStoreQueryResult
+from llama_index.core.vector_stores.utils import metadata_dict_to_node
+from llama_index.vector_stores.qdrant import QdrantVectorStore
+from llama_index.vector_stores.qdrant.utils import relative_score_fusion
+
+from .bm25 import BM25Index
+from .numpy_vector_store import NumpyVectorStore
+
+
+def get_nodes_by_id(
+    vector_store: QdrantVectorStore | NumpyVectorStore, node_ids: Sequence[str]
+) -> Dict[str, BaseNode]:
+    if not node_ids:
+        return {}
+    if isinstance(vector_store, NumpyVectorStore):
+        nodes = vector_store.get_nodes(node_ids)
+    else:
+        points = vector_store.client.retrieve(
+            collection_name=vector_store.collection_name,
+            ids=list(node_ids),
+            with_payload=True,
+            with_vectors=False,
+        )
+        nodes = [metadata_dict_to_node(point.payload) for point in points]
+    return {node.node_id: node for node in nodes}
+
+
+class BM25HybridRetriever(BaseRetriever):
+    """
+    Hybrid retriever fusing the dense results of `dense_retriever` with the results
+    of a `BM25Index` of the same collection.
+
+    The fusion is the one of the Qdrant hybrid search: the scores of both sides are
+    min-max normalized and summed with weights `alpha` (dense) and `1 - alpha`
+    (sparse). Only the nodes found by BM25 alone are fetched from the vector store.
+    """
+
+    def __init__(
+        self,
+        dense_retriever: BaseRetriever,
+        bm25_index: BM25Index,
+        vector_store: QdrantVectorStore | NumpyVectorStore,
+        similarity_top_k: int = 5,
+        sparse_top_k: Optional[int] = None,
+        alpha: float = 0.5,
+        node_ids: Optional[Sequence[str]] = None,
+        callback_manager: Optional[CallbackManager] = None,
+    ):
+        self._dense_retriever = dense_retriever
+        self._bm25_index = bm25_index
+        self._vector_store = vector_store
+        self._similarity_top_k = similarity_top_k
+        # same default as the Qdrant hybrid search
+        self._sparse_top_k = sparse_top_k or similarity_top_k
+        self._alpha = alpha
+        # the BM25 side is restricted to `node_ids`, the dense side to its filters
+        self._doc_mask = None
+        if node_ids is not None:
+            self._doc_mask = bm25_index.get_doc_mask(node_ids)
+        super().__init__(
+            callback_manager=callback_manager or dense_retriever.callback_manager
+        )
+
+    def _fuse(
+        self, query_bundle: QueryBundle, dense_nodes: List[NodeWithScore]
+    ) -> List[NodeWithScore]:
+        sparse_hits = self._bm25_index.query(
+            query_bundle.query_str, self._sparse_top_k, doc_mask=self._doc_mask
+        )
+        nodes = {node.node.node_id: node.node for node in dense_nodes}
+        nodes.update(
+            get_nodes_by_id(
+                self._vector_store,
+                [node_id for node_id, _ in sparse_hits if node_id not in nodes],
+            )
+        )
+        # nodes of the index missing from the vector store are skipped
+        sparse_hits = [
+            (node_id, score) for node_id, score in sparse_hits if node_id in nodes
+        ]
+
+        result = relative_score_fusion(
+            VectorStoreQueryResult(
+                nodes=[node.node for node in dense_nodes],
+                similarities=[node.score for node in dense_nodes],
+                ids=[node.node.node_id for node in dense_nodes],
+            ),
+            VectorStoreQueryResult(
+                nodes=[nodes[node_id] for node_id, _ in sparse_hits],
+                similarities=[score for _, score in sparse_hits],
+                ids=[node_id for node_id, _ in sparse_hits],
+            ),
+            alpha=self._alpha,
+            top_k=self._similarity_top_k,
+        )
+        return [
+            NodeWithScore(node=node, score=score)
+            for node, score in zip(result.nodes or [], result.similarities or [])
+        ]
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        return self._fuse(query_bundle, self._dense_retriever.retrieve(query_bundle))
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        dense_nodes = await self._dense_retriever.aretrieve(query_bundle)
+        return self._fuse(query_bundle, dense_nodes)
@@ -0,0 +1,238 @@
+import time
+from dataclasses import dataclass, field
+from queue import Queue
+from threading import Thread
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.schema import MetadataMode, TextNode
+from llama_index.core.utils import iter_batch
+from llama_index.vector_stores.qdrant import QdrantVectorStore
+from qdrant_client.http import models as rest
+from loguru import logger
+
+from data_ingestion.nodes_processing import CodeNodes, PAYLOAD_HASH_METADATA_KEY
+
+from .embedding_cache import EmbeddingCache, embed_nodes_with_cache, get_cache_namespace
+from .numpy_vector_store import NumpyVectorStore
+
+
+@dataclass
+class StageStats:
+    name: str
+    n_items: int = 0
+    seconds: float = 0.0
+
+    @property
+    def throughput(self) -> float:
+        return self.n_items / self.seconds if self.seconds > 0 else float("inf")
+
+
+@dataclass
+class IngestionReport:
+    stages: Dict[str, StageStats] = field(default_factory=dict)
+    n_unchanged: int = 0
+    n_deleted: int = 0
+    time_to_first_upsert: Optional[float] = None
+    total_seconds: float = 0.0
+
+    def log(self):
+        for stage in self.stages.values():
+            logger.info(
+                f"Stage {stage.name}: {stage.n_items} items in {stage.seconds:.2f}s "
+                f"({stage.throughput:.1f} items/s)."
+            )
+        logger.info(
+            f"Ingestion finished in {self.total_seconds:.2f}s, first upsert after "
+            f"{self.time_to_first_upsert or 0:.2f}s. {self.n_unchanged} unchanged "
+            f"nodes skipped, {self.n_deleted} stale points deleted."
+        )
+
+
+def _metered(iterable: Iterable, stats: StageStats) -> Iterator:
+    """Count the items of `iterable` and the time spent producing them.
+
+    The time includes the upstream stages, `run_ingestion_pipeline` subtracts it.
+    """
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            stats.seconds += time.perf_counter() - start
+            return
+        stats.seconds += time.perf_counter() - start
+        stats.n_items += 1
+        yield item
+
+
+def _upsert_worker(
+    vector_store: QdrantVectorStore | NumpyVectorStore,
+    batches: Queue,
+    stats: StageStats,
+    report: IngestionReport,
+    start_time: float,
+    errors: List[Exception],
+):
+    while True:
+        batch = batches.get()
+        if batch is None:
+            return
+        if errors:
+            # keep draining so that the producer never blocks on a full queue
+            continue
+        try:
+            start = time.perf_counter()
+            vector_store.add(batch)
+            stats.seconds += time.perf_counter() - start
+            stats.n_items += len(batch)
+            if report.time_to_first_upsert is None:
+                report.time_to_first_upsert = time.perf_counter() - start_time
+        except Exception as exc:
+            errors.append(exc)
+
+
+def delete_points(
+    vector_store: QdrantVectorStore | NumpyVectorStore, node_ids: List[str]
+) -> None:
+    if isinstance(vector_store, NumpyVectorStore):
+        vector_store.delete_nodes(node_ids)
+    else:
+        vector_store.client.delete(
+            collection_name=vector_store.collection_name,
+            points_selector=rest.PointIdsList(points=node_ids),
+        )
+
+
+def run_ingestion_pipeline(
+    code_nodes: CodeNodes,
+    vector_store: QdrantVectorStore | NumpyVectorStore,
+    embedding_model: BaseEmbedding,
+    batch_size: int = 64,
+    max_pending_batches: int = 2,
+    use_embedding_cache: bool = True,
+    stored_hashes: Optional[Dict[str, Optional[str]]] = None,
+    on_node: Optional[Callable[[TextNode], None]] = None,
+) -> IngestionReport:
+    """
+    Index a code into `vector_store` one batch of nodes at a time.
+
+    Articles are loaded, chunked and turned into nodes lazily, embedded by batches
+    of `batch_size` nodes and upserted by a background thread. At most
+    `max_pending_batches` embedded batches wait for the upsert, so the embedding
+    stage blocks when the vector store falls behind and memory stays bounded by
+    the batch size rather than the size of the code.
+
+    Parameters
+    ----------
+    code_nodes : CodeNodes
+        The code to index. Its `nodes` are never materialized.
+    vector_store : QdrantVectorStore | NumpyVectorStore
+        The vector store to write to.
+    embedding_model : BaseEmbedding
+        The embedding model to use.
+    batch_size : int, optional
+        Number of nodes per embedding request and per upsert, by default 64.
+    max_pending_batches : int, optional
+        Number of embedded batches allowed to wait for the upsert, by default 2.
+    use_embedding_cache : bool, optional
+        Whether to use the on-disk embedding cache, by default True.
+    stored_hashes : Dict[str, Optional[str]], optional
+        Payload hashes of the points already in the collection. When given, nodes
+        whose payload hash is unchanged are skipped and stored points that were
+        not produced by the pipeline are deleted at the end.
+    on_node : Callable[[TextNode], None], optional
+        Called with every node of the code, unchanged ones included, so that the
+        data built alongside the points is built in the same pass over the code.
+    """
+    report = IngestionReport()
+    start_time = time.perf_counter()
+    cache = (
+        EmbeddingCache(get_cache_namespace(embedding_model))
+        if use_embedding_cache
+        else None
+    )
+    seen_ids = set()
+
+    def skip_unchanged(nodes: Iterable[TextNode]) -> Iterator[TextNode]:
+        for node in nodes:
+            seen_ids.add(node.node_id)
+            if on_node is not None:
+                on_node(node)
+            if (
+                stored_hashes is not None
+                and stored_hashes.get(node.node_id)
+                == node.metadata[PAYLOAD_HASH_METADATA_KEY]
+            ):
+                report.n_unchanged += 1
+                continue
+            yield node
+
+    def embed(batches: Iterable[List[TextNode]]) -> Iterator[List[TextNode]]:
+        for batch in batches:
+            if cache is not None:
+                embed_nodes_with_cache(batch, embedding_model, cache)
+            else:
+                embeddings = embedding_model.get_text_embedding_batch(
+                    [
+                        node.get_content(metadata_mode=MetadataMode.EMBED)
+                        for node in batch
+                    ]
+                )
+                for node, embedding in zip(batch, embeddings):
+                    node.embedding = embedding
+            yield batch
+
+    stage_names = ["load_and_chunk", "build_nodes", "embed", "upsert"]
+    report.stages = {name: StageStats(name) for name in stage_names}
+    articles = _metered(code_nodes.iter_articles(), report.stages["load_and_chunk"])
+    nodes = _metered(code_nodes.iter_nodes(articles), report.stages["build_nodes"])
+    batches = iter_batch(skip_unchanged(nodes), batch_size)
+    embedded_batches = _metered(embed(batches), report.stages["embed"])
+
+    pending_batches = Queue(maxsize=max_pending_batches)
+    errors = []
+    worker = Thread(
+        target=_upsert_worker,
+        args=(
+            vector_store,
+            pending_batches,
+            report.stages["upsert"],
+            report,
+            start_time,
+            errors,
+        ),
+        daemon=True,
+    )
+    worker.start()
+    try:
+        for batch in embedded_batches:
+            if errors:
+                break
+            pending_batches.put(batch)
+    finally:
+        pending_batches.put(None)
+        worker.join()
+    if errors:
+        raise errors[0]
+
+    # `_metered` times include the upstream stages
+    embed_stats = report.stages["embed"]
+    embed_stats.n_items = report.stages["build_nodes"].n_items - report.n_unchanged
+    embed_stats.seconds -= report.stages["build_nodes"].seconds
+    report.stages["build_nodes"].seconds -= report.stages["load_and_chunk"].seconds
+
+    if stored_hashes is not None:
+        ids_to_delete = [
+            node_id for node_id in stored_hashes if node_id not in seen_ids
+        ]
+        if ids_to_delete:
+            delete_points(vector_store, ids_to_delete)
+        report.n_deleted = len(ids_to_delete)
+
+    if cache is not None:
+        cache.log_stats()
+    report.total_seconds = time.perf_counter() - start_time
+    report.log()
+    return report
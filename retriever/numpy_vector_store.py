@@ -0,0 +1,615 @@
+import json
+import os
+import shutil
+from dataclasses import dataclass, field, replace
+from threading import Lock
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    FilterCondition,
+    FilterOperator,
+    MetadataFilter,
+    MetadataFilters,
+    VectorStoreQuery,
+    VectorStoreQueryMode,
+    VectorStoreQueryResult,
+)
+from llama_index.core.vector_stores.utils import (
+    metadata_dict_to_node,
+    node_to_metadata_dict,
+)
+
+from schema import VectorQuantization
+
+from .constants import path_dir_vector_stores
+from .quantization import get_int8_scale, get_n_candidates, quantize, score_codes
+
+META_FILE_NAME = "meta.json"
+VECTORS_FILE_NAME = "vectors.bin"
+CODES_FILE_NAME = "codes.bin"
+PAYLOADS_FILE_NAME = "payloads.bin"
+# end offset of each payload in PAYLOADS_FILE_NAME, as int64
+PAYLOAD_ENDS_FILE_NAME = "payload_ends.bin"
+IDS_FILE_NAME = "ids.txt"
+DELETED_ROWS_FILE_NAME = "deleted_rows.txt"
+
+NODE_CONTENT_KEY = "_node_content"
+SUPPORTED_DTYPES = ("float32", "float16")
+# rows scored at once when the vectors are stored as float16
+SCORING_CHUNK_ROWS = 4096
+# the rows matching the filters are gathered before scoring when they are less than
+# this fraction of the rows, otherwise every row is scored
+SUBSET_SCORING_MAX_FRACTION = 0.5
+
+
+def get_persist_dir(collection_name: str) -> str:
+    return os.path.join(path_dir_vector_stores, collection_name)
+
+
+def _map(path: str, dtype, shape=None) -> Optional[np.memmap]:
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return None
+    return np.memmap(path, dtype=dtype, mode="r", shape=shape)
+
+
+@dataclass
+class _Rows:
+    """
+    The rows of a `NumpyVectorStore` at one point in time. `add`, `delete_nodes` and
+    `compact` replace the rows of the store instead of modifying them, so a query
+    reads consistent ids, tombstones and maps without holding the lock of the store.
+    """
+
+    ids: List[str] = field(default_factory=list)
+    id_to_row: Dict[str, int] = field(default_factory=dict)
+    live: np.ndarray = field(default_factory=lambda: np.zeros(0, dtype=bool))
+    vectors: Optional[np.memmap] = None
+    codes: Optional[np.memmap] = None
+    payloads: Optional[np.memmap] = None
+    payload_ends: Optional[np.memmap] = None
+    # decoded once, by the first query filtering on the metadata
+    metadata_rows: Optional[List[dict]] = None
+    masks: Dict[tuple, np.ndarray] = field(default_factory=dict)
+
+    def get_payload(self, row: int) -> dict:
+        start = self.payload_ends[row - 1] if row > 0 else 0
+        return json.loads(
+            self.payloads[start : self.payload_ends[row]].tobytes().decode("utf-8")
+        )
+
+    def get_metadata_rows(self) -> List[dict]:
+        """The payloads of every row without the node content."""
+        if self.metadata_rows is None:
+            metadata_rows = []
+            for row in range(len(self.ids)):
+                payload = self.get_payload(row)
+                payload.pop(NODE_CONTENT_KEY, None)
+                metadata_rows.append(payload)
+            self.metadata_rows = metadata_rows
+        return self.metadata_rows
+
+
+class NumpyVectorStore(BasePydanticVectorStore):
+    """
+    In-process vector store persisted in a directory, for collections small enough to
+    be scanned at every query.
+
+    The embeddings are stored with normalized rows in a memory-mapped float32 (or
+    float16) matrix, so a query is one matrix-vector product followed by an
+    `argpartition`. The payloads are the same as the ones of `QdrantVectorStore`,
+    stored as utf-8 JSON blobs and only decoded for the returned nodes and, once,
+    to build the metadata filters masks.
+
+    With a `quantization`, the compact codes of the vectors (see `quantization`) are
+    scanned instead of the vectors, and only the rows of the `oversampling` times
+    `similarity_top_k` best codes are rescored with their vectors.
+
+    Every file is only appended to: rows of deleted or replaced nodes are listed in
+    `deleted_rows.txt` until `compact` rewrites the store.
+
+    Parameters
+    ----------
+    persist_dir : str
+        The directory of the store, see `get_persist_dir`.
+    dtype : str, optional
+        "float32" or "float16", the type of the stored vectors. Only used when the
+        store is created, by default "float32".
+    quantization : VectorQuantization, optional
+        "none", "int8" or "binary", the codes scanned at query time. Only used when
+        the store is created, by default "none".
+    oversampling : float, optional
+        The number of candidates rescored by result of a query of a quantized store,
+        by default 2.0.
+    """
+
+    stores_text: bool = True
+    flat_metadata: bool = False
+    persist_dir: str
+    dtype: str = "float32"
+    quantization: VectorQuantization = VectorQuantization.NONE
+    oversampling: float = 2.0
+
+    _lock: Lock = PrivateAttr()
+    _dim: Optional[int] = PrivateAttr(default=None)
+    _int8_scale: float = PrivateAttr(default=1.0)
+    _rows: _Rows = PrivateAttr(default_factory=_Rows)
+
+    def __init__(
+        self,
+        persist_dir: str,
+        dtype: str = "float32",
+        quantization: VectorQuantization = VectorQuantization.NONE,
+        oversampling: float = 2.0,
+    ) -> None:
+        if dtype not in SUPPORTED_DTYPES:
+            raise ValueError(
+                f"Unsupported dtype {dtype}, use one of {SUPPORTED_DTYPES}."
+            )
+        super().__init__(
+            persist_dir=persist_dir,
+            dtype=dtype,
+            quantization=VectorQuantization(quantization),
+            oversampling=oversampling,
+        )
+        self._lock = Lock()
+        self._load()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "NumpyVectorStore"
+
+    @property
+    def client(self) -> None:
+        return None
+
+    @property
+    def collection_name(self) -> str:
+        return os.path.basename(os.path.normpath(self.persist_dir))
+
+    def _path(self, file_name: str) -> str:
+        return os.path.join(self.persist_dir, file_name)
+
+    def _get_rows(self) -> _Rows:
+        """The current rows, to be read without the lock."""
+        with self._lock:
+            return self._rows
+
+    # not `__len__`: llama-index tests vector stores for truthiness
+    @property
+    def n_nodes(self) -> int:
+        return len(self._get_rows().id_to_row)
+
+    @property
+    def n_deleted_rows(self) -> int:
+        rows = self._get_rows()
+        return len(rows.ids) - len(rows.id_to_row)
+
+    @property
+    def is_quantized(self) -> bool:
+        return self.quantization != VectorQuantization.NONE
+
+    @property
+    def scanned_nbytes(self) -> int:
+        """Bytes read by a query scanning every row: the codes when quantized."""
+        rows = self._get_rows()
+        scanned = rows.codes if self.is_quantized else rows.vectors
+        return scanned.nbytes if scanned is not None else 0
+
+    def _get_meta(self) -> dict:
+        return {
+            "dim": self._dim,
+            "dtype": self.dtype,
+            "quantization": self.quantization.value,
+            "int8_scale": self._int8_scale,
+        }
+
+    def _get_code_shape(self, n_rows: int) -> tuple:
+        if self.quantization == VectorQuantization.BINARY:
+            return n_rows, (self._dim + 7) // 8
+        return n_rows, self._dim
+
+    def _load(self):
+        self._rows = _Rows()
+        if not os.path.exists(self._path(META_FILE_NAME)):
+            self._dim = None
+            return
+
+        with open(self._path(META_FILE_NAME), "r") as js:
+            meta = json.load(js)
+        self._dim, self.dtype = meta["dim"], meta["dtype"]
+        self.quantization = VectorQuantization(meta.get("quantization", "none"))
+        self._int8_scale = meta.get("int8_scale", 1.0)
+        ids = []
+        if os.path.exists(self._path(IDS_FILE_NAME)):
+            with open(self._path(IDS_FILE_NAME), "r") as f:
+                ids = f.read().split()
+        # ids are written last, so a crash can only leave extra vectors and payloads,
+        # which are dropped so that the next rows are appended at the right offsets
+        self._truncate(
+            VECTORS_FILE_NAME, len(ids) * self._dim * np.dtype(self.dtype).itemsize
+        )
+        if self.is_quantized:
+            self._truncate(
+                CODES_FILE_NAME, int(np.prod(self._get_code_shape(len(ids))))
+            )
+        self._truncate(PAYLOAD_ENDS_FILE_NAME, len(ids) * 8)
+        payload_ends = _map(self._path(PAYLOAD_ENDS_FILE_NAME), np.int64)
+        self._truncate(
+            PAYLOADS_FILE_NAME, int(payload_ends[-1]) if payload_ends is not None else 0
+        )
+        del payload_ends
+        live = np.ones(len(ids), dtype=bool)
+        if os.path.exists(self._path(DELETED_ROWS_FILE_NAME)):
+            with open(self._path(DELETED_ROWS_FILE_NAME), "r") as f:
+                deleted_rows = [int(row) for row in f.read().split()]
+            live[[row for row in deleted_rows if row < len(ids)]] = False
+        id_to_row = {node_id: row for row, node_id in enumerate(ids) if live[row]}
+        self._rows = self._map_rows(ids, id_to_row, live)
+
+    def _truncate(self, file_name: str, size: int):
+        path = self._path(file_name)
+        if os.path.exists(path) and os.path.getsize(path) > size:
+            with open(path, "r+b") as f:
+                f.truncate(size)
+
+    def _map_rows(
+        self, ids: List[str], id_to_row: Dict[str, int], live: np.ndarray
+    ) -> _Rows:
+        """The rows of `ids`, with new maps of the files."""
+        n_rows = len(ids)
+        if n_rows == 0:
+            return _Rows(ids=ids, id_to_row=id_to_row, live=live)
+        return _Rows(
+            ids=ids,
+            id_to_row=id_to_row,
+            live=live,
+            vectors=_map(
+                self._path(VECTORS_FILE_NAME), self.dtype, shape=(n_rows, self._dim)
+            ),
+            codes=(
+                _map(
+                    self._path(CODES_FILE_NAME),
+                    (
+                        np.uint8
+                        if self.quantization == VectorQuantization.BINARY
+                        else np.int8
+                    ),
+                    shape=self._get_code_shape(n_rows),
+                )
+                if self.is_quantized
+                else None
+            ),
+            payloads=_map(self._path(PAYLOADS_FILE_NAME), np.uint8),
+            payload_ends=_map(
+                self._path(PAYLOAD_ENDS_FILE_NAME), np.int64, shape=(n_rows,)
+            ),
+        )
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        if not nodes:
+            return []
+        vectors = np.asarray([node.get_embedding() for node in nodes], np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1, norms)
+        payloads = [
+            json.dumps(
+                node_to_metadata_dict(
+                    node, remove_text=False, flat_metadata=self.flat_metadata
+                )
+            ).encode("utf-8")
+            for node in nodes
+        ]
+
+        with self._lock:
+            if self._dim is None:
+                self._dim = vectors.shape[1]
+                if self.quantization == VectorQuantization.INT8:
+                    # the scale of the first vectors is kept for the next ones
+                    self._int8_scale = get_int8_scale(vectors)
+                os.makedirs(self.persist_dir, exist_ok=True)
+                with open(self._path(META_FILE_NAME), "w") as js:
+                    json.dump(self._get_meta(), js)
+
+            rows = self._rows
+            first_row = len(rows.ids)
+            payload_start = (
+                int(rows.payload_ends[-1]) if rows.payload_ends is not None else 0
+            )
+            payload_ends = payload_start + np.cumsum([len(p) for p in payloads])
+
+            # replaced nodes, including duplicates within `nodes`
+            deleted_rows = []
+            id_to_row = dict(rows.id_to_row)
+            for i, node in enumerate(nodes):
+                if node.node_id in id_to_row:
+                    deleted_rows.append(id_to_row[node.node_id])
+                id_to_row[node.node_id] = first_row + i
+
+            with open(self._path(VECTORS_FILE_NAME), "ab") as f:
+                f.write(vectors.astype(self.dtype).tobytes())
+            if self.is_quantized:
+                with open(self._path(CODES_FILE_NAME), "ab") as f:
+                    f.write(
+                        quantize(vectors, self.quantization, self._int8_scale).tobytes()
+                    )
+            with open(self._path(PAYLOADS_FILE_NAME), "ab") as f:
+                f.write(b"".join(payloads))
+            with open(self._path(PAYLOAD_ENDS_FILE_NAME), "ab") as f:
+                f.write(payload_ends.astype(np.int64).tobytes())
+            with open(self._path(IDS_FILE_NAME), "a") as f:
+                f.write("".join(node.node_id + "\n" for node in nodes))
+            self._write_deleted_rows(deleted_rows)
+
+            live = np.concatenate([rows.live, np.ones(len(nodes), dtype=bool)])
+            live[deleted_rows] = False
+            self._rows = self._map_rows(
+                rows.ids + [node.node_id for node in nodes], id_to_row, live
+            )
+        return [node.node_id for node in nodes]
+
+    def _write_deleted_rows(self, rows: List[int]):
+        if rows:
+            with open(self._path(DELETED_ROWS_FILE_NAME), "a") as f:
+                f.write("".join(f"{row}\n" for row in rows))
+
+    def delete_nodes(self, node_ids: Sequence[str]) -> None:
+        with self._lock:
+            id_to_row = dict(self._rows.id_to_row)
+            deleted_rows = [
+                id_to_row.pop(node_id) for node_id in node_ids if node_id in id_to_row
+            ]
+            if not deleted_rows:
+                return
+            self._write_deleted_rows(deleted_rows)
+            live = self._rows.live.copy()
+            live[deleted_rows] = False
+            # the rows themselves are unchanged, with their decoded metadata
+            self._rows = replace(self._rows, id_to_row=id_to_row, live=live)
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        self.delete_nodes(
+            [
+                node_id
+                for node_id, doc_id in self.get_metadata_values("doc_id").items()
+                if doc_id == ref_doc_id
+            ]
+        )
+
+    def clear(self) -> None:
+        with self._lock:
+            shutil.rmtree(self.persist_dir, ignore_errors=True)
+            self._load()
+
+    def compact(self) -> None:
+        """Rewrite the store without the rows of deleted nodes."""
+        with self._lock:
+            rows = self._rows
+            if len(rows.ids) == len(rows.id_to_row):
+                return
+            live_rows = sorted(rows.id_to_row.values())
+            payloads = [
+                json.dumps(rows.get_payload(row)).encode("utf-8") for row in live_rows
+            ]
+            tmp_dir = f"{os.path.normpath(self.persist_dir)}.tmp"
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            os.makedirs(tmp_dir)
+            with open(os.path.join(tmp_dir, META_FILE_NAME), "w") as js:
+                json.dump(self._get_meta(), js)
+            with open(os.path.join(tmp_dir, VECTORS_FILE_NAME), "wb") as f:
+                f.write(np.ascontiguousarray(rows.vectors[live_rows]).tobytes())
+            if self.is_quantized:
+                with open(os.path.join(tmp_dir, CODES_FILE_NAME), "wb") as f:
+                    f.write(np.ascontiguousarray(rows.codes[live_rows]).tobytes())
+            with open(os.path.join(tmp_dir, PAYLOADS_FILE_NAME), "wb") as f:
+                f.write(b"".join(payloads))
+            with open(os.path.join(tmp_dir, PAYLOAD_ENDS_FILE_NAME), "wb") as f:
+                f.write(
+                    np.cumsum([len(p) for p in payloads]).astype(np.int64).tobytes()
+                )
+            with open(os.path.join(tmp_dir, IDS_FILE_NAME), "w") as f:
+                f.write("".join(rows.ids[row] + "\n" for row in live_rows))
+
+            # the queries still running keep their own maps of the replaced files
+            self._rows = _Rows()
+            shutil.rmtree(self.persist_dir)
+            os.replace(tmp_dir, self.persist_dir)
+            self._load()
+
+    def get_metadata_values(self, key: str) -> Dict[str, Any]:
+        """Map the id of every node to the value of its metadata `key`."""
+        rows = self._get_rows()
+        metadata_rows = rows.get_metadata_rows()
+        return {
+            node_id: metadata_rows[row].get(key)
+            for node_id, row in rows.id_to_row.items()
+        }
+
+    def get_mean_vector(
+        self, node_ids: Optional[Iterable[str]] = None
+    ) -> Optional[np.ndarray]:
+        """Mean of the stored vectors of `node_ids`, by default of every node, None
+        if there is none."""
+        rows = self._get_rows()
+        if node_ids is None:
+            node_rows = list(rows.id_to_row.values())
+        else:
+            node_rows = [rows.id_to_row[node_id] for node_id in node_ids]
+        if not node_rows:
+            return None
+        return np.asarray(rows.vectors[sorted(node_rows)], dtype=np.float64).mean(
+            axis=0
+        )
+
+    def get_nodes(self, node_ids: Sequence[str]) -> List[BaseNode]:
+        """The stored nodes of `node_ids`, skipping the unknown ids."""
+        rows = self._get_rows()
+        return [
+            metadata_dict_to_node(rows.get_payload(rows.id_to_row[node_id]))
+            for node_id in node_ids
+            if node_id in rows.id_to_row
+        ]
+
+    def _filter_mask(self, rows: _Rows, metadata_filter: MetadataFilter) -> np.ndarray:
+        value = metadata_filter.value
+        cache_key = (
+            metadata_filter.key,
+            metadata_filter.operator,
+            tuple(value) if isinstance(value, list) else value,
+        )
+        if cache_key not in rows.masks:
+            operator = metadata_filter.operator
+            # the comma-separated values of the Qdrant vector store are also accepted
+            values = value.split(",") if isinstance(value, str) else value
+            matches = {
+                FilterOperator.EQ: lambda v: v == value,
+                FilterOperator.NE: lambda v: v != value,
+                FilterOperator.GT: lambda v: v is not None and v > value,
+                FilterOperator.GTE: lambda v: v is not None and v >= value,
+                FilterOperator.LT: lambda v: v is not None and v < value,
+                FilterOperator.LTE: lambda v: v is not None and v <= value,
+                FilterOperator.IN: lambda v: v in values,
+                FilterOperator.NIN: lambda v: v not in values,
+                FilterOperator.CONTAINS: lambda v: isinstance(v, list) and value in v,
+                FilterOperator.TEXT_MATCH: lambda v: isinstance(v, str) and value in v,
+            }.get(operator)
+            if matches is None:
+                raise ValueError(f"Unsupported filter operator {operator}.")
+            rows.masks[cache_key] = np.fromiter(
+                (
+                    matches(metadata.get(metadata_filter.key))
+                    for metadata in rows.get_metadata_rows()
+                ),
+                dtype=bool,
+                count=len(rows.ids),
+            )
+        return rows.masks[cache_key]
+
+    def _filters_mask(self, rows: _Rows, filters: MetadataFilters) -> np.ndarray:
+        masks = [
+            (
+                self._filters_mask(rows, f)
+                if isinstance(f, MetadataFilters)
+                else self._filter_mask(rows, f)
+            )
+            for f in filters.filters
+        ]
+        if not masks:
+            return np.ones(len(rows.ids), dtype=bool)
+        if filters.condition == FilterCondition.OR:
+            return np.logical_or.reduce(masks)
+        return np.logical_and.reduce(masks)
+
+    def _score(
+        self,
+        rows: _Rows,
+        query_vector: np.ndarray,
+        row_ids: Optional[np.ndarray] = None,
+        use_codes: bool = False,
+    ) -> np.ndarray:
+        """The scores of every row, or of `row_ids` only, approximated from the codes
+        with `use_codes`."""
+        if use_codes:
+            codes = rows.codes if row_ids is None else np.take(rows.codes, row_ids, 0)
+            return score_codes(codes, query_vector, self.quantization)
+        vectors = rows.vectors
+        if row_ids is not None:
+            # only the rows of the subset are read
+            vectors = np.take(vectors, row_ids, axis=0)
+        if self.dtype == "float32":
+            return vectors @ query_vector
+        return np.concatenate(
+            [
+                vectors[start : start + SCORING_CHUNK_ROWS].astype(np.float32)
+                @ query_vector
+                for start in range(0, len(vectors), SCORING_CHUNK_ROWS)
+            ]
+        )
+
+    def _get_query_mask(self, rows: _Rows, query: VectorStoreQuery) -> np.ndarray:
+        if query.mode != VectorStoreQueryMode.DEFAULT:
+            raise ValueError(f"{self.class_name()} only supports dense queries.")
+        mask = rows.live
+        if query.filters is not None:
+            mask = mask & self._filters_mask(rows, query.filters)
+        if query.node_ids:
+            mask = mask & np.isin(rows.ids, query.node_ids)
+        if query.doc_ids:
+            doc_ids = [metadata.get("doc_id") for metadata in rows.get_metadata_rows()]
+            mask = mask & np.isin(doc_ids, query.doc_ids)
+        return mask
+
+    @staticmethod
+    def _get_top_result(
+        rows: _Rows, row_ids: np.ndarray, scores: np.ndarray, top_k: int
+    ) -> VectorStoreQueryResult:
+        """The result of the `top_k` best `row_ids`, given their `scores`."""
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+        top = top[np.argsort(-scores[top])]
+        top_row_ids = row_ids[top]
+        return VectorStoreQueryResult(
+            nodes=[metadata_dict_to_node(rows.get_payload(row)) for row in top_row_ids],
+            similarities=scores[top].tolist(),
+            ids=[rows.ids[row] for row in top_row_ids],
+        )
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        rows = self._get_rows()
+        row_ids = np.flatnonzero(self._get_query_mask(rows, query))
+        top_k = min(query.similarity_top_k, len(row_ids))
+        if top_k == 0:
+            return VectorStoreQueryResult(nodes=[], similarities=[], ids=[])
+        query_vector = np.asarray(query.query_embedding, dtype=np.float32)
+        query_vector /= np.linalg.norm(query_vector) or 1
+        if len(row_ids) < SUBSET_SCORING_MAX_FRACTION * len(rows.ids):
+            scores = self._score(rows, query_vector, row_ids, self.is_quantized)
+        else:
+            scores = self._score(rows, query_vector, use_codes=self.is_quantized)
+            scores = scores[row_ids]
+        if self.is_quantized:
+            n_candidates = get_n_candidates(top_k, self.oversampling, len(row_ids))
+            candidates = np.argpartition(-scores, n_candidates - 1)[:n_candidates]
+            row_ids = np.sort(row_ids[candidates])
+            scores = self._score(rows, query_vector, row_ids)
+        return self._get_top_result(rows, row_ids, scores, top_k)
+
+    def query_batch(
+        self, queries: Sequence[VectorStoreQuery]
+    ) -> List[VectorStoreQueryResult]:
+        """
+        Same as `query` for several queries, whose vectors are all scored with one
+        matrix product. The queries of a quantized store are run one by one, their
+        candidates being different rows of the vectors.
+        """
+        if self.is_quantized:
+            return [self.query(query) for query in queries]
+        rows = self._get_rows()
+        masks = [self._get_query_mask(rows, query) for query in queries]
+        if not queries or not rows.id_to_row:
+            return [
+                VectorStoreQueryResult(nodes=[], similarities=[], ids=[])
+                for _ in queries
+            ]
+        query_vectors = np.asarray(
+            [query.query_embedding for query in queries], dtype=np.float32
+        )
+        norms = np.linalg.norm(query_vectors, axis=1, keepdims=True)
+        query_vectors /= np.where(norms == 0, 1, norms)
+        # one column of scores by query
+        scores = self._score(rows, query_vectors.T)
+        results = []
+        for i, (query, mask) in enumerate(zip(queries, masks)):
+            row_ids = np.flatnonzero(mask)
+            top_k = min(query.similarity_top_k, len(row_ids))
+            if top_k == 0:
+                results.append(
+                    VectorStoreQueryResult(nodes=[], similarities=[], ids=[])
+                )
+                continue
+            results.append(
+                self._get_top_result(rows, row_ids, scores[row_ids, i], top_k)
+            )
+        return results
@@ -0,0 +1,190 @@
+"""
+Compact representations of the stored vectors, searched instead of the full-precision
+ones: int8 scalar quantization (4 times smaller than float32) and binary quantization
+(32 times smaller). The candidates of the compact search are oversampled, then
+rescored with the full-precision vectors, which are only read for them.
+"""
+
+import math
+from typing import Any, List, Optional
+
+import numpy as np
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.vector_stores.types import (
+    VectorStoreQuery,
+    VectorStoreQueryMode,
+    VectorStoreQueryResult,
+)
+from llama_index.vector_stores.qdrant import QdrantVectorStore
+from qdrant_client import QdrantClient
+from qdrant_client.http import models as rest
+
+from schema import VectorQuantization
+
+# name of the dense vectors in the collections created with `enable_hybrid`
+DENSE_VECTOR_NAME = "text-dense"
+# the int8 range covers this quantile of the absolute non-zero vector components,
+# the larger ones are clipped
+INT8_QUANTILE = 0.999
+# number of set bits of every byte
+POPCOUNT_TABLE = np.array([bin(byte).count("1") for byte in range(256)], np.uint8)
+
+
+def get_n_candidates(top_k: int, oversampling: float, n_rows: int) -> int:
+    return min(n_rows, max(top_k, math.ceil(oversampling * top_k)))
+
+
+def get_code_nbytes(dimensions: int, quantization: VectorQuantization) -> int:
+    """Bytes of the compact code of a vector, 4 bytes per dimension unquantized."""
+    quantization = VectorQuantization(quantization)
+    if quantization == VectorQuantization.INT8:
+        return dimensions
+    if quantization == VectorQuantization.BINARY:
+        return math.ceil(dimensions / 8)
+    return 4 * dimensions
+
+
+def get_int8_scale(vectors: np.ndarray) -> float:
+    components = np.abs(vectors[vectors != 0])
+    return float(np.quantile(components, INT8_QUANTILE)) if components.size else 1.0
+
+
+def quantize(
+    vectors: np.ndarray, quantization: VectorQuantization, int8_scale: float = 1.0
+) -> np.ndarray:
+    """The int8 codes or the packed sign bits of the rows of `vectors`."""
+    quantization = VectorQuantization(quantization)
+    if quantization == VectorQuantization.INT8:
+        return np.clip(np.rint(vectors * (127 / int8_scale)), -127, 127).astype(np.int8)
+    if quantization == VectorQuantization.BINARY:
+        return np.packbits(vectors > 0, axis=1)
+    raise ValueError(f"No codes for the quantization {quantization}.")
+
+
+def score_codes(
+    codes: np.ndarray,
+    query_vector: np.ndarray,
+    quantization: VectorQuantization,
+    chunk_rows: int = 4096,
+) -> np.ndarray:
+    """
+    Approximate similarities between the query and the codes, only meant to rank
+    them: dot products with the int8 codes, and minus the Hamming distances between
+    the sign bits for the binary codes.
+    """
+    quantization = VectorQuantization(quantization)
+    if quantization == VectorQuantization.BINARY:
+        query_code = np.packbits(query_vector > 0)
+        return -np.concatenate(
+            [
+                POPCOUNT_TABLE[
+                    np.bitwise_xor(codes[start : start + chunk_rows], query_code)
+                ].sum(axis=1, dtype=np.int32)
+                for start in range(0, len(codes), chunk_rows)
+            ]
+        )
+    return np.concatenate(
+        [
+            codes[start : start + chunk_rows].astype(np.float32) @ query_vector
+            for start in range(0, len(codes), chunk_rows)
+        ]
+    )
+
+
+def get_qdrant_quantization_config(
+    quantization: VectorQuantization,
+) -> Optional[rest.QuantizationConfig]:
+    # the compact vectors stay in RAM, the original ones are read for rescoring
+    quantization = VectorQuantization(quantization)
+    if quantization == VectorQuantization.INT8:
+        return rest.ScalarQuantization(
+            scalar=rest.ScalarQuantizationConfig(
+                type=rest.ScalarType.INT8, quantile=INT8_QUANTILE, always_ram=True
+            )
+        )
+    if quantization == VectorQuantization.BINARY:
+        return rest.BinaryQuantization(
+            binary=rest.BinaryQuantizationConfig(always_ram=True)
+        )
+    return None
+
+
+def apply_collection_quantization(
+    client: QdrantClient,
+    collection_name: str,
+    quantization: VectorQuantization,
+    hybrid_search: bool = False,
+):
+    """
+    Quantize the dense vectors of the collection and move the original ones to disk,
+    unless already done. Qdrant builds the quantized segments in the background.
+    """
+    quantization_config = get_qdrant_quantization_config(quantization)
+    if quantization_config is None or not client.collection_exists(collection_name):
+        return
+    if client.get_collection(collection_name).config.quantization_config is not None:
+        return
+    client.update_collection(
+        collection_name=collection_name,
+        vectors_config={
+            DENSE_VECTOR_NAME if hybrid_search else "": rest.VectorParamsDiff(
+                on_disk=True
+            )
+        },
+        quantization_config=quantization_config,
+    )
+
+
+class RescoringQdrantVectorStore(QdrantVectorStore):
+    """
+    Qdrant vector store searching the quantized vectors of its collection for
+    `oversampling` times more candidates than asked, rescored with the original
+    vectors. The sparse and hybrid queries are the ones of `QdrantVectorStore`.
+    """
+
+    _oversampling: float = PrivateAttr()
+
+    def __init__(self, *args: Any, oversampling: float = 2.0, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self._oversampling = oversampling
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "RescoringQdrantVectorStore"
+
+    def _get_search_request(self, query: VectorStoreQuery, **kwargs: Any):
+        query_filter = kwargs.get("qdrant_filters") or self._build_query_filter(query)
+        vector: List[float] | rest.NamedVector = query.query_embedding
+        if self.enable_hybrid:
+            vector = rest.NamedVector(name=DENSE_VECTOR_NAME, vector=vector)
+        return rest.SearchRequest(
+            vector=vector,
+            limit=query.similarity_top_k,
+            filter=query_filter,
+            with_payload=True,
+            params=rest.SearchParams(
+                quantization=rest.QuantizationSearchParams(
+                    rescore=True, oversampling=self._oversampling
+                )
+            ),
+        )
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        if query.mode != VectorStoreQueryMode.DEFAULT:
+            return super().query(query, **kwargs)
+        response = self._client.search_batch(
+            collection_name=self.collection_name,
+            requests=[self._get_search_request(query, **kwargs)],
+        )
+        return self.parse_to_query_result(response[0])
+
+    async def aquery(
+        self, query: VectorStoreQuery, **kwargs: Any
+    ) -> VectorStoreQueryResult:
+        if query.mode != VectorStoreQueryMode.DEFAULT:
+            return await super().aquery(query, **kwargs)
+        response = await self._aclient.search_batch(
+            collection_name=self.collection_name,
+            requests=[self._get_search_request(query, **kwargs)],
+        )
+        return self.parse_to_query_result(response[0])
@@ -9,3 +9,42 @@ class OpenAISupportedModels(str, Enum):
     ADA = "text-embedding-ada-002"
     V3_SMALL = "text-embedding-3-small"
     V3_LARGE = "text-embedding-3-large"
+
+
+# models trained with Matryoshka representation learning, whose embeddings can be
+# shortened with the `dimensions` parameter of the API
+MATRYOSHKA_MODELS = (
+    OpenAISupportedModels.V3_SMALL.value,
+    OpenAISupportedModels.V3_LARGE.value,
+)
+
+
+# maximum number of input tokens of each embedding model
+EMBEDDING_MODELS_MAX_TOKENS = {
+    MistralSupportedModels.MISTRAL_EMBED.value: 8192,
+    OpenAISupportedModels.ADA.value: 8191,
+    OpenAISupportedModels.V3_SMALL.value: 8191,
+    OpenAISupportedModels.V3_LARGE.value: 8191,
+}
+# FastEmbed ONNX models truncate their input to 512 tokens
+FASTEMBED_MAX_TOKENS = 512
+# the local hashing embedding has no input limit, its nodes are chunked like the
+# OpenAI ones that it stands for in the offline benchmarks
+HASHING_EMBEDDING_PREFIX = "hashing"
+HASHING_EMBEDDING_MAX_TOKENS = 8191
+
+
+class VectorStoreBackend(str, Enum):
+    QDRANT = "qdrant"
+    NUMPY = "numpy"
+
+
+class SparseIndexBackend(str, Enum):
+    BM25 = "bm25"
+    QDRANT = "qdrant"
+
+
+class VectorQuantization(str, Enum):
+    NONE = "none"
+    INT8 = "int8"
+    BINARY = "binary"
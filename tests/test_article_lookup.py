@@ -0,0 +1,131 @@
+import pytest
+from llama_index.core.schema import TextNode
+
+from data_ingestion.nodes_processing import CODE_NAME_METADATA_KEY
+from query.article_lookup import mentions_other_text, parse_article_references
+from retriever.article_index import (
+    ARTICLE_NUMBER_METADATA_KEY,
+    ArticleIndex,
+    get_article_sort_key,
+    normalize_article_number,
+)
+
+
+@pytest.mark.parametrize(
+    "query, references",
+    [
+        ("Que dit l'article 1240 ?", [("1240", None)]),
+        ("Que dit l'article 1240-1 ?", [("1240-1", None)]),
+        ("Que prévoit l'article L. 121-1 ?", [("L. 121-1", None)]),
+        ("art. R417-4", [("R417-4", None)]),
+        (
+            "articles 1240, 1241 et 1242",
+            [("1240", None), ("1241", None), ("1242", None)],
+        ),
+        ("articles 1240 à 1244", [("1240", "1244")]),
+        ("articles 1240 a 1244", [("1240", "1244")]),
+        ("articles 1240 au 1244", [("1240", "1244")]),
+        ("articles L. 121-1 à 121-3", [("L. 121-1", "L121-3")]),
+        ("article 1er", [("1", None)]),
+        ("articles 1er à 5", [("1", "5")]),
+        ("L'article 12 a été modifié", [("12", None)]),
+        ("Quelle est la vitesse maximale sur autoroute ?", []),
+    ],
+)
+def test_parse_article_references(query, references):
+    assert parse_article_references(query) == references
+
+
+def test_mentions_other_text():
+    assert mentions_other_text("article 3 du code pénal", "Code civil")
+    assert not mentions_other_text("article 3 du code civil", "Code civil")
+    assert not mentions_other_text("article 3", "Code civil")
+    assert not mentions_other_text(
+        "article L. 1 du code de la propriete intellectuelle",
+        "Code de la propriété intellectuelle",
+    )
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "Que dit l'article 7 de la loi de 1978 ?",
+        "article 2 du décret n° 2019-536",
+        "l'article 4 de l'ordonnance du 10 février 2016",
+        "article 6 du règlement général sur la protection des données",
+        "article 3 de la directive 2011/83/UE",
+        "l'article 66 de la Constitution",
+        "article 8 de la Convention européenne des droits de l'homme",
+    ],
+)
+def test_mentions_other_text(query):
+    assert mentions_other_text(query, "Code civil")
+    assert parse_article_references(query)
+
+
+def test_mentions_other_text_with_the_code_name():
+    assert not mentions_other_text(
+        "l'article 1240 du code civil, modifié par l'ordonnance de 2016", "Code civil"
+    )
+
+
+def test_normalize_article_number():
+    assert normalize_article_number("L. 121-1") == "L121-1"
+    assert normalize_article_number("r 417-4") == "R417-4"
+
+
+def test_article_sort_key():
+    numbers = ["L122", "L121-10", "L121-2", "L121"]
+    assert sorted(numbers, key=get_article_sort_key) == [
+        "L121",
+        "L121-2",
+        "L121-10",
+        "L122",
+    ]
+
+
+def make_article_index() -> ArticleIndex:
+    articles = ["1", "2", "3_chunk_0", "3_chunk_1", "10"]
+    nodes = [
+        TextNode(
+            id_=f"node-{article}",
+            text="",
+            metadata={
+                CODE_NAME_METADATA_KEY: "Code civil",
+                ARTICLE_NUMBER_METADATA_KEY: article.split("_")[0],
+            },
+        )
+        for article in articles
+    ]
+    return ArticleIndex.from_nodes(nodes)
+
+
+def test_article_index_resolves_articles_and_ranges():
+    article_index = make_article_index()
+    assert article_index.code_name == "Code civil"
+    assert article_index.get_node_ids("2") == ["node-2"]
+    # the chunks of a long article share its number
+    assert article_index.get_node_ids("3") == ["node-3_chunk_0", "node-3_chunk_1"]
+    assert article_index.get_node_ids("2", "10") == [
+        "node-2",
+        "node-3_chunk_0",
+        "node-3_chunk_1",
+        "node-10",
+    ]
+
+
+def test_article_index_rejects_unknown_articles_and_reversed_ranges():
+    article_index = make_article_index()
+    assert article_index.get_node_ids("4") is None
+    assert article_index.get_node_ids("1", "4") is None
+    assert article_index.get_node_ids("3", "2") is None
+
+
+def test_article_index_is_saved_and_loaded(tmp_path):
+    article_index = make_article_index()
+    path = str(tmp_path / "article_index" / "collection.json")
+    article_index.save(path)
+    loaded = ArticleIndex.load(path)
+    assert loaded.code_name == article_index.code_name
+    assert loaded.articles == article_index.articles
+    assert loaded.article_numbers == article_index.article_numbers
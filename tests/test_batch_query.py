@@ -0,0 +1,119 @@
+import pytest
+from llama_index.core import Settings, VectorStoreIndex
+from llama_index.core.query_engine import RetrieverQueryEngine
+from llama_index.core.schema import TextNode
+from llama_index.core.vector_stores.types import VectorStoreQuery
+
+from evaluation.stub_providers import HashingEmbedding, StubLLM
+from query.article_lookup import ArticleLookupQueryEngine
+from query.batch_query import _supports_search_batch, query_many
+from query.query_engine import (
+    get_index_retriever,
+    get_query_engine_based_on_index,
+    get_query_fusion_retrieval,
+)
+from retriever.article_index import ARTICLE_NUMBER_METADATA_KEY, ArticleIndex
+from retriever.numpy_vector_store import NumpyVectorStore
+from schema import VectorQuantization
+
+TEXTS = [
+    "La vitesse des véhicules est limitée à 130 km/h sur les autoroutes.",
+    "Le permis de conduire est délivré après un examen théorique et pratique.",
+    "Le stationnement des véhicules est interdit sur les trottoirs.",
+    "La conduite sous l'empire d'un état alcoolique est un délit.",
+    "Le port de la ceinture de sécurité est obligatoire.",
+    "Le conducteur doit céder le passage aux piétons engagés.",
+]
+QUERIES = [
+    "vitesse sur autoroute",
+    "examen du permis de conduire",
+    "stationnement sur le trottoir",
+    "alcool au volant",
+    "ceinture de sécurité",
+]
+
+embed_model = HashingEmbedding(embed_dim=64)
+
+
+@pytest.fixture(autouse=True)
+def stub_llm(monkeypatch):
+    monkeypatch.setattr(Settings, "_llm", StubLLM())
+
+
+def make_index(tmp_path, **store_kwargs) -> VectorStoreIndex:
+    nodes = [
+        TextNode(
+            id_=f"node-{i}",
+            text=text,
+            metadata={ARTICLE_NUMBER_METADATA_KEY: str(i + 1)},
+            embedding=embed_model.get_text_embedding(text),
+        )
+        for i, text in enumerate(TEXTS)
+    ]
+    vector_store = NumpyVectorStore(str(tmp_path / "collection"), **store_kwargs)
+    vector_store.add(nodes)
+    return VectorStoreIndex.from_vector_store(vector_store, embed_model=embed_model)
+
+
+def get_source_ids(response):
+    return [node.node.node_id for node in response.source_nodes]
+
+
+def test_default_engine_is_searched_in_batch(tmp_path, monkeypatch):
+    query_engine = get_query_engine_based_on_index(
+        make_index(tmp_path), [], similarity_top_k=2
+    )
+    assert _supports_search_batch(query_engine)
+    expected = [get_source_ids(query_engine.query(query)) for query in QUERIES]
+
+    def fail(*args, **kwargs):
+        raise AssertionError("the queries should be searched in batch")
+
+    monkeypatch.setattr(NumpyVectorStore, "query", fail)
+    results = query_many(query_engine, QUERIES, search_batch_size=2)
+    assert all(result.ok for result in results)
+    assert [get_source_ids(result.response) for result in results] == expected
+
+
+def test_wrapped_and_hybrid_engines_are_queried_one_by_one(tmp_path):
+    index = make_index(tmp_path)
+    query_engine = get_query_engine_based_on_index(index, [], similarity_top_k=2)
+    article_lookup_engine = ArticleLookupQueryEngine(
+        query_engine=query_engine,
+        article_index=ArticleIndex.from_nodes(
+            index.vector_store.get_nodes([f"node-{i}" for i in range(len(TEXTS))])
+        ),
+        vector_store=index.vector_store,
+    )
+    assert not _supports_search_batch(article_lookup_engine)
+    results = query_many(article_lookup_engine, ["que dit l'article 3 ?"])
+    assert get_source_ids(results[0].response) == ["node-2"]
+
+    hybrid_engine = RetrieverQueryEngine.from_args(
+        retriever=get_index_retriever(index, hybrid_search=True)
+    )
+    assert not _supports_search_batch(hybrid_engine)
+    query_rewrite_engine = get_query_fusion_retrieval(index, [], similarity_top_k=2)
+    assert not _supports_search_batch(query_rewrite_engine)
+
+
+@pytest.mark.parametrize(
+    "store_kwargs",
+    [
+        {},
+        {"dtype": "float16"},
+        {"quantization": VectorQuantization.INT8},
+    ],
+)
+def test_query_batch_matches_query(tmp_path, store_kwargs):
+    vector_store = make_index(tmp_path, **store_kwargs).vector_store
+    queries = [
+        VectorStoreQuery(
+            query_embedding=embed_model.get_query_embedding(query), similarity_top_k=3
+        )
+        for query in QUERIES
+    ]
+    for batch_result, query in zip(vector_store.query_batch(queries), queries):
+        result = vector_store.query(query)
+        assert batch_result.ids == result.ids
+        assert batch_result.similarities == pytest.approx(result.similarities, abs=1e-5)
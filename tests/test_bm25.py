@@ -0,0 +1,111 @@
+from llama_index.core.schema import TextNode
+
+from data_ingestion.nodes_processing import PAYLOAD_HASH_METADATA_KEY
+from retriever import bm25
+from retriever.bm25 import (
+    BM25Index,
+    BM25IndexBuilder,
+    FRENCH_STOPWORDS,
+    fold_accents,
+    save_bm25_index,
+    stem_french,
+    tokenize_french,
+)
+
+TEXTS = {
+    "vitesse": "La vitesse des véhicules est limitée à 130 km/h sur les autoroutes.",
+    "permis": "Le permis de conduire est délivré après un examen.",
+    "stationnement": "Le stationnement des véhicules est interdit sur les trottoirs.",
+}
+
+
+def make_nodes(payload_hash: str = "v1"):
+    return [
+        TextNode(
+            id_=node_id, text=text, metadata={PAYLOAD_HASH_METADATA_KEY: payload_hash}
+        )
+        for node_id, text in TEXTS.items()
+    ]
+
+
+def test_fold_accents():
+    assert fold_accents("élève œuvre à Noël") == "eleve oeuvre a Noel"
+
+
+def test_stemmer_merges_plural_and_feminine_forms():
+    assert stem_french("chevaux") == stem_french("cheval") == "cheval"
+    assert stem_french("voitures") == stem_french("voiture")
+    assert stem_french("assurees") == stem_french("assure")
+    assert stem_french("conduites") == stem_french("conduite")
+
+
+def test_stemmer_keeps_short_words():
+    assert stem_french("lois") == "lois"
+    assert stem_french("code") == "code"
+
+
+def test_tokenizer():
+    tokens = tokenize_french("L'article 1240 du Code civil s’applique aux véhicules")
+    assert "1240" in tokens
+    assert "code" in tokens
+    assert not {"l", "s", "du", "aux"} & set(tokens)
+    assert tokenize_french("Véhicules") == tokenize_french("vehicule")
+
+
+def test_stopwords_are_folded():
+    assert all(fold_accents(word) == word for word in FRENCH_STOPWORDS)
+
+
+def test_query_ranks_the_matching_nodes(tmp_path):
+    index = BM25Index.build(make_nodes(), str(tmp_path / "index"))
+    results = index.query("stationnement sur le trottoir", top_k=3)
+    assert results[0][0] == "stationnement"
+    assert {node_id for node_id, _ in index.query("véhicule", top_k=3)} == {
+        "vitesse",
+        "stationnement",
+    }
+
+
+def test_query_without_known_terms(tmp_path):
+    index = BM25Index.build(make_nodes(), str(tmp_path / "index"))
+    assert index.query("jardinage", top_k=3) == []
+    assert index.query("le la les", top_k=3) == []
+    assert index.query("permis", top_k=0) == []
+
+
+def test_query_with_doc_mask(tmp_path):
+    index = BM25Index.build(make_nodes(), str(tmp_path / "index"))
+    doc_mask = index.get_doc_mask(["vitesse"])
+    results = index.query("véhicules", top_k=3, doc_mask=doc_mask)
+    assert [node_id for node_id, _ in results] == ["vitesse"]
+
+
+def test_index_is_reloaded_from_disk(tmp_path):
+    built = BM25Index.build(make_nodes(), str(tmp_path / "index"))
+    loaded = BM25Index(str(tmp_path / "index"))
+    assert loaded.node_ids == built.node_ids
+    assert loaded.fingerprint == built.fingerprint
+    assert loaded.query("permis de conduire", top_k=2) == built.query(
+        "permis de conduire", top_k=2
+    )
+
+
+def test_fingerprint_follows_the_payload_hashes(tmp_path):
+    first = BM25Index.build(make_nodes("v1"), str(tmp_path / "first"))
+    second = BM25Index.build(make_nodes("v2"), str(tmp_path / "second"))
+    assert first.fingerprint != second.fingerprint
+
+
+def test_save_reuses_an_up_to_date_index(tmp_path, monkeypatch):
+    monkeypatch.setattr(bm25, "path_dir_bm25", str(tmp_path))
+    builder = BM25IndexBuilder()
+    for node in make_nodes():
+        builder.add(node)
+    index = save_bm25_index("collection", builder)
+    assert index.meta["n_docs"] == len(TEXTS)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("the index should not be rebuilt")
+
+    monkeypatch.setattr(BM25IndexBuilder, "build", fail)
+    assert save_bm25_index("collection", builder).fingerprint == index.fingerprint
@@ -0,0 +1,78 @@
+from data_ingestion.chunking import TokenChunker, estimate_tokens
+
+
+def count_words(text: str) -> int:
+    return len(text.split())
+
+
+def make_text(n_sentences: int, words_per_sentence: int = 6) -> str:
+    return " ".join(
+        " ".join(f"mot{i}_{j}" for j in range(words_per_sentence - 1)) + f" fin{i}."
+        for i in range(n_sentences)
+    )
+
+
+def test_short_text_is_one_chunk():
+    chunker = TokenChunker(count_tokens=count_words, max_tokens=50)
+    text = "L'article est court.\nIl tient en un seul morceau."
+    assert chunker.split(text) == [text]
+
+
+def test_blank_text_is_kept():
+    chunker = TokenChunker(count_tokens=count_words, max_tokens=5)
+    assert chunker.split("  \n ") == ["  \n "]
+
+
+def test_chunks_fit_the_budget_and_keep_the_words_in_order():
+    chunker = TokenChunker(count_tokens=count_words, max_tokens=20)
+    text = make_text(30)
+    chunks = chunker.split(text)
+    assert len(chunks) > 1
+    assert all(count_words(chunk) <= 20 for chunk in chunks)
+    assert " ".join(chunks).split() == text.split()
+
+
+def test_chunks_end_on_sentence_boundaries():
+    chunker = TokenChunker(count_tokens=count_words, max_tokens=20)
+    chunks = chunker.split(make_text(30))
+    assert all(chunk.endswith(".") for chunk in chunks)
+
+
+def test_paragraphs_are_kept_apart():
+    chunker = TokenChunker(count_tokens=count_words, max_tokens=4)
+    chunks = chunker.split("un deux\ntrois quatre\ncinq six")
+    assert chunks == ["un deux", "trois quatre", "cinq six"]
+
+
+def test_overlap_repeats_the_end_of_the_previous_chunk():
+    chunker = TokenChunker(count_tokens=count_words, max_tokens=20, overlap_tokens=7)
+    chunks = chunker.split(make_text(30))
+    assert all(count_words(chunk) <= 20 for chunk in chunks)
+    for previous, chunk in zip(chunks, chunks[1:]):
+        # one sentence of 6 words (7 tokens with its separator) is repeated
+        last_sentence = " ".join(previous.split()[-6:])
+        assert chunk.startswith(last_sentence)
+
+
+def test_long_sentence_is_split_on_words():
+    chunker = TokenChunker(count_tokens=count_words, max_tokens=5)
+    text = " ".join(f"mot{i}" for i in range(23))
+    chunks = chunker.split(text)
+    assert all(count_words(chunk) <= 5 for chunk in chunks)
+    assert " ".join(chunks).split() == text.split()
+
+
+def test_long_word_is_cut_by_characters():
+    chunker = TokenChunker(count_tokens=estimate_tokens, max_tokens=10)
+    text = "x" * 200
+    chunks = chunker.split(text)
+    assert len(chunks) > 1
+    assert all(estimate_tokens(chunk) <= 10 for chunk in chunks)
+    assert "".join(chunks) == text
+
+
+def test_max_tokens_override():
+    chunker = TokenChunker(count_tokens=count_words, max_tokens=1000)
+    chunks = chunker.split(make_text(10), max_tokens=12)
+    assert len(chunks) > 1
+    assert all(count_words(chunk) <= 12 for chunk in chunks)
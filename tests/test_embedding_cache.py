@@ -0,0 +1,113 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import numpy as np
+import pytest
+from llama_index.core.schema import TextNode
+
+from evaluation.stub_providers import HashingEmbedding
+from retriever.embedding_cache import (
+    KEYS_FILE_NAME,
+    VECTORS_FILE_NAME,
+    EmbeddingCache,
+    embed_nodes_with_cache,
+    get_cache_namespace,
+)
+
+
+class CountingEmbedding(HashingEmbedding):
+    n_embedded_texts: int = 0
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        self.n_embedded_texts += len(texts)
+        return super()._get_text_embeddings(texts)
+
+
+def test_get_cache_namespace():
+    assert get_cache_namespace(HashingEmbedding(embed_dim=64)) == "hashing-64"
+    assert (
+        get_cache_namespace(HashingEmbedding(embed_dim=64, dimensions=32))
+        == "hashing-64_d32"
+    )
+
+
+def test_put_and_get(tmp_path):
+    cache = EmbeddingCache("model", str(tmp_path))
+    assert cache.get_many(["a", "b"]) == [None, None]
+    cache.put_many(["a", "b", "a"], [[1.0, 0.0], [0.0, 1.0], [2.0, 2.0]])
+    assert len(cache) == 2
+    assert cache.get_many(["b", "a", "c"]) == [[0.0, 1.0], [1.0, 0.0], None]
+    assert (cache.hits, cache.misses) == (2, 3)
+
+
+def test_cache_is_persisted(tmp_path):
+    EmbeddingCache("model", str(tmp_path)).put_many(["a"], [[1.0, 0.0]])
+    cache = EmbeddingCache("model", str(tmp_path))
+    cache.put_many(["a", "b"], [[5.0, 5.0], [0.0, 1.0]])
+    cache = EmbeddingCache("model", str(tmp_path))
+    assert len(cache) == 2
+    # the first embedding of a text is kept
+    assert cache.get_many(["a", "b"]) == [[1.0, 0.0], [0.0, 1.0]]
+    assert EmbeddingCache("other", str(tmp_path)).get_many(["a"]) == [None]
+
+
+@pytest.mark.parametrize("torn_key", ["", "deadbeef"])
+def test_interrupted_put_is_dropped_on_load(tmp_path, torn_key):
+    EmbeddingCache("model", str(tmp_path)).put_many(["a"], [[1.0, 0.0]])
+    # vectors are written before keys: a crash in between leaves a row without key,
+    # and possibly a key without line break
+    dir_path = tmp_path / "model"
+    with open(dir_path / VECTORS_FILE_NAME, "ab") as f:
+        f.write(np.array([9.0, 9.0], dtype=np.float32).tobytes())
+    with open(dir_path / KEYS_FILE_NAME, "a") as f:
+        f.write(torn_key)
+
+    cache = EmbeddingCache("model", str(tmp_path))
+    assert len(cache) == 1
+    cache.put_many(["b"], [[0.0, 1.0]])
+    cache = EmbeddingCache("model", str(tmp_path))
+    assert len(cache) == 2
+    assert cache.get_many(["a", "b"]) == [[1.0, 0.0], [0.0, 1.0]]
+    assert os.path.getsize(dir_path / VECTORS_FILE_NAME) == 2 * 2 * 4
+
+
+def test_embed_nodes_with_cache(tmp_path):
+    embed_model = CountingEmbedding(embed_dim=16)
+    cache = EmbeddingCache(get_cache_namespace(embed_model), str(tmp_path))
+    texts = ["Le permis de conduire.", "La vitesse maximale.", "Le permis de conduire."]
+
+    nodes = [TextNode(text=text) for text in texts]
+    embed_nodes_with_cache(nodes, embed_model, cache)
+    assert embed_model.n_embedded_texts == 3
+    assert len(cache) == 2
+    for node, text in zip(nodes, texts):
+        assert node.embedding == pytest.approx(embed_model.get_text_embedding(text))
+
+    nodes = [TextNode(text=text) for text in texts + ["Le stationnement."]]
+    n_embedded_texts = embed_model.n_embedded_texts
+    embed_nodes_with_cache(nodes, embed_model, cache)
+    assert embed_model.n_embedded_texts == n_embedded_texts + 1
+    assert len(cache) == 3
+    assert nodes[0].embedding == pytest.approx(embed_model.get_text_embedding(texts[0]))
+
+
+def test_get_during_puts(tmp_path):
+    cache = EmbeddingCache("model", str(tmp_path))
+    texts = [f"texte {i}" for i in range(20000)]
+
+    def put():
+        for start in range(0, len(texts), 1000):
+            batch = texts[start : start + 1000]
+            cache.put_many(batch, [[float(i), 1.0] for i in range(start, start + 1000)])
+
+    def get():
+        for _ in range(50):
+            for i, embedding in enumerate(cache.get_many(texts[::10])):
+                assert embedding in (None, [float(10 * i), 1.0])
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(put)] + [executor.submit(get) for _ in range(3)]
+        for future in futures:
+            future.result()
+    assert len(cache) == len(texts)
@@ -0,0 +1,207 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+from llama_index.core.schema import TextNode
+from llama_index.core.vector_stores.types import (
+    MetadataFilter,
+    MetadataFilters,
+    VectorStoreQuery,
+)
+
+from evaluation.stub_providers import HashingEmbedding
+from retriever.numpy_vector_store import (
+    IDS_FILE_NAME,
+    PAYLOADS_FILE_NAME,
+    VECTORS_FILE_NAME,
+    NumpyVectorStore,
+)
+from schema import VectorQuantization
+
+TEXTS = {
+    "vitesse": "La vitesse est limitée à 130 km/h sur autoroute.",
+    "permis": "Le permis de conduire est délivré après un examen.",
+    "stationnement": "Le stationnement est interdit sur les trottoirs.",
+    "alcool": "La conduite sous l'empire d'un état alcoolique est un délit.",
+}
+
+embed_model = HashingEmbedding(embed_dim=64)
+
+
+def make_node(node_id: str, text: str, **metadata) -> TextNode:
+    return TextNode(
+        id_=node_id,
+        text=text,
+        metadata={"theme": node_id, **metadata},
+        embedding=embed_model.get_text_embedding(text),
+    )
+
+
+def make_nodes():
+    return [make_node(node_id, text) for node_id, text in TEXTS.items()]
+
+
+def query(store: NumpyVectorStore, text: str, top_k: int = 1, **kwargs):
+    return store.query(
+        VectorStoreQuery(
+            query_embedding=embed_model.get_query_embedding(text),
+            similarity_top_k=top_k,
+            **kwargs,
+        )
+    )
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = NumpyVectorStore(str(tmp_path / "collection"))
+    store.add(make_nodes())
+    return store
+
+
+def test_query_returns_the_closest_nodes(store):
+    result = query(store, TEXTS["permis"], top_k=2)
+    assert result.ids[0] == "permis"
+    assert result.nodes[0].get_content() == TEXTS["permis"]
+    assert result.similarities[0] == pytest.approx(1.0, abs=1e-5)
+    assert result.similarities[0] >= result.similarities[1]
+
+
+def test_query_with_filters(store):
+    filters = MetadataFilters(filters=[MetadataFilter(key="theme", value="alcool")])
+    result = query(store, TEXTS["permis"], top_k=3, filters=filters)
+    assert result.ids == ["alcool"]
+
+
+def test_replaced_node_is_tombstoned(store):
+    store.add([make_node("permis", "Le permis à points compte douze points.")])
+    assert store.n_nodes == len(TEXTS)
+    assert store.n_deleted_rows == 1
+    result = query(store, "permis à points", top_k=len(TEXTS))
+    assert result.ids.count("permis") == 1
+    assert result.nodes[0].get_content() == "Le permis à points compte douze points."
+
+
+def test_deleted_nodes_are_not_returned(store):
+    store.delete_nodes(["permis", "unknown"])
+    assert store.n_nodes == len(TEXTS) - 1
+    assert store.n_deleted_rows == 1
+    assert "permis" not in query(store, TEXTS["permis"], top_k=len(TEXTS)).ids
+    assert store.get_nodes(["permis"]) == []
+
+
+def test_deletions_are_persisted(store):
+    store.delete_nodes(["permis"])
+    store.add([make_node("vitesse", "La vitesse est limitée à 110 km/h.")])
+    reloaded = NumpyVectorStore(store.persist_dir)
+    assert reloaded.n_nodes == len(TEXTS) - 1
+    assert reloaded.n_deleted_rows == 2
+    assert "permis" not in query(reloaded, TEXTS["permis"], top_k=len(TEXTS)).ids
+    [node] = reloaded.get_nodes(["vitesse"])
+    assert node.get_content() == "La vitesse est limitée à 110 km/h."
+
+
+def test_compact_drops_the_deleted_rows(store):
+    store.delete_nodes(["permis"])
+    store.add([make_node("vitesse", "La vitesse est limitée à 110 km/h.")])
+    store.compact()
+    assert store.n_deleted_rows == 0
+    assert store.n_nodes == len(TEXTS) - 1
+    with open(os.path.join(store.persist_dir, IDS_FILE_NAME)) as f:
+        assert sorted(f.read().split()) == ["alcool", "stationnement", "vitesse"]
+    reloaded = NumpyVectorStore(store.persist_dir)
+    assert query(reloaded, TEXTS["alcool"]).ids == ["alcool"]
+    [node] = reloaded.get_nodes(["vitesse"])
+    assert node.get_content() == "La vitesse est limitée à 110 km/h."
+
+
+def test_interrupted_add_is_dropped_on_load(store):
+    # vectors and payloads are written before the ids: a crash in between leaves
+    # rows without ids, which must not shift the rows appended next
+    for file_name in (VECTORS_FILE_NAME, PAYLOADS_FILE_NAME):
+        with open(os.path.join(store.persist_dir, file_name), "ab") as f:
+            f.write(b"\x01" * 100)
+    reloaded = NumpyVectorStore(store.persist_dir)
+    assert reloaded.n_nodes == len(TEXTS)
+    reloaded.add([make_node("amende", "L'amende forfaitaire est de 135 euros.")])
+    reloaded = NumpyVectorStore(store.persist_dir)
+    assert query(reloaded, "amende forfaitaire").ids == ["amende"]
+    [node] = reloaded.get_nodes(["amende"])
+    assert node.get_content() == "L'amende forfaitaire est de 135 euros."
+    assert query(reloaded, TEXTS["permis"]).ids == ["permis"]
+
+
+def test_metadata_values(store):
+    assert store.get_metadata_values("theme") == {node_id: node_id for node_id in TEXTS}
+
+
+def test_mean_vector(store):
+    mean = store.get_mean_vector(["permis", "alcool"])
+    expected = np.mean(
+        [
+            embed_model.get_text_embedding(TEXTS["permis"]),
+            embed_model.get_text_embedding(TEXTS["alcool"]),
+        ],
+        axis=0,
+    )
+    assert mean == pytest.approx(expected, abs=1e-5)
+    assert store.get_mean_vector([]) is None
+
+
+@pytest.mark.parametrize(
+    "dtype, quantization",
+    [
+        ("float16", VectorQuantization.NONE),
+        ("float32", VectorQuantization.INT8),
+        ("float32", VectorQuantization.BINARY),
+    ],
+)
+def test_compact_stores(tmp_path, dtype, quantization):
+    store = NumpyVectorStore(
+        str(tmp_path / "collection"), dtype=dtype, quantization=quantization
+    )
+    store.add(make_nodes())
+    store.delete_nodes(["vitesse"])
+    store.compact()
+    reloaded = NumpyVectorStore(store.persist_dir)
+    assert reloaded.dtype == dtype
+    assert reloaded.quantization == quantization
+    for node_id in ("permis", "stationnement", "alcool"):
+        assert query(reloaded, TEXTS[node_id]).ids == [node_id]
+
+
+def test_unsupported_dtype(tmp_path):
+    with pytest.raises(ValueError):
+        NumpyVectorStore(str(tmp_path / "collection"), dtype="int8")
+
+
+def test_clear(store):
+    store.clear()
+    assert store.n_nodes == 0
+    assert not os.path.exists(store.persist_dir)
+    assert query(store, TEXTS["permis"]).ids == []
+
+
+def test_queries_during_adds_and_compactions(store):
+    new_nodes = [
+        make_node(f"article-{i}", f"Article {i} du code de la route.")
+        for i in range(200)
+    ]
+
+    def write():
+        for start in range(0, len(new_nodes), 10):
+            store.add(new_nodes[start : start + 10])
+            store.delete_nodes([new_nodes[start].node_id])
+            if start % 50 == 0:
+                store.compact()
+
+    def read():
+        for _ in range(100):
+            assert query(store, TEXTS["permis"]).ids == ["permis"]
+            assert [node.node_id for node in store.get_nodes(["alcool"])] == ["alcool"]
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(write)] + [executor.submit(read) for _ in range(3)]
+        for future in futures:
+            future.result()
+    assert store.n_nodes == len(TEXTS) + len(new_nodes) - len(new_nodes) // 10
@@ -0,0 +1,40 @@
+from llama_index.core.schema import NodeWithScore, TextNode
+
+from data_ingestion.constants import possible_headers
+from data_ingestion.window_nodes import WindowReconstructionPostProcessor
+
+
+def make_nodes():
+    return [
+        TextNode(id_=f"node-{i}", text=f"article {i}", metadata={"titre": "Titre"})
+        for i in range(5)
+    ]
+
+
+def test_window_reconstruction_leaves_the_retrieved_nodes_unchanged():
+    nodes = make_nodes()
+    postprocessor = WindowReconstructionPostProcessor(
+        "test-window-reconstruction", make_nodes, window_size=1
+    )
+    retrieved = [NodeWithScore(node=nodes[2], score=0.5)]
+
+    for _ in range(3):
+        result = postprocessor.postprocess_nodes(retrieved)
+
+    assert retrieved[0].node.text == "article 2"
+    assert retrieved[0].node.excluded_llm_metadata_keys == []
+    assert result[0].score == 0.5
+    assert result[0].node.node_id == "node-2"
+    assert "article 1" in result[0].node.text
+    assert "article 3" in result[0].node.text
+    assert "article 4" not in result[0].node.text
+    assert result[0].node.excluded_llm_metadata_keys == possible_headers
+
+
+def test_window_reconstruction_keeps_unknown_nodes():
+    postprocessor = WindowReconstructionPostProcessor(
+        "test-window-reconstruction-unknown", make_nodes
+    )
+    retrieved = [NodeWithScore(node=TextNode(id_="other", text="other"), score=1.0)]
+
+    assert postprocessor.postprocess_nodes(retrieved) == retrieved
@@ -1,12 +1,60 @@
+import asyncio
+import hashlib
 import json
+import os
+import time
+from typing import Optional
 
 
 def save_json(data, path):
-    with open(path, "w") as js:
+    # write to a temporary file first so that an interrupted save never leaves a
+    # truncated file behind
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as js:
         json.dump(data, js)
+    os.replace(tmp_path, path)
 
 
 def load_json(path):
     with open(path, "r") as js:
         data = json.load(js)
     return data
+
+
+def hash_text(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class RateLimiter:
+    """
+    Async context manager limiting the number of calls running at once and,
+    optionally, the number of calls started per minute.
+
+        rate_limiter = RateLimiter(max_concurrency=8, max_calls_per_minute=500)
+        async with rate_limiter:
+            await llm.acomplete(prompt)
+
+    It must be created and used in the same event loop.
+    """
+
+    def __init__(
+        self, max_concurrency: int = 8, max_calls_per_minute: Optional[float] = None
+    ):
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._interval = 60 / max_calls_per_minute if max_calls_per_minute else 0.0
+        self._next_start = 0.0
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        await self._semaphore.acquire()
+        if self._interval:
+            # the calls are spread evenly, at most one every `_interval` seconds
+            async with self._lock:
+                now = time.monotonic()
+                start = max(now, self._next_start)
+                self._next_start = start + self._interval
+            await asyncio.sleep(start - now)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._semaphore.release()